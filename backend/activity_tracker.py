@@ -0,0 +1,414 @@
+"""
+Heartbeat ingestion off the request path.
+
+/heartbeat only touches memory:
+- the beat is recorded in a write-behind buffer (one pending item per device) that
+  is flushed with a multi-row user_activity upsert;
+- the heatmap spam check runs against an in-process device state table, and
+  counted beats accumulate per (lat_bucket, lng_bucket) until they are merged into
+  user_activity_heatmap_cell in one bulk statement every HEATMAP_FLUSH_SECONDS.
+"""
+import math
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import text
+
+from db import db
+from heatmap_store import compact_heatmap_buckets, upsert_heatmap_cells, values_sql
+from memory_cache import SegmentedLRUCache
+from presence import PresenceRegistry
+from write_behind import WriteBehindBuffer
+
+HEATMAP_COOLDOWN_SECONDS = int((os.getenv("HEATMAP_SPAM_COOLDOWN_SECONDS") or "12").strip() or "12")
+HEATMAP_COOLDOWN_SECONDS = max(3, min(300, HEATMAP_COOLDOWN_SECONDS))
+
+HEATMAP_MIN_MOVE_METERS = float((os.getenv("HEATMAP_SPAM_MIN_MOVE_METERS") or "20").strip() or "20")
+HEATMAP_MIN_MOVE_METERS = max(0.0, min(1000.0, HEATMAP_MIN_MOVE_METERS))
+
+_HEARTBEAT_FLUSH_SECONDS = float((os.getenv("HEARTBEAT_FLUSH_SECONDS") or "5").strip() or "5")
+_HEARTBEAT_FLUSH_SECONDS = max(0.5, min(60.0, _HEARTBEAT_FLUSH_SECONDS))
+_HEARTBEAT_BATCH = int((os.getenv("HEARTBEAT_FLUSH_BATCH") or "500").strip() or "500")
+_HEARTBEAT_BATCH = max(10, min(5000, _HEARTBEAT_BATCH))
+_HEARTBEAT_MAX_PENDING = int((os.getenv("HEARTBEAT_MAX_PENDING_DEVICES") or "50000").strip() or "50000")
+_HEARTBEAT_MAX_PENDING = max(_HEARTBEAT_BATCH, min(500000, _HEARTBEAT_MAX_PENDING))
+
+ONLINE_WINDOW_SECONDS = int((os.getenv("HEARTBEAT_ONLINE_WINDOW_SECONDS") or "45").strip() or "45")
+ONLINE_WINDOW_SECONDS = max(15, min(300, ONLINE_WINDOW_SECONDS))
+_PRESENCE_RECONCILE_SECONDS = int((os.getenv("PRESENCE_RECONCILE_SECONDS") or "300").strip() or "300")
+_PRESENCE_RECONCILE_SECONDS = max(30, min(3600, _PRESENCE_RECONCILE_SECONDS))
+
+_HEATMAP_FLUSH_SECONDS = float((os.getenv("HEATMAP_FLUSH_SECONDS") or "10").strip() or "10")
+_HEATMAP_FLUSH_SECONDS = max(1.0, min(300.0, _HEATMAP_FLUSH_SECONDS))
+_HEATMAP_CELL_BATCH = int((os.getenv("HEATMAP_FLUSH_BATCH") or "1000").strip() or "1000")
+_HEATMAP_CELL_BATCH = max(10, min(5000, _HEATMAP_CELL_BATCH))
+_HEATMAP_MAX_PENDING_CELLS = int((os.getenv("HEATMAP_MAX_PENDING_CELLS") or "100000").strip() or "100000")
+_HEATMAP_MAX_PENDING_CELLS = max(_HEATMAP_CELL_BATCH, min(1000000, _HEATMAP_MAX_PENDING_CELLS))
+_HEATMAP_HOURLY_RETENTION_HOURS = int((os.getenv("HEATMAP_HOURLY_RETENTION_HOURS") or "48").strip() or "48")
+_HEATMAP_HOURLY_RETENTION_HOURS = max(24, min(24 * 31, _HEATMAP_HOURLY_RETENTION_HOURS))
+_HEATMAP_DAILY_RETENTION_DAYS = int((os.getenv("HEATMAP_DAILY_RETENTION_DAYS") or "90").strip() or "90")
+_HEATMAP_DAILY_RETENTION_DAYS = max(7, min(3650, _HEATMAP_DAILY_RETENTION_DAYS))
+_HEATMAP_COMPACT_INTERVAL_SECONDS = int((os.getenv("HEATMAP_COMPACT_INTERVAL_SECONDS") or "3600").strip() or "3600")
+_HEATMAP_COMPACT_INTERVAL_SECONDS = max(60, min(86400, _HEATMAP_COMPACT_INTERVAL_SECONDS))
+_heatmap_compacted_at = None
+
+_HEATMAP_DEVICE_STATE_MAX = int((os.getenv("HEATMAP_DEVICE_STATE_MAX") or "200000").strip() or "200000")
+_HEATMAP_DEVICE_STATE_MAX = max(1000, min(2000000, _HEATMAP_DEVICE_STATE_MAX))
+
+# device_id -> (last_counted_at, lat, lng). State cũ hơn cooldown không còn ảnh hưởng quyết định
+# (cooldown đã qua thì beat luôn được đếm), nên TTL = cooldown và mất state khi restart là vô hại.
+_HEATMAP_DEVICE_STATE = SegmentedLRUCache(
+    "heatmap_device_state",
+    max_items=_HEATMAP_DEVICE_STATE_MAX,
+    ttl_seconds=HEATMAP_COOLDOWN_SECONDS,
+)
+_HEATMAP_STATE_LOCK = threading.Lock()
+
+# Hit mới theo cell kể từ lần drain trước, cho stream metrics admin. Chỉ ghi khi stream đang chạy
+# (set_recent_heatmap_hits_enabled): hit cũ hơn lần dashboard tải /admin/heatmap đã nằm trong DB,
+# gửi lại sẽ bị cộng hai lần. Mỗi process chỉ thấy hit của chính nó.
+_RECENT_CELL_HITS = {}
+_RECENT_CELL_HITS_MAX = 20000
+_RECENT_CELL_HITS_LOCK = threading.Lock()
+_recent_cell_hits_enabled = False
+
+# Device online trong cửa sổ heartbeat; DB chỉ được đọc khi cold start và đối soát định kỳ.
+_PRESENCE = PresenceRegistry(ONLINE_WINDOW_SECONDS)
+_PRESENCE_LOCK = threading.Lock()
+_presence_reconciled_at = None
+
+# Kết quả kiểm tra user_profile theo user_id, để flush không phải hỏi lại mỗi lần.
+_USER_PROFILE_EXISTS = SegmentedLRUCache("user_profile_exists", max_items=20000, ttl_seconds=600)
+
+_FLASK_APP = None
+
+
+def _distance_meters(lat1, lng1, lat2, lng2):
+    r = 6371000.0
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    delta_phi = math.radians(lat2 - lat1)
+    delta_lambda = math.radians(lng2 - lng1)
+    a = (
+        math.sin(delta_phi / 2.0) ** 2
+        + math.cos(phi1) * math.cos(phi2) * math.sin(delta_lambda / 2.0) ** 2
+    )
+    c = 2.0 * math.atan2(math.sqrt(a), math.sqrt(1.0 - a))
+    return r * c
+
+
+def _merge_beats(pending, beat):
+    # Beat mới không có vị trí thì giữ vị trí của beat đang chờ (giống UPDATE cũ không đụng last_lat/lng).
+    if beat["lat"] is None and pending["lat"] is not None:
+        beat = {**beat, "lat": pending["lat"], "lng": pending["lng"]}
+    return beat
+
+
+def _resolve_user_profiles(beats):
+    """Null out user_id values that have no user_profile row (avoids FK violations)."""
+    unknown = sorted({
+        beat["user_id"] for beat in beats
+        if beat["user_id"] and _USER_PROFILE_EXISTS.get(beat["user_id"]) is None
+    })
+    if unknown:
+        try:
+            rows = db.session.execute(
+                text("SELECT id::text AS id FROM user_profile WHERE id = ANY(CAST(:user_ids AS uuid[]))"),
+                {"user_ids": unknown},
+            ).mappings().all()
+            found = {row["id"] for row in rows}
+            for user_id in unknown:
+                _USER_PROFILE_EXISTS.set(user_id, user_id in found)
+        except Exception as exc:
+            db.session.rollback()
+            print(f"[heartbeat] user_profile lookup skipped: {exc}")
+
+    for beat in beats:
+        if beat["user_id"] and not _USER_PROFILE_EXISTS.get(beat["user_id"]):
+            beat["user_id"] = None
+            # Presence đã ghi theo user_id lúc nhận beat: chuyển về identity của session.
+            _PRESENCE.touch(beat["device_id"], beat["session_identity"], beat["seen_at"].timestamp())
+        beat["user_identity"] = f"user_profile:{beat['user_id']}" if beat["user_id"] else beat["session_identity"]
+
+
+def _upsert_user_activity(beats):
+    values, params = values_sql(beats, ("device_id", "user_id", "user_identity", "seen_at", "lat", "lng"))
+    db.session.execute(
+        text(
+            f"""
+            INSERT INTO user_activity (device_id, user_id, user_identity, last_seen, last_lat, last_lng)
+            VALUES {values}
+            ON CONFLICT (device_id) DO UPDATE
+            SET user_id = EXCLUDED.user_id,
+                user_identity = EXCLUDED.user_identity,
+                last_seen = GREATEST(user_activity.last_seen, EXCLUDED.last_seen),
+                last_lat = COALESCE(EXCLUDED.last_lat, user_activity.last_lat),
+                last_lng = COALESCE(EXCLUDED.last_lng, user_activity.last_lng)
+            """
+        ),
+        params,
+    )
+
+
+def _upsert_user_activity_rowwise(beats):
+    """
+    Fallback when the device_id unique index is missing (historical duplicate rows):
+    update-or-insert per device and keep one canonical row.
+    """
+    for beat in beats:
+        params = {
+            "device_id": beat["device_id"],
+            "user_id": beat["user_id"],
+            "user_identity": beat["user_identity"],
+            "seen_at": beat["seen_at"],
+            "lat": beat["lat"],
+            "lng": beat["lng"],
+        }
+        updated = db.session.execute(
+            text(
+                """
+                UPDATE user_activity
+                SET last_seen = :seen_at,
+                    user_id = :user_id,
+                    user_identity = :user_identity,
+                    last_lat = COALESCE(:lat, last_lat),
+                    last_lng = COALESCE(:lng, last_lng)
+                WHERE device_id = :device_id
+                RETURNING id
+                """
+            ),
+            params,
+        ).mappings().all()
+        if not updated:
+            db.session.execute(
+                text(
+                    """
+                    INSERT INTO user_activity (device_id, user_id, user_identity, last_seen, last_lat, last_lng)
+                    VALUES (:device_id, :user_id, :user_identity, :seen_at, :lat, :lng)
+                    """
+                ),
+                params,
+            )
+        elif len(updated) > 1:
+            db.session.execute(
+                text("DELETE FROM user_activity WHERE device_id = :device_id AND id <> :keep_id"),
+                {"device_id": beat["device_id"], "keep_id": updated[0]["id"]},
+            )
+
+
+def _should_count_locked(device_id, lat, lng, now):
+    state = _HEATMAP_DEVICE_STATE.get(device_id)
+    if state is None:
+        # Không có state trong cửa sổ cooldown (hoặc đã hết TTL): cooldown coi như đã qua.
+        return True
+    last_counted_at, last_lat, last_lng = state
+    if now - last_counted_at >= timedelta(seconds=HEATMAP_COOLDOWN_SECONDS):
+        return True
+    return _distance_meters(last_lat, last_lng, lat, lng) >= HEATMAP_MIN_MOVE_METERS
+
+
+def count_heatmap_beat(device_id, lat, lng, now=None):
+    """
+    Apply the spam cooldown / minimum-move check against the in-process device state
+    and, if the beat counts, add it to the pending cell hits. Returns whether it counted.
+    """
+    now = now or datetime.now(timezone.utc)
+    lat = float(lat)
+    lng = float(lng)
+    with _HEATMAP_STATE_LOCK:
+        if not _should_count_locked(device_id, lat, lng, now):
+            return False
+        _HEATMAP_DEVICE_STATE.set(device_id, (now, lat, lng))
+
+    lat_bucket = round(lat, 4)
+    lng_bucket = round(lng, 4)
+    if _recent_cell_hits_enabled:
+        with _RECENT_CELL_HITS_LOCK:
+            cell_key = (lat_bucket, lng_bucket)
+            if cell_key in _RECENT_CELL_HITS or len(_RECENT_CELL_HITS) < _RECENT_CELL_HITS_MAX:
+                _RECENT_CELL_HITS[cell_key] = _RECENT_CELL_HITS.get(cell_key, 0) + 1
+    _HEATMAP_CELL_BUFFER.put(
+        (lat_bucket, lng_bucket),
+        {"lat_bucket": lat_bucket, "lng_bucket": lng_bucket, "hit_count": 1, "last_seen": now},
+    )
+    return True
+
+
+def set_recent_heatmap_hits_enabled(enabled):
+    """Start/stop recording per-cell hits for drain_recent_heatmap_hits(); both reset the pending hits."""
+    global _recent_cell_hits_enabled
+    with _RECENT_CELL_HITS_LOCK:
+        _recent_cell_hits_enabled = bool(enabled)
+        _RECENT_CELL_HITS.clear()
+
+
+def drain_recent_heatmap_hits():
+    """Cells counted since the previous call: [{"lat", "lng", "hits"}]."""
+    global _RECENT_CELL_HITS
+    with _RECENT_CELL_HITS_LOCK:
+        drained, _RECENT_CELL_HITS = _RECENT_CELL_HITS, {}
+    return [{"lat": lat, "lng": lng, "hits": hits} for (lat, lng), hits in drained.items()]
+
+
+def _merge_cell_hits(pending, hit):
+    return {
+        **pending,
+        "hit_count": pending["hit_count"] + hit["hit_count"],
+        "last_seen": max(pending["last_seen"], hit["last_seen"]),
+    }
+
+
+def _compact_heatmap_buckets_if_due():
+    global _heatmap_compacted_at
+    now = time.monotonic()
+    if _heatmap_compacted_at is not None and now - _heatmap_compacted_at < _HEATMAP_COMPACT_INTERVAL_SECONDS:
+        return
+    _heatmap_compacted_at = now
+    try:
+        folded, dropped = compact_heatmap_buckets(_HEATMAP_HOURLY_RETENTION_HOURS, _HEATMAP_DAILY_RETENTION_DAYS)
+        if folded or dropped:
+            print(f"[heatmap] compacted hourly_folded={folded} daily_dropped={dropped}")
+    except Exception as exc:
+        print(f"[heatmap] bucket compaction skipped: {exc}")
+
+
+def _flush_heatmap_cells(cells):
+    """Merge accumulated cell hits into the heatmap grids and hourly buckets with one statement each."""
+    with _FLASK_APP.app_context():
+        upsert_heatmap_cells(cells)
+        # Chạy trên thread flush sẵn có: không cần thêm worker riêng cho việc gộp bucket cũ.
+        _compact_heatmap_buckets_if_due()
+
+
+def _flush_heartbeats(beats):
+    # Flush callback của write-behind buffer, chạy trên thread nền nên cần app context riêng.
+    with _FLASK_APP.app_context():
+        beats = [dict(beat) for beat in beats]
+        _resolve_user_profiles(beats)
+        try:
+            _upsert_user_activity(beats)
+            db.session.commit()
+        except Exception as exc:
+            db.session.rollback()
+            print(f"[heartbeat] bulk upsert failed, falling back to per-device writes: {exc}")
+            try:
+                _upsert_user_activity_rowwise(beats)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+
+
+_HEATMAP_CELL_BUFFER = WriteBehindBuffer(
+    "heatmap_cells",
+    _flush_heatmap_cells,
+    max_batch=_HEATMAP_CELL_BATCH,
+    flush_interval=_HEATMAP_FLUSH_SECONDS,
+    max_pending=_HEATMAP_MAX_PENDING_CELLS,
+    merge_fn=_merge_cell_hits,
+)
+
+_HEARTBEAT_BUFFER = WriteBehindBuffer(
+    "heartbeat",
+    _flush_heartbeats,
+    max_batch=_HEARTBEAT_BATCH,
+    flush_interval=_HEARTBEAT_FLUSH_SECONDS,
+    max_pending=_HEARTBEAT_MAX_PENDING,
+    merge_fn=_merge_beats,
+)
+
+
+def record_heartbeat(flask_app, device_id, user_id=None, session_identity=None, lat=None, lng=None):
+    """
+    Buffer one heartbeat without touching the DB. Beats of the same device within a
+    flush interval are coalesced (latest wins, last known location kept); the heatmap
+    check runs immediately against in-process state.
+    """
+    global _FLASK_APP
+    _FLASK_APP = flask_app
+
+    if user_id and _USER_PROFILE_EXISTS.get(user_id) is False:
+        user_id = None
+    beat = {
+        "device_id": device_id,
+        "user_id": user_id,
+        "session_identity": session_identity,
+        "seen_at": datetime.now(timezone.utc),
+        "lat": lat,
+        "lng": lng,
+    }
+    _HEARTBEAT_BUFFER.put(device_id, beat)
+    _PRESENCE.touch(device_id, user_id or session_identity, beat["seen_at"].timestamp())
+    heatmap_counted = False
+    if lat is not None and lng is not None:
+        heatmap_counted = count_heatmap_beat(device_id, lat, lng, now=beat["seen_at"])
+    return {
+        **beat,
+        "user_identity": f"user_profile:{user_id}" if user_id else session_identity,
+        "heatmap_counted": heatmap_counted,
+    }
+
+
+def _reconcile_presence():
+    # Cold start / đối soát: nạp device đã được flush (kể cả từ process khác) trong cửa sổ online.
+    rows = db.session.execute(
+        text(
+            """
+            SELECT device_id, COALESCE(user_id::text, user_identity) AS identity, last_seen
+            FROM user_activity
+            WHERE last_seen > NOW() - (:window_seconds * INTERVAL '1 second')
+            """
+        ),
+        {"window_seconds": ONLINE_WINDOW_SECONDS},
+    ).mappings().all()
+    for row in rows:
+        last_seen = row["last_seen"]
+        if last_seen is None:
+            continue
+        if last_seen.tzinfo is None:
+            last_seen = last_seen.replace(tzinfo=timezone.utc)
+        _PRESENCE.touch(row["device_id"], row["identity"], last_seen.timestamp())
+    return len(rows)
+
+
+def get_online_presence():
+    """
+    Online device/user counts and per-identity list from the in-process registry.
+    Runs inside a request (app context); hits the DB only on cold start and every
+    PRESENCE_RECONCILE_SECONDS.
+    """
+    global _presence_reconciled_at
+    with _PRESENCE_LOCK:
+        now = time.monotonic()
+        if _presence_reconciled_at is None or now - _presence_reconciled_at >= _PRESENCE_RECONCILE_SECONDS:
+            try:
+                _reconcile_presence()
+                _presence_reconciled_at = now
+            except Exception as exc:
+                db.session.rollback()
+                print(f"[presence] reconcile skipped: {exc}")
+
+    online_devices, online_users = _PRESENCE.counts()
+    return {
+        "online_devices": online_devices,
+        "online_users": online_users,
+        "online_user_list": [
+            {
+                "user_id": identity,
+                "last_seen": datetime.fromtimestamp(last_seen, timezone.utc).isoformat(),
+                "device_count": device_count,
+            }
+            for identity, last_seen, device_count in _PRESENCE.identities()
+        ],
+    }
+
+
+def get_heartbeat_stats():
+    return {
+        "heartbeats": _HEARTBEAT_BUFFER.stats(),
+        "heatmap_cells": _HEATMAP_CELL_BUFFER.stats(),
+        "heatmap_device_state": _HEATMAP_DEVICE_STATE.stats(),
+        "presence": _PRESENCE.stats(),
+    }
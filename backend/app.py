@@ -1,4 +1,4 @@
-from flask import Flask, jsonify, send_from_directory, request, Response, session
+from flask import Flask, jsonify, send_file, send_from_directory, request, Response, session
 from flask_cors import CORS
 from db import db
 from sqlalchemy import inspect, text
@@ -8,13 +8,17 @@ import time
 import threading
 from datetime import datetime, timedelta, timezone
 from uuid import uuid4
-from urllib.error import HTTPError, URLError
-from urllib.request import Request, urlopen
 from routes.user import register_user_routes
 from routes.admin import register_admin_routes
 from translate import prewarm_translation_cache, cleanup_expired_translation_cache
-from tts import cleanup_expired_tts_cache
-from cache_warmup import prewarm_all_restaurants_content, resolve_target_languages
+from tts import cleanup_expired_tts_cache, resolve_local_tts_audio
+from heatmap_store import backfill_heatmap_pyramid
+from tile_cache import TileUpstreamError, get_tile
+from cache_warmup import (
+    prewarm_all_restaurants_content,
+    resolve_target_languages,
+    enqueue_restaurant_prewarm_jobs,
+)
 from auth import (
     admin_login,
     admin_check,
@@ -114,7 +118,7 @@ CORS(
     supports_credentials=True,
     methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"],
     allow_headers=["Content-Type", "Authorization"],
-    expose_headers=["Content-Type", "Authorization"]
+    expose_headers=["Content-Type", "Authorization", "X-Heatmap-Grid-Level"]
 )
 
 # Thêm middleware để handle OPTIONS requests
@@ -363,6 +367,9 @@ def _start_translation_prewarm_worker():
                 print(f"[prewarm] UI translations ready for {len(target_langs)} languages, {len(texts)} texts")
 
             if prewarm_restaurants:
+                # Hàng đợi bền vững: restart chỉ làm tiếp phần chưa xong, không warm lại ngôn ngữ đã xong.
+                if enqueue_restaurant_prewarm_jobs(target_langs=target_langs, reason="startup", flask_app=app):
+                    return
                 with app.app_context():
                     stats = prewarm_all_restaurants_content(
                         target_langs=target_langs,
@@ -615,6 +622,35 @@ def _ensure_user_activity_heatmap_schema():
             ON user_activity_heatmap_device_state(user_id)
             WHERE user_id IS NOT NULL
         """,
+        """
+        CREATE TABLE IF NOT EXISTS user_activity_heatmap_pyramid (
+            grid_level SMALLINT NOT NULL,
+            lat_bucket DOUBLE PRECISION NOT NULL,
+            lng_bucket DOUBLE PRECISION NOT NULL,
+            hit_count BIGINT NOT NULL DEFAULT 0,
+            last_seen timestamptz NOT NULL DEFAULT NOW(),
+            PRIMARY KEY (grid_level, lat_bucket, lng_bucket)
+        )
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_user_activity_heatmap_pyramid_hits
+            ON user_activity_heatmap_pyramid(grid_level, hit_count DESC)
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS user_activity_heatmap_bucket (
+            bucket_hours SMALLINT NOT NULL,
+            bucket_start timestamptz NOT NULL,
+            grid_level SMALLINT NOT NULL,
+            lat_bucket DOUBLE PRECISION NOT NULL,
+            lng_bucket DOUBLE PRECISION NOT NULL,
+            hit_count BIGINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (bucket_hours, bucket_start, grid_level, lat_bucket, lng_bucket)
+        )
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_user_activity_heatmap_bucket_window
+            ON user_activity_heatmap_bucket(grid_level, bucket_start DESC)
+        """,
     ]
 
     try:
@@ -624,6 +660,14 @@ def _ensure_user_activity_heatmap_schema():
     except Exception as exc:
         db.session.rollback()
         print(f"[user-activity-schema] Ensure heartbeat heatmap schema skipped: {exc}")
+        return
+
+    try:
+        backfilled = backfill_heatmap_pyramid()
+        if backfilled:
+            print(f"[user-activity-schema] Heatmap pyramid backfilled cells={backfilled}")
+    except Exception as exc:
+        print(f"[user-activity-schema] Heatmap pyramid backfill skipped: {exc}")
 
 
 def _cleanup_legacy_scoped_translation_cache_rows():
@@ -718,18 +762,6 @@ def _refresh_translation_cache_on_redeploy():
         return
 
     try:
-        db.session.execute(
-            text(
-                """
-                CREATE TABLE IF NOT EXISTS app_runtime_meta (
-                    meta_key TEXT PRIMARY KEY,
-                    meta_value TEXT NOT NULL,
-                    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
-                )
-                """
-            )
-        )
-
         row = db.session.execute(
             text(
                 "SELECT meta_value FROM app_runtime_meta WHERE meta_key = 'translation_cache_deploy_marker' LIMIT 1"
@@ -766,6 +798,63 @@ def _refresh_translation_cache_on_redeploy():
         print(f"[cache-refresh] Redeploy refresh skipped: {exc}")
 
 
+def _ensure_app_runtime_meta_table():
+    """Key/value markers shared by all processes (deploy marker, catalogue version)."""
+    try:
+        db.session.execute(
+            text(
+                """
+                CREATE TABLE IF NOT EXISTS app_runtime_meta (
+                    meta_key TEXT PRIMARY KEY,
+                    meta_value TEXT NOT NULL,
+                    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+                )
+                """
+            )
+        )
+        db.session.commit()
+    except Exception as exc:
+        db.session.rollback()
+        print(f"[startup] Ensure app_runtime_meta table skipped: {exc}")
+
+
+def _ensure_prewarm_job_table():
+    """Durable prewarm queue: one row per (restaurant, language), survives restarts/redeploys."""
+    statements = [
+        """
+        CREATE TABLE IF NOT EXISTS prewarm_job (
+            id BIGSERIAL PRIMARY KEY,
+            restaurant_id INTEGER NOT NULL,
+            target_lang VARCHAR(16) NOT NULL,
+            source_checksum VARCHAR(64) NOT NULL,
+            key_checksums TEXT NULL,
+            status VARCHAR(16) NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            checkpoint TEXT NULL,
+            last_error TEXT NULL,
+            reason TEXT NULL,
+            run_after TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            locked_at TIMESTAMPTZ NULL,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            UNIQUE (restaurant_id, target_lang)
+        )
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_prewarm_job_runnable
+            ON prewarm_job(status, run_after)
+        """,
+    ]
+
+    try:
+        for stmt in statements:
+            db.session.execute(text(stmt))
+        db.session.commit()
+    except Exception as exc:
+        db.session.rollback()
+        print(f"[prewarm-jobs] Ensure prewarm job table skipped: {exc}")
+
+
 def _run_startup_db_bootstrap():
     """
     Run DB bootstrap tasks with best-effort semantics.
@@ -776,7 +865,9 @@ def _run_startup_db_bootstrap():
             _ensure_cache_tables()
             _ensure_translation_cache_catalog_columns()
             _ensure_user_activity_heatmap_schema()
+            _ensure_app_runtime_meta_table()
             _refresh_translation_cache_on_redeploy()
+            _ensure_prewarm_job_table()
             _cleanup_legacy_scoped_translation_cache_rows()
             _ensure_local_schema_compatibility()
     except Exception as exc:
@@ -851,6 +942,18 @@ def qr_access_check():
     return jsonify({"status": "error", "message": "QR access required"}), 401
 
 
+@app.route("/static/tts/<filename>", methods=["GET"])
+def serve_tts_audio(filename):
+    # Tên file là hash nội dung nên có thể cache lâu; send_file xử lý Range/If-None-Match.
+    path = resolve_local_tts_audio(filename)
+    if not path:
+        return jsonify({"error": "Audio not found"}), 404
+    try:
+        return send_file(path, mimetype="audio/mpeg", conditional=True, max_age=86400)
+    except FileNotFoundError:
+        return jsonify({"error": "Audio not found"}), 404
+
+
 @app.route("/map-tiles/<provider>/<int:z>/<int:x>/<int:y>.png", methods=["GET"])
 @app.route("/api/map-tiles/<provider>/<int:z>/<int:x>/<int:y>.png", methods=["GET"])
 def proxy_map_tiles(provider, z, x, y):
@@ -862,28 +965,17 @@ def proxy_map_tiles(provider, z, x, y):
         return jsonify({"error": "Invalid tile coordinates"}), 400
 
     upstream_url = provider_template.format(z=z, x=x, y=y)
-    upstream_request = Request(
-        upstream_url,
-        headers={
-            "User-Agent": "NearBiteMapProxy/1.0",
-            "Accept": "image/avif,image/webp,image/apng,image/*,*/*;q=0.8",
-        },
-    )
-
     try:
-        with urlopen(upstream_request, timeout=8) as upstream_response:
-            body = upstream_response.read()
-            content_type = upstream_response.headers.get("Content-Type", "image/png")
-            response = Response(body, status=200, content_type=content_type)
-            response.headers["Cache-Control"] = "public, max-age=86400, stale-while-revalidate=604800"
-            response.headers["Cross-Origin-Resource-Policy"] = "cross-origin"
-            return response
-    except HTTPError as exc:
-        return Response(status=int(exc.code or 502))
-    except (URLError, TimeoutError):
-        return Response(status=504)
-    except Exception:
-        return Response(status=502)
+        body, content_type, cache_state = get_tile(provider, z, x, y, upstream_url)
+    except TileUpstreamError as exc:
+        return Response(status=exc.status)
+
+    response = Response(body, status=200, content_type=content_type)
+    response.headers["Cache-Control"] = "public, max-age=86400, stale-while-revalidate=604800"
+    response.headers["Cross-Origin-Resource-Policy"] = "cross-origin"
+    response.headers["X-Tile-Cache"] = cache_state
+    response.add_etag()
+    return response.make_conditional(request)
 
 
 @app.route("/")
@@ -1,19 +1,148 @@
+import hashlib
+import json
 import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
 from threading import Lock
-from concurrent.futures import ThreadPoolExecutor
-
-from models import Restaurant
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from catalog import load_restaurant_payloads
+from prewarm_job_store import (
+    enqueue_prewarm_jobs,
+    claim_prewarm_jobs,
+    save_prewarm_checkpoint,
+    complete_prewarm_job,
+    fail_prewarm_job,
+    delete_prewarm_jobs,
+    load_done_key_checksums,
+    prewarm_job_counts,
+    prewarm_jobs_all_done,
+)
+from rate_limit import TokenBucket, thread_rate_limits
 from services import calculate_distance, generate_narration
-from translate import LANGUAGE_LABELS, translate_texts, translate_text, invalidate_translation_cache
+from translate import (
+    LANGUAGE_LABELS,
+    translate_texts,
+    translate_text,
+    invalidate_translation_cache,
+    invalidate_translation_keys,
+    source_checksum,
+)
 from tts import text_to_speech, invalidate_tts_cache
 
 _PREWARM_RESTAURANT_WORKERS = int((os.getenv("PREWARM_RESTAURANT_WORKERS") or "2").strip() or "2")
 _PREWARM_RESTAURANT_WORKERS = max(1, min(6, _PREWARM_RESTAURANT_WORKERS))
+# Pipeline prewarm: stage dịch và stage TTS chạy song song trên 2 pool riêng.
+_PREWARM_TRANSLATE_WORKERS = int((os.getenv("PREWARM_TRANSLATE_WORKERS") or "4").strip() or "4")
+_PREWARM_TRANSLATE_WORKERS = max(1, min(16, _PREWARM_TRANSLATE_WORKERS))
+_PREWARM_TTS_WORKERS = int((os.getenv("PREWARM_TTS_WORKERS") or "3").strip() or "3")
+_PREWARM_TTS_WORKERS = max(1, min(16, _PREWARM_TTS_WORKERS))
+# Giới hạn lời gọi provider (Google Translate, gTTS) mỗi giây trong prewarm, không áp cho request user.
+_PREWARM_TRANSLATE_RPS = float((os.getenv("PREWARM_TRANSLATE_RPS") or "5").strip() or "5")
+_PREWARM_TRANSLATE_RPS = max(0.2, min(50.0, _PREWARM_TRANSLATE_RPS))
+_PREWARM_TTS_RPS = float((os.getenv("PREWARM_TTS_RPS") or "2").strip() or "2")
+_PREWARM_TTS_RPS = max(0.2, min(20.0, _PREWARM_TTS_RPS))
+
+# Hàng đợi prewarm bền vững (bảng prewarm_job); nếu DB không hỗ trợ thì quay về executor trong bộ nhớ.
+_PREWARM_DURABLE_JOBS = (os.getenv("PREWARM_DURABLE_JOBS") or "true").strip().lower() in {"1", "true", "yes", "on"}
+_PREWARM_JOB_BATCH = int((os.getenv("PREWARM_JOB_BATCH") or "8").strip() or "8")
+_PREWARM_JOB_BATCH = max(1, min(64, _PREWARM_JOB_BATCH))
+_PREWARM_JOB_POLL_SECONDS = int((os.getenv("PREWARM_JOB_POLL_SECONDS") or "30").strip() or "30")
+_PREWARM_JOB_POLL_SECONDS = max(2, min(600, _PREWARM_JOB_POLL_SECONDS))
+_PREWARM_JOB_LEASE_SECONDS = int((os.getenv("PREWARM_JOB_LEASE_SECONDS") or "600").strip() or "600")
+_PREWARM_JOB_LEASE_SECONDS = max(60, min(7200, _PREWARM_JOB_LEASE_SECONDS))
+_PREWARM_JOB_MAX_ATTEMPTS = int((os.getenv("PREWARM_JOB_MAX_ATTEMPTS") or "5").strip() or "5")
+_PREWARM_JOB_MAX_ATTEMPTS = max(1, min(20, _PREWARM_JOB_MAX_ATTEMPTS))
+_PREWARM_JOB_RETRY_SECONDS = 30
 
 _REWARM_EXECUTOR = ThreadPoolExecutor(max_workers=_PREWARM_RESTAURANT_WORKERS)
+_TRANSLATE_STAGE_EXECUTOR = ThreadPoolExecutor(max_workers=_PREWARM_TRANSLATE_WORKERS, thread_name_prefix="prewarm-translate")
+_TTS_STAGE_EXECUTOR = ThreadPoolExecutor(max_workers=_PREWARM_TTS_WORKERS, thread_name_prefix="prewarm-tts")
+_TRANSLATE_PROVIDER_BUCKET = TokenBucket(_PREWARM_TRANSLATE_RPS, capacity=max(1, int(_PREWARM_TRANSLATE_RPS)))
+_TTS_PROVIDER_BUCKET = TokenBucket(_PREWARM_TTS_RPS, capacity=max(1, int(_PREWARM_TTS_RPS)))
 _PENDING_RESTAURANT_IDS = set()
 _PENDING_LOCK = Lock()
 
+# restaurant_id -> {logical_key: source checksum} của lần warm gần nhất, để rewarm chỉ làm phần đã đổi.
+_CONTENT_MANIFESTS = {}
+_MANIFEST_LOCK = Lock()
+
+_JOB_WORKER_WAKE = threading.Event()
+_JOB_WORKER_LOCK = Lock()
+_JOB_WORKER_STARTED = False
+
+_PROGRESS_RUNS = OrderedDict()
+_PROGRESS_LOCK = Lock()
+_PROGRESS_MAX_RUNS = 20
+
+
+class PrewarmProgress:
+    """Counters for one prewarm run; every (restaurant, language) pair is one translate and one TTS unit."""
+
+    def __init__(self, kind, restaurants_total, languages):
+        self.run_id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.restaurants_total = restaurants_total
+        self.languages = list(languages)
+        self.pairs_total = restaurants_total * len(self.languages)
+        self.translate_done = 0
+        self.tts_done = 0
+        self.failures = 0
+        self.started_at = time.time()
+        self.finished_at = None
+        self._lock = Lock()
+
+    def mark(self, stage, ok=True):
+        with self._lock:
+            if stage == "translate":
+                self.translate_done += 1
+            else:
+                self.tts_done += 1
+            if not ok:
+                self.failures += 1
+
+    def finish(self):
+        self.finished_at = time.time()
+
+    def to_dict(self):
+        with self._lock:
+            units_total = self.pairs_total * 2
+            units_done = self.translate_done + self.tts_done
+            elapsed = (self.finished_at or time.time()) - self.started_at
+            eta_seconds = None
+            if self.finished_at is None and units_done and units_total:
+                eta_seconds = round(elapsed / units_done * (units_total - units_done), 1)
+            return {
+                "run_id": self.run_id,
+                "kind": self.kind,
+                "status": "done" if self.finished_at else "running",
+                "restaurants_total": self.restaurants_total,
+                "languages": self.languages,
+                "pairs_total": self.pairs_total,
+                "translate_done": self.translate_done,
+                "tts_done": self.tts_done,
+                "failures": self.failures,
+                "percent": round(units_done * 100.0 / units_total, 1) if units_total else 100.0,
+                "elapsed_seconds": round(elapsed, 1),
+                "eta_seconds": eta_seconds,
+            }
+
+
+def _register_progress(progress):
+    with _PROGRESS_LOCK:
+        _PROGRESS_RUNS[progress.run_id] = progress
+        while len(_PROGRESS_RUNS) > _PROGRESS_MAX_RUNS:
+            _PROGRESS_RUNS.popitem(last=False)
+
+
+def get_prewarm_progress():
+    """Recent prewarm runs (newest first) with progress and ETA."""
+    with _PROGRESS_LOCK:
+        runs = list(_PROGRESS_RUNS.values())
+    return [run.to_dict() for run in reversed(runs)]
+
 
 def resolve_target_languages(raw_langs=None):
     if raw_langs:
@@ -35,8 +164,7 @@ def resolve_target_languages(raw_langs=None):
     return filtered
 
 
-def _collect_restaurant_translatable_texts(restaurant):
-    payload = restaurant.to_dict(include_details=True)
+def _collect_restaurant_translatable_texts(payload):
     entries = []
 
     def add_entry(value, logical_suffix):
@@ -47,7 +175,7 @@ def _collect_restaurant_translatable_texts(restaurant):
             return
         entries.append({
             "text": text,
-            "logical_key": f"restaurant:{restaurant.id}:{logical_suffix}",
+            "logical_key": f"restaurant:{payload['id']}:{logical_suffix}",
         })
 
     add_entry(payload.get("name"), "name")
@@ -69,121 +197,556 @@ def _collect_restaurant_translatable_texts(restaurant):
     return entries
 
 
-def _build_restaurant_narration_text(restaurant):
-    user_lat = restaurant.lat
-    user_lng = restaurant.lng
-    distance_km = calculate_distance(user_lat, user_lng, restaurant.lat, restaurant.lng)
-    return generate_narration(restaurant, distance_km)
+def _build_restaurant_narration_text(payload):
+    user_lat = payload["lat"]
+    user_lng = payload["lng"]
+    distance_km = calculate_distance(user_lat, user_lng, payload["lat"], payload["lng"])
+    return generate_narration(payload, distance_km)
+
 
+def _build_out_of_range_message(payload):
+    return f'🚶 Bạn hãy tới gần quán "{payload["name"]}" để nghe thuyết minh'
 
-def _build_out_of_range_message(restaurant):
-    return f'🚶 Bạn hãy tới gần quán "{restaurant.name}" để nghe thuyết minh'
 
+class _RestaurantWarmInput:
+    """Everything the pipeline needs for one restaurant, read from the DB up front (no app context in pools)."""
+
+    def __init__(self, payload):
+        self.restaurant_id = payload["id"]
+        self.text_entries = _collect_restaurant_translatable_texts(payload)
+        self.narration_vi = _build_restaurant_narration_text(payload)
+        self.out_of_range_message_vi = _build_out_of_range_message(payload)
+        self.narration_key = f"restaurant:{self.restaurant_id}:narration"
+        self.proximity_hint_key = f"restaurant:{self.restaurant_id}:proximity_hint"
+        # None = dịch mọi key; diff_against() thu hẹp về các key có source đổi.
+        self.changed_keys = None
+        self.narration_changed = True
+
+    def checksums(self):
+        checksums = {entry["logical_key"]: source_checksum(entry["text"]) for entry in self.text_entries}
+        checksums[self.narration_key] = source_checksum(self.narration_vi)
+        checksums[self.proximity_hint_key] = source_checksum(self.out_of_range_message_vi)
+        return checksums
+
+    def diff_against(self, previous):
+        """Keep only logical keys whose checksum differs from `previous` (None = unknown, all changed)."""
+        current = self.checksums()
+        if previous is None:
+            self.changed_keys = set(current)
+            self.narration_changed = True
+        else:
+            self.changed_keys = {key for key, checksum in current.items() if previous.get(key) != checksum}
+            self.narration_changed = self.narration_key in self.changed_keys
+        removed_keys = set(previous or {}) - set(current)
+        return current, removed_keys
+
+    def wants(self, logical_key):
+        return self.changed_keys is None or logical_key in self.changed_keys
+
+    @property
+    def has_changes(self):
+        return self.changed_keys is None or bool(self.changed_keys)
+
+
+def _get_content_manifest(restaurant_id):
+    with _MANIFEST_LOCK:
+        manifest = _CONTENT_MANIFESTS.get(restaurant_id)
+    if manifest is not None:
+        return dict(manifest)
+    if not _PREWARM_DURABLE_JOBS:
+        return None
+    # Sau restart: lấy checksum của lần warm xong gần nhất trong bảng prewarm_job.
+    try:
+        manifest = load_done_key_checksums(restaurant_id)
+    except Exception:
+        return None
+    if manifest is not None:
+        _store_content_manifest(restaurant_id, manifest)
+    return manifest
+
+
+def _content_checksum(checksums):
+    """One checksum for a restaurant's whole translatable content (prewarm_job.source_checksum)."""
+    return hashlib.sha256(json.dumps(checksums, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def _store_content_manifest(restaurant_id, checksums):
+    with _MANIFEST_LOCK:
+        if checksums is None:
+            _CONTENT_MANIFESTS.pop(restaurant_id, None)
+        else:
+            _CONTENT_MANIFESTS[restaurant_id] = dict(checksums)
+
+
+def invalidate_changed_restaurant_content(restaurant_id):
+    """
+    Drop cached translations only for the logical keys of a restaurant whose source text
+    changed since the last warm, so readers never see a stale translation before the
+    rewarm runs. Hidden/deleted restaurants lose their whole translation/TTS cache.
+    Call inside an app context.
+    """
+    payloads = _load_restaurant_payloads([restaurant_id])
+    if not payloads:
+        _store_content_manifest(restaurant_id, None)
+        invalidate_translation_cache(cache_scope_id=restaurant_id)
+        invalidate_tts_cache(restaurant_id=restaurant_id)
+        return {"restaurant_id": restaurant_id, "status": "removed"}
+
+    warm_input = _RestaurantWarmInput(payloads[0])
+    previous = _get_content_manifest(restaurant_id)
+    _, removed_keys = warm_input.diff_against(previous)
+    invalidate_translation_keys(warm_input.changed_keys | removed_keys)
+    if previous is not None and warm_input.narration_changed:
+        # Audio cũ thuộc về narration cũ: xoá để không giữ file mồ côi.
+        invalidate_tts_cache(restaurant_id=restaurant_id)
+    return {
+        "restaurant_id": restaurant_id,
+        "status": "ok",
+        "changed_keys": len(warm_input.changed_keys),
+        "narration_changed": warm_input.narration_changed,
+    }
+
+
+def _translate_narration(warm_input, lang, force_refresh=False):
+    return translate_text(
+        warm_input.narration_vi,
+        lang,
+        cache_scope_id=warm_input.restaurant_id,
+        cache_note="restaurant_narration",
+        cache_logical_key=warm_input.narration_key,
+        force_refresh=force_refresh,
+    )
+
+
+def _translate_stage(warm_input, lang, force_refresh):
+    restaurant_id = warm_input.restaurant_id
+    with thread_rate_limits(translate=_TRANSLATE_PROVIDER_BUCKET):
+        entries = [entry for entry in warm_input.text_entries if warm_input.wants(entry["logical_key"])]
+        if entries:
+            translate_texts(
+                [entry["text"] for entry in entries],
+                lang,
+                cache_scope_id=restaurant_id,
+                cache_note="restaurant_content",
+                cache_logical_keys=[entry["logical_key"] for entry in entries],
+                force_refresh=force_refresh,
+            )
+
+        translated_narration = None
+        if warm_input.narration_changed:
+            translated_narration = _translate_narration(warm_input, lang, force_refresh)
+        if warm_input.wants(warm_input.proximity_hint_key):
+            translate_text(
+                warm_input.out_of_range_message_vi,
+                lang,
+                cache_scope_id=restaurant_id,
+                cache_note="restaurant_proximity_hint",
+                cache_logical_key=warm_input.proximity_hint_key,
+                force_refresh=force_refresh,
+            )
+    return translated_narration
 
-def prewarm_restaurant_content(restaurant_id, target_langs=None, clear_existing=False):
-    restaurant = Restaurant.query.get(restaurant_id)
-    if not restaurant or not restaurant.is_active:
+
+def _tts_stage(warm_input, lang, translated_narration):
+    with thread_rate_limits(tts=_TTS_PROVIDER_BUCKET):
+        audio_url = text_to_speech(translated_narration, lang, restaurant_id=warm_input.restaurant_id)
+
+        # Keep a best-effort fallback voice to avoid missing audio button in popup.
+        if not audio_url and lang != "en":
+            audio_url = text_to_speech(translated_narration, "en", restaurant_id=warm_input.restaurant_id)
+    return audio_url
+
+
+def _run_prewarm_pipeline(warm_inputs, langs, progress, force_refresh=False):
+    """
+    Fan out (restaurant, language) pairs: translation on one pool, and as soon as a
+    pair is translated its narration audio goes to the TTS pool, so both stages overlap.
+    """
+    tts_futures = []
+    tts_futures_lock = Lock()
+
+    def _translate_then_schedule_tts(warm_input, lang):
+        try:
+            translated_narration = _translate_stage(warm_input, lang, force_refresh)
+        except Exception as exc:
+            progress.mark("translate", ok=False)
+            progress.mark("tts", ok=False)
+            print(f"[prewarm] translate failed restaurant={warm_input.restaurant_id} lang={lang} error={exc}")
+            return
+        progress.mark("translate")
+        if translated_narration is None:
+            # Narration không đổi: audio cũ vẫn đúng, bỏ qua TTS.
+            progress.mark("tts")
+            return
+
+        def _tts_job():
+            try:
+                _tts_stage(warm_input, lang, translated_narration)
+                progress.mark("tts")
+            except Exception as exc:
+                progress.mark("tts", ok=False)
+                print(f"[prewarm] tts failed restaurant={warm_input.restaurant_id} lang={lang} error={exc}")
+
+        future = _TTS_STAGE_EXECUTOR.submit(_tts_job)
+        with tts_futures_lock:
+            tts_futures.append(future)
+
+    translate_futures = [
+        _TRANSLATE_STAGE_EXECUTOR.submit(_translate_then_schedule_tts, warm_input, lang)
+        for warm_input in warm_inputs
+        for lang in langs
+    ]
+    # Mọi TTS job được submit bên trong translate job, nên chờ xong stage dịch rồi mới chờ TTS.
+    wait(translate_futures)
+    with tts_futures_lock:
+        pending_tts = list(tts_futures)
+    wait(pending_tts)
+    progress.finish()
+
+
+def _load_restaurant_payloads(restaurant_ids=None, only_active=True):
+    payloads = load_restaurant_payloads(restaurant_ids, only_active=only_active)
+    return [payloads[restaurant_id] for restaurant_id in sorted(payloads)]
+
+
+def prewarm_restaurant_content(restaurant_id, target_langs=None, clear_existing=False, incremental=False):
+    """
+    Warm translations and narration audio of one restaurant.
+
+    With incremental=True only logical keys whose source checksum changed since the
+    last warm are translated, and TTS runs only if the narration text changed.
+    """
+    payloads = _load_restaurant_payloads([restaurant_id])
+    if not payloads:
+        _store_content_manifest(restaurant_id, None)
         return {
             "restaurant_id": restaurant_id,
             "status": "skipped",
             "reason": "restaurant-not-active"
         }
+    payload = payloads[0]
+    warm_input = _RestaurantWarmInput(payload)
+    checksums = warm_input.checksums()
 
     if clear_existing:
         try:
-            invalidate_translation_cache(cache_scope_id=restaurant.id)
+            invalidate_translation_cache(cache_scope_id=payload["id"])
+        except Exception:
+            pass
+        try:
+            invalidate_tts_cache(restaurant_id=payload["id"])
         except Exception:
             pass
+    elif incremental:
+        previous = _get_content_manifest(payload["id"])
+        checksums, removed_keys = warm_input.diff_against(previous)
         try:
-            invalidate_tts_cache(restaurant_id=restaurant.id)
+            invalidate_translation_keys(warm_input.changed_keys | removed_keys)
         except Exception:
             pass
+        if not warm_input.has_changes:
+            return {
+                "restaurant_id": payload["id"],
+                "status": "unchanged",
+            }
 
     langs = resolve_target_languages(target_langs)
     if not langs:
         return {
-            "restaurant_id": restaurant.id,
+            "restaurant_id": payload["id"],
             "status": "skipped",
             "reason": "no-target-languages"
         }
 
-    text_entries = _collect_restaurant_translatable_texts(restaurant)
-    narration_vi = _build_restaurant_narration_text(restaurant)
-    out_of_range_message_vi = _build_out_of_range_message(restaurant)
-
-    for lang in langs:
-        if text_entries:
-            translate_texts(
-                [entry["text"] for entry in text_entries],
-                lang,
-                cache_scope_id=restaurant.id,
-                cache_note="restaurant_content",
-                cache_logical_keys=[entry["logical_key"] for entry in text_entries],
-                force_refresh=bool(clear_existing),
-            )
-
-        translated_narration = translate_text(
-            narration_vi,
-            lang,
-            cache_scope_id=restaurant.id,
-            cache_note="restaurant_narration",
-            cache_logical_key=f"restaurant:{restaurant.id}:narration",
-            force_refresh=bool(clear_existing),
-        )
-        translate_text(
-            out_of_range_message_vi,
-            lang,
-            cache_scope_id=restaurant.id,
-            cache_note="restaurant_proximity_hint",
-            cache_logical_key=f"restaurant:{restaurant.id}:proximity_hint",
-            force_refresh=bool(clear_existing),
-        )
-        audio_url = text_to_speech(translated_narration, lang, restaurant_id=restaurant.id)
-
-        # Keep a best-effort fallback voice to avoid missing audio button in popup.
-        if not audio_url and lang != "en":
-            audio_url = text_to_speech(translated_narration, "en", restaurant_id=restaurant.id)
+    progress = PrewarmProgress(f"restaurant:{payload['id']}", 1, langs)
+    _register_progress(progress)
+    _run_prewarm_pipeline([warm_input], langs, progress, force_refresh=bool(clear_existing))
+    if not progress.failures:
+        _store_content_manifest(payload["id"], checksums)
 
     return {
-        "restaurant_id": restaurant.id,
+        "restaurant_id": payload["id"],
         "status": "ok",
-        "languages": len(langs)
+        "languages": len(langs),
+        "changed_keys": len(warm_input.changed_keys) if warm_input.changed_keys is not None else None,
+        "narration_changed": warm_input.narration_changed,
+        "failures": progress.failures,
     }
 
 
 def prewarm_all_restaurants_content(target_langs=None, clear_existing=False, only_active=True):
-    query = Restaurant.query
-    if only_active:
-        query = query.filter_by(is_active=True)
-
-    restaurants = query.all()
-    warmed = 0
-    skipped = 0
-
-    for restaurant in restaurants:
-        result = prewarm_restaurant_content(
-            restaurant.id,
-            target_langs=target_langs,
-            clear_existing=clear_existing,
-        )
-        if result.get("status") == "ok":
-            warmed += 1
-        else:
-            skipped += 1
+    payloads = _load_restaurant_payloads(only_active=only_active)
+    langs = resolve_target_languages(target_langs)
+    if not payloads or not langs:
+        return {
+            "restaurants_total": len(payloads),
+            "restaurants_warmed": 0,
+            "restaurants_skipped": len(payloads),
+        }
+
+    if clear_existing:
+        for payload in payloads:
+            try:
+                invalidate_translation_cache(cache_scope_id=payload["id"])
+            except Exception:
+                pass
+            try:
+                invalidate_tts_cache(restaurant_id=payload["id"])
+            except Exception:
+                pass
+
+    progress = PrewarmProgress("all", len(payloads), langs)
+    _register_progress(progress)
+    print(f"[prewarm] pipeline run={progress.run_id} restaurants={len(payloads)} languages={len(langs)}")
+    warm_inputs = [_RestaurantWarmInput(payload) for payload in payloads]
+    _run_prewarm_pipeline(warm_inputs, langs, progress, force_refresh=bool(clear_existing))
+    if not progress.failures:
+        for warm_input in warm_inputs:
+            _store_content_manifest(warm_input.restaurant_id, warm_input.checksums())
 
     return {
-        "restaurants_total": len(restaurants),
-        "restaurants_warmed": warmed,
-        "restaurants_skipped": skipped,
+        "restaurants_total": len(payloads),
+        "restaurants_warmed": len(payloads),
+        "restaurants_skipped": 0,
+        "failures": progress.failures,
+        "elapsed_seconds": progress.to_dict()["elapsed_seconds"],
+    }
+
+
+def _with_app_context(flask_app, fn, *args, **kwargs):
+    with flask_app.app_context():
+        return fn(*args, **kwargs)
+
+
+def _record_job_result(flask_app, job, fn, *args):
+    try:
+        _with_app_context(flask_app, fn, job, *args)
+    except Exception as exc:
+        print(f"[prewarm-jobs] update failed job={job['id']} error={exc}")
+
+
+def _run_prewarm_job_batch(flask_app, jobs):
+    """
+    Run claimed (restaurant, language) jobs through the same translate -> TTS pools as
+    the in-memory pipeline. Each job checkpoints after translation, so a restart that
+    reclaims it only redoes TTS; completed jobs store their key checksums, which become
+    the next diff base once every language of the restaurant is done.
+    """
+    payloads = {
+        payload["id"]: payload
+        for payload in _with_app_context(
+            flask_app, _load_restaurant_payloads, {job["restaurant_id"] for job in jobs}
+        )
     }
+    progress = PrewarmProgress(
+        "jobs",
+        len({job["restaurant_id"] for job in jobs}),
+        sorted({job["target_lang"] for job in jobs}),
+    )
+    progress.pairs_total = len(jobs)
+    _register_progress(progress)
+
+    tts_futures = []
+    tts_futures_lock = Lock()
+
+    def _fail(job, exc):
+        print(f"[prewarm-jobs] job={job['id']} restaurant={job['restaurant_id']} lang={job['target_lang']} error={exc}")
+        _record_job_result(flask_app, job, fail_prewarm_job, exc, _PREWARM_JOB_MAX_ATTEMPTS, _PREWARM_JOB_RETRY_SECONDS)
+
+    def _complete(job, checksums):
+        _record_job_result(flask_app, job, complete_prewarm_job, checksums)
+        # Manifest là mốc diff cho mọi ngôn ngữ: chỉ ghi khi mọi job của quán đã done. Còn job
+        # pending/failed thì bỏ manifest trong bộ nhớ, lần diff sau đọc DB (cũng chỉ trả khi đã done hết).
+        try:
+            all_done = _with_app_context(flask_app, prewarm_jobs_all_done, job["restaurant_id"])
+        except Exception:
+            all_done = False
+        _store_content_manifest(job["restaurant_id"], checksums if all_done else None)
+
+    def _run_job(job):
+        payload = payloads.get(job["restaurant_id"])
+        if payload is None:
+            # Quán đã ẩn/xoá: bỏ job thay vì warm nội dung không còn hiển thị.
+            try:
+                _with_app_context(flask_app, delete_prewarm_jobs, job["restaurant_id"])
+            except Exception:
+                pass
+            progress.mark("translate")
+            progress.mark("tts")
+            return
+
+        lang = job["target_lang"]
+        warm_input = _RestaurantWarmInput(payload)
+        checksums, removed_keys = warm_input.diff_against(job["key_checksums"])
+        content_checksum = _content_checksum(checksums)
+        checkpoint = job["checkpoint"]
+        try:
+            if checkpoint.get("stage") == "translated" and checkpoint.get("source_checksum") == content_checksum:
+                # Job được claim lại sau restart: bản dịch đã nằm trong cache, chỉ còn TTS.
+                translated_narration = _translate_narration(warm_input, lang) if warm_input.narration_changed else None
+            else:
+                # Nội dung có thể đã đổi khi process cũ chết: bỏ bản dịch cũ của ngôn ngữ này.
+                invalidate_translation_keys(warm_input.changed_keys | removed_keys, target_lang=lang)
+                translated_narration = _translate_stage(warm_input, lang, False)
+                _record_job_result(
+                    flask_app,
+                    job,
+                    save_prewarm_checkpoint,
+                    {"stage": "translated", "source_checksum": content_checksum},
+                )
+        except Exception as exc:
+            progress.mark("translate", ok=False)
+            progress.mark("tts", ok=False)
+            _fail(job, exc)
+            return
+        progress.mark("translate")
+
+        if translated_narration is None:
+            _complete(job, checksums)
+            progress.mark("tts")
+            return
+
+        def _tts_job():
+            try:
+                _tts_stage(warm_input, lang, translated_narration)
+            except Exception as exc:
+                progress.mark("tts", ok=False)
+                _fail(job, exc)
+                return
+            _complete(job, checksums)
+            progress.mark("tts")
+
+        future = _TTS_STAGE_EXECUTOR.submit(_tts_job)
+        with tts_futures_lock:
+            tts_futures.append(future)
+
+    wait([_TRANSLATE_STAGE_EXECUTOR.submit(_run_job, job) for job in jobs])
+    with tts_futures_lock:
+        pending_tts = list(tts_futures)
+    wait(pending_tts)
+    progress.finish()
+
+
+def _prewarm_job_worker_loop(flask_app):
+    while True:
+        try:
+            jobs = _with_app_context(flask_app, claim_prewarm_jobs, _PREWARM_JOB_BATCH, _PREWARM_JOB_LEASE_SECONDS)
+        except Exception as exc:
+            print(f"[prewarm-jobs] claim failed: {exc}")
+            jobs = []
+
+        if not jobs:
+            _JOB_WORKER_WAKE.wait(timeout=_PREWARM_JOB_POLL_SECONDS)
+            _JOB_WORKER_WAKE.clear()
+            continue
+
+        try:
+            _run_prewarm_job_batch(flask_app, jobs)
+        except Exception as exc:
+            # Job chưa xong sẽ được claim lại khi hết lease.
+            print(f"[prewarm-jobs] batch failed jobs={len(jobs)} error={exc}")
+            time.sleep(_PREWARM_JOB_RETRY_SECONDS)
+
+
+def start_prewarm_job_worker(flask_app):
+    """Start the single durable-queue worker thread of this process (idempotent)."""
+    global _JOB_WORKER_STARTED
+
+    with _JOB_WORKER_LOCK:
+        if _JOB_WORKER_STARTED:
+            return
+        _JOB_WORKER_STARTED = True
+    threading.Thread(
+        target=_prewarm_job_worker_loop,
+        args=(flask_app,),
+        name="prewarm-job-worker",
+        daemon=True,
+    ).start()
+
+
+def enqueue_restaurant_prewarm_jobs(restaurant_ids=None, target_langs=None, reason=None, force=False, flask_app=None):
+    """
+    Record (restaurant, language) jobs in the durable queue and wake the worker.
+
+    restaurant_ids=None enqueues every active restaurant. Languages already warmed for
+    the current content checksum are left alone unless force=True. Returns False when
+    durable jobs are disabled or the table is unavailable, so callers can fall back to
+    the in-memory path.
+    """
+    if not _PREWARM_DURABLE_JOBS:
+        return False
+    if flask_app is None:
+        from flask import current_app
+        flask_app = current_app._get_current_object()
+
+    langs = resolve_target_languages(target_langs)
+    if not langs:
+        return True
+
+    def _enqueue():
+        payloads = _load_restaurant_payloads(restaurant_ids)
+        if restaurant_ids is not None:
+            for missing_id in set(restaurant_ids) - {payload["id"] for payload in payloads}:
+                delete_prewarm_jobs(missing_id)
+        for payload in payloads:
+            checksums = _RestaurantWarmInput(payload).checksums()
+            enqueue_prewarm_jobs(payload["id"], langs, _content_checksum(checksums), reason=reason, force=force)
+        return len(payloads)
+
+    try:
+        total = _with_app_context(flask_app, _enqueue)
+    except Exception as exc:
+        print(f"[prewarm-jobs] durable enqueue unavailable, using in-memory prewarm: {exc}")
+        return False
+
+    start_prewarm_job_worker(flask_app)
+    _JOB_WORKER_WAKE.set()
+    if restaurant_ids is None:
+        print(f"[prewarm-jobs] enqueued restaurants={total} languages={len(langs)} reason={reason}")
+    return True
 
 
-def schedule_restaurant_rewarm(restaurant_id, reason="crud", clear_existing=False, target_langs=None, flask_app=None):
+def get_prewarm_job_stats():
+    """Durable queue counts by status, or None when the table is unavailable."""
+    if not _PREWARM_DURABLE_JOBS:
+        return None
+    try:
+        return prewarm_job_counts()
+    except Exception:
+        return None
+
+
+def schedule_restaurant_rewarm(
+    restaurant_id,
+    reason="crud",
+    clear_existing=False,
+    target_langs=None,
+    flask_app=None,
+    incremental=True,
+):
     try:
         normalized_id = int(restaurant_id)
     except Exception:
         return False
 
+    if clear_existing:
+        try:
+            invalidate_translation_cache(cache_scope_id=normalized_id)
+        except Exception:
+            pass
+        try:
+            invalidate_tts_cache(restaurant_id=normalized_id)
+        except Exception:
+            pass
+    if enqueue_restaurant_prewarm_jobs(
+        [normalized_id],
+        target_langs=target_langs,
+        reason=reason,
+        force=clear_existing,
+        flask_app=flask_app,
+    ):
+        return True
+
     with _PENDING_LOCK:
         if normalized_id in _PENDING_RESTAURANT_IDS:
             return False
@@ -197,12 +760,14 @@ def schedule_restaurant_rewarm(restaurant_id, reason="crud", clear_existing=Fals
                         normalized_id,
                         target_langs=target_langs,
                         clear_existing=clear_existing,
+                        incremental=incremental,
                     )
             else:
                 result = prewarm_restaurant_content(
                     normalized_id,
                     target_langs=target_langs,
                     clear_existing=clear_existing,
+                    incremental=incremental,
                 )
             print(f"[cache-rewarm] restaurant={normalized_id} reason={reason} result={result}")
         except Exception as exc:
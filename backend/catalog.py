@@ -0,0 +1,311 @@
+import os
+import threading
+import time
+from types import MappingProxyType
+
+from sqlalchemy import text
+
+from spatial_index import SpatialGrid
+
+_SNAPSHOT = None
+_SNAPSHOT_STALE = False
+_SNAPSHOT_LOCK = threading.Lock()
+_BUILD_LOCK = threading.Lock()
+_VERSION = 0
+
+# Đổi catalogue ở process khác (worker gunicorn khác): admin CRUD tăng marker trong app_runtime_meta,
+# mỗi process đọc lại marker tối đa mỗi CATALOG_FRESHNESS_CHECK_SECONDS và build lại khi nó đổi.
+_CATALOG_MARKER_KEY = "catalog_version"
+_CATALOG_FRESHNESS_CHECK_SECONDS = float((os.getenv("CATALOG_FRESHNESS_CHECK_SECONDS") or "5").strip() or "5")
+_CATALOG_FRESHNESS_CHECK_SECONDS = max(1.0, min(300.0, _CATALOG_FRESHNESS_CHECK_SECONDS))
+_seen_marker = None
+_marker_checked_at = None
+
+# Bộ đếm analytics đổi theo từng lượt ghé/lượt nghe: không nằm trong snapshot (sẽ tăng version và làm
+# mất body /restaurants đã render sẵn mỗi lượt) mà ở map riêng, nạp lại từ DB mỗi TTL và ghép vào lúc render.
+_ANALYTICS_FIELDS = ("visit_count", "avg_visit_duration", "avg_audio_duration", "audio_play_count")
+_ANALYTICS_TTL_SECONDS = int((os.getenv("CATALOG_ANALYTICS_TTL_SECONDS") or "60").strip() or "60")
+_ANALYTICS_TTL_SECONDS = max(5, min(3600, _ANALYTICS_TTL_SECONDS))
+_EMPTY_ANALYTICS = MappingProxyType({field: 0 for field in _ANALYTICS_FIELDS})
+_ANALYTICS = None
+_ANALYTICS_LOCK = threading.Lock()
+_ANALYTICS_BUILD_LOCK = threading.Lock()
+
+
+class CatalogSnapshot:
+    """
+    Immutable in-memory view of active restaurants (with menu, tags, images) and tags.
+
+    Public routes read payload dicts from here instead of querying Restaurant and its
+    lazy relationships per request. Payload dicts are shared between requests:
+    copy before mutating (see _translate_restaurant_data).
+    """
+
+    __slots__ = (
+        "version",
+        "built_at",
+        "restaurants",
+        "by_id",
+        "tags",
+        "avg_menu_price_by_id",
+        "spatial_index",
+    )
+
+    def __init__(self, version, restaurants_by_id, tags, spatial_index=None):
+        self.version = version
+        self.built_at = time.time()
+        self.restaurants = tuple(restaurants_by_id[rid] for rid in sorted(restaurants_by_id))
+        self.by_id = MappingProxyType(dict(restaurants_by_id))
+        self.tags = tuple(tags)
+        self.avg_menu_price_by_id = MappingProxyType({
+            payload["id"]: sum(item["price"] for item in payload["menu"]) / len(payload["menu"])
+            for payload in self.restaurants
+            if payload.get("menu")
+        })
+        if spatial_index is None:
+            spatial_index = SpatialGrid(
+                (payload["id"], payload["lat"], payload["lng"]) for payload in self.restaurants
+            )
+        self.spatial_index = spatial_index
+
+    def get(self, restaurant_id):
+        try:
+            return self.by_id.get(int(restaurant_id))
+        except (TypeError, ValueError):
+            return None
+
+
+def _next_version():
+    global _VERSION
+    _VERSION += 1
+    return _VERSION
+
+
+def load_restaurant_payloads(restaurant_ids=None, only_active=True):
+    """
+    {restaurant_id: to_dict(include_details=True)} for the given (default: all) restaurants,
+    without the analytics counters (see get_restaurant_analytics).
+    """
+    from sqlalchemy.orm import selectinload
+    from models import Restaurant
+
+    # selectinload: 1 query cho mỗi relationship thay vì N+1 lazy load trong to_dict().
+    query = Restaurant.query.options(
+        selectinload(Restaurant.menu_items),
+        selectinload(Restaurant.tags),
+        selectinload(Restaurant.images),
+    )
+    if only_active:
+        query = query.filter(Restaurant.is_active == True)
+    if restaurant_ids is not None:
+        query = query.filter(Restaurant.id.in_(list(restaurant_ids)))
+
+    payloads = {}
+    for restaurant in query.all():
+        payload = restaurant.to_dict(include_details=True)
+        for field in _ANALYTICS_FIELDS:
+            payload.pop(field, None)
+        payloads[restaurant.id] = payload
+    return payloads
+
+
+def _load_tag_payloads():
+    from models import Tag
+
+    return [tag.to_dict() for tag in Tag.query.order_by(Tag.id).all()]
+
+
+def _install(snapshot):
+    global _SNAPSHOT, _SNAPSHOT_STALE
+    with _SNAPSHOT_LOCK:
+        _SNAPSHOT = snapshot
+        _SNAPSHOT_STALE = False
+
+
+def _read_catalog_marker():
+    """Current cross-process catalogue marker, or None when it cannot be read."""
+    from db import db
+
+    try:
+        # Connection riêng: không đụng transaction của request đang chạy.
+        with db.engine.connect() as connection:
+            return connection.execute(
+                text("SELECT meta_value FROM app_runtime_meta WHERE meta_key = :key"),
+                {"key": _CATALOG_MARKER_KEY},
+            ).scalar()
+    except Exception:
+        return None
+
+
+def _publish_catalog_change():
+    """Bump the cross-process marker so other processes rebuild their snapshot."""
+    global _seen_marker
+    from db import db
+
+    try:
+        with db.engine.begin() as connection:
+            marker = connection.execute(
+                text(
+                    """
+                    INSERT INTO app_runtime_meta (meta_key, meta_value, updated_at)
+                    VALUES (:key, '1', NOW())
+                    ON CONFLICT (meta_key)
+                    DO UPDATE SET meta_value = (CAST(app_runtime_meta.meta_value AS bigint) + 1)::text,
+                                  updated_at = NOW()
+                    RETURNING meta_value
+                    """
+                ),
+                {"key": _CATALOG_MARKER_KEY},
+            ).scalar()
+    except Exception as exc:
+        print(f"[catalog] publish change skipped: {exc}")
+        return
+    with _SNAPSHOT_LOCK:
+        if _seen_marker is not None and str(int(_seen_marker) + 1) == marker:
+            # Chỉ có thay đổi của chính process này (đã refresh cục bộ): không cần build lại.
+            _seen_marker = marker
+
+
+def _check_cross_process_changes():
+    global _marker_checked_at, _SNAPSHOT_STALE
+    now = time.monotonic()
+    with _SNAPSHOT_LOCK:
+        if _SNAPSHOT is None or _SNAPSHOT_STALE:
+            return
+        if _marker_checked_at is not None and now - _marker_checked_at < _CATALOG_FRESHNESS_CHECK_SECONDS:
+            return
+        _marker_checked_at = now
+    marker = _read_catalog_marker()
+    with _SNAPSHOT_LOCK:
+        if marker is not None and marker != _seen_marker:
+            _SNAPSHOT_STALE = True
+
+
+def _rebuild_full():
+    global _seen_marker
+    # Đọc marker trước khi nạp: thay đổi xảy ra trong lúc nạp sẽ bị phát hiện ở lần kiểm tra sau.
+    marker = _read_catalog_marker()
+    snapshot = CatalogSnapshot(_next_version(), load_restaurant_payloads(), _load_tag_payloads())
+    _install(snapshot)
+    with _SNAPSHOT_LOCK:
+        _seen_marker = marker
+    print(
+        f"[catalog] full build version={snapshot.version} "
+        f"restaurants={len(snapshot.restaurants)} tags={len(snapshot.tags)}"
+    )
+    return snapshot
+
+
+def get_catalog_snapshot():
+    """
+    Return the current catalogue snapshot, building it on first use (needs app context).
+    Rebuilds when another process published a catalogue change.
+    """
+    _check_cross_process_changes()
+    with _SNAPSHOT_LOCK:
+        if _SNAPSHOT is not None and not _SNAPSHOT_STALE:
+            return _SNAPSHOT
+
+    with _BUILD_LOCK:
+        with _SNAPSHOT_LOCK:
+            if _SNAPSHOT is not None and not _SNAPSHOT_STALE:
+                return _SNAPSHOT
+        return _rebuild_full()
+
+
+def invalidate_catalog():
+    """Force a full rebuild on next read (fallback when incremental refresh fails)."""
+    global _SNAPSHOT_STALE
+    with _SNAPSHOT_LOCK:
+        _SNAPSHOT_STALE = True
+
+
+def refresh_catalog_restaurants(restaurant_ids, include_tags=False):
+    """
+    Reload only the given restaurants (and optionally the tag list) into a new snapshot.
+
+    Restaurants that were deleted or hidden drop out of the snapshot.
+    """
+    ids = {int(rid) for rid in (restaurant_ids or []) if rid is not None}
+    _publish_catalog_change()
+
+    with _BUILD_LOCK:
+        with _SNAPSHOT_LOCK:
+            current = _SNAPSHOT
+            stale = _SNAPSHOT_STALE
+        if current is None or stale:
+            # Chưa có snapshot thì để lần đọc kế tiếp build full.
+            return None
+
+        try:
+            reloaded = load_restaurant_payloads(ids) if ids else {}
+            tags = _load_tag_payloads() if include_tags else current.tags
+        except Exception as exc:
+            print(f"[catalog] incremental refresh failed ids={sorted(ids)} error={exc}")
+            invalidate_catalog()
+            return None
+
+        by_id = dict(current.by_id)
+        for rid in ids:
+            by_id.pop(rid, None)
+        by_id.update(reloaded)
+
+        snapshot = CatalogSnapshot(_next_version(), by_id, tags)
+        _install(snapshot)
+        print(
+            f"[catalog] refreshed version={snapshot.version} restaurant_ids={sorted(ids)} "
+            f"tags={'reloaded' if include_tags else 'kept'}"
+        )
+        return snapshot
+
+
+def _load_restaurant_analytics():
+    from models import Restaurant
+
+    rows = (
+        Restaurant.query.with_entities(Restaurant.id, *(getattr(Restaurant, field) for field in _ANALYTICS_FIELDS))
+        .filter(Restaurant.is_active == True)
+        .all()
+    )
+    return {
+        row[0]: MappingProxyType({field: value or 0 for field, value in zip(_ANALYTICS_FIELDS, row[1:])})
+        for row in rows
+    }
+
+
+def get_restaurant_analytics():
+    """
+    (version, {restaurant_id: counters}) reloaded from the DB at most every
+    CATALOG_ANALYTICS_TTL_SECONDS; the version changes only when some counter did.
+    While one thread reloads, others keep getting the previous map (needs app context).
+    """
+    global _ANALYTICS
+    with _ANALYTICS_LOCK:
+        current = _ANALYTICS
+    if current is not None and time.monotonic() - current[1] < _ANALYTICS_TTL_SECONDS:
+        return current[0], current[2]
+    if not _ANALYTICS_BUILD_LOCK.acquire(blocking=current is None):
+        return current[0], current[2]
+    try:
+        with _ANALYTICS_LOCK:
+            current = _ANALYTICS
+        if current is not None and time.monotonic() - current[1] < _ANALYTICS_TTL_SECONDS:
+            return current[0], current[2]
+        try:
+            counters = _load_restaurant_analytics()
+        except Exception as exc:
+            print(f"[catalog] analytics reload failed: {exc}")
+            if current is None:
+                raise
+            counters = current[2]
+        version = current[0] if current is not None and current[2] == counters else _next_version()
+        with _ANALYTICS_LOCK:
+            _ANALYTICS = (version, time.monotonic(), counters)
+        return version, counters
+    finally:
+        _ANALYTICS_BUILD_LOCK.release()
+
+
+def with_restaurant_analytics(payload, analytics):
+    """Copy of a snapshot payload with its analytics counters from get_restaurant_analytics()."""
+    return {**payload, **analytics.get(payload["id"], _EMPTY_ANALYTICS)}
@@ -0,0 +1,339 @@
+import atexit
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+from file_lock import locked_file
+
+_INDEX_FILE = "index.json"
+_LOCK_FILE = ".index.lock"
+_FORMAT = "disk-cache-v1"
+# File không có trong index chỉ bị coi là rác khi đủ cũ: worker khác có thể vừa ghi file
+# và chưa kịp lưu index của nó.
+_ORPHAN_MAX_AGE_SECONDS = 3600
+
+_REGISTRY = weakref.WeakValueDictionary()
+_REGISTRY_LOCK = threading.Lock()
+
+
+def _sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class DiskCache:
+    """
+    Files on local disk under a byte budget, evicted least-recently-used first.
+
+    An index file (written atomically) keeps key -> {file, size, sha256, last_access,
+    meta}. Each file is checked against its sha256 the first time it is read in a
+    process, so a torn or corrupted file is dropped instead of served. On load, index
+    entries without a file and old files without an index entry are removed.
+
+    Several processes (gunicorn workers) may share the directory: the index is read,
+    merged with this process's entries and rewritten under a file lock, so entries of
+    other workers are kept instead of overwritten.
+    """
+
+    def __init__(self, name, directory, max_bytes, suffix="", index_flush_interval=5.0):
+        self.name = name
+        self.directory = directory
+        self.max_bytes = max(1, int(max_bytes))
+        self.suffix = suffix
+        self.index_flush_interval = max(0.0, float(index_flush_interval))
+        self._lock = threading.RLock()
+        self._entries = None
+        self._verified = set()
+        self._bytes = 0
+        self._dirty = False
+        self._last_flush = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.corrupt = 0
+
+        with _REGISTRY_LOCK:
+            _REGISTRY[name] = self
+        atexit.register(self.flush)
+
+    @property
+    def _index_path(self):
+        return os.path.join(self.directory, _INDEX_FILE)
+
+    @property
+    def _lock_path(self):
+        return os.path.join(self.directory, _LOCK_FILE)
+
+    def _read_index(self):
+        try:
+            with open(self._index_path, "r", encoding="utf-8") as f:
+                raw = json.load(f)
+            if raw.get("format") == _FORMAT and isinstance(raw.get("entries"), dict):
+                return raw["entries"]
+        except (OSError, ValueError):
+            pass
+        return {}
+
+    def _file_matches(self, entry):
+        try:
+            return os.path.getsize(os.path.join(self.directory, entry.get("file") or "")) == entry.get("size")
+        except OSError:
+            return False
+
+    def _set_entries_locked(self, entries):
+        # OrderedDict theo last_access tăng dần: đầu là LRU, move_to_end khi truy cập.
+        self._entries = OrderedDict(sorted(entries.items(), key=lambda item: item[1].get("last_access", 0)))
+        self._bytes = sum(entry["size"] for entry in self._entries.values())
+
+    def _file_name(self, key):
+        return hashlib.sha256(str(key).encode("utf-8")).hexdigest()[:40] + self.suffix
+
+    def _ensure_loaded_locked(self):
+        if self._entries is not None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        with locked_file(self._lock_path):
+            entries = {key: entry for key, entry in self._read_index().items() if self._file_matches(entry)}
+            referenced = {entry["file"] for entry in entries.values()}
+
+            # File không có trong index (crash giữa ghi file và ghi index, temp file bỏ dở): xoá khi đủ cũ.
+            cutoff = time.time() - _ORPHAN_MAX_AGE_SECONDS
+            for file_name in os.listdir(self.directory):
+                if file_name in (_INDEX_FILE, _LOCK_FILE) or file_name in referenced:
+                    continue
+                path = os.path.join(self.directory, file_name)
+                try:
+                    if os.path.getmtime(path) < cutoff:
+                        os.remove(path)
+                except OSError:
+                    pass
+
+            self._set_entries_locked(entries)
+            self._dirty = True
+            self._evict_locked()
+            self._write_index_locked()
+
+    def _merge_disk_index_locked(self):
+        """Adopt entries other processes wrote since our last save (file lock held)."""
+        adopted = False
+        for key, disk_entry in self._read_index().items():
+            entry = self._entries.get(key)
+            if entry is not None:
+                if disk_entry.get("sha256") != entry.get("sha256") \
+                        and disk_entry.get("last_access", 0) > entry.get("last_access", 0) \
+                        and self._file_matches(disk_entry):
+                    # Process khác ghi lại key này sau mình: file trên đĩa là bản của nó.
+                    self._bytes += disk_entry["size"] - entry["size"]
+                    self._entries[key] = disk_entry
+                    self._verified.discard(key)
+                    adopted = True
+                continue
+            if self._file_matches(disk_entry):
+                self._entries[key] = disk_entry
+                self._bytes += disk_entry["size"]
+                adopted = True
+        if adopted:
+            self._set_entries_locked(self._entries)
+            self._evict_locked()
+
+    def _write_index_locked(self):
+        fd, temp_path = tempfile.mkstemp(prefix=".index-", dir=self.directory)
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump({"format": _FORMAT, "entries": self._entries}, f, ensure_ascii=False)
+            os.replace(temp_path, self._index_path)
+        except Exception:
+            try:
+                os.unlink(temp_path)
+            except OSError:
+                pass
+            return False
+        self._dirty = False
+        self._last_flush = time.monotonic()
+        return True
+
+    def _save_index_locked(self, force=False):
+        if not self._dirty:
+            return
+        if not force and time.monotonic() - self._last_flush < self.index_flush_interval:
+            return
+        try:
+            with locked_file(self._lock_path):
+                self._merge_disk_index_locked()
+                self._write_index_locked()
+        except OSError as exc:
+            print(f"[disk-cache] {self.name} index save failed: {exc}")
+
+    def _remove_locked(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        self._bytes -= entry["size"]
+        self._verified.discard(key)
+        try:
+            os.remove(os.path.join(self.directory, entry["file"]))
+        except OSError:
+            pass
+        self._dirty = True
+        return True
+
+    def _evict_locked(self):
+        while self._bytes > self.max_bytes and self._entries:
+            self._remove_locked(next(iter(self._entries)))
+            self.evictions += 1
+
+    def get_path(self, key):
+        """Path of the cached file (checksum-verified once per process), or None."""
+        with self._lock:
+            self._ensure_loaded_locked()
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            path = os.path.join(self.directory, entry["file"])
+            if key not in self._verified or not os.path.isfile(path):
+                # Chưa kiểm trong process này, hoặc process khác đã xoá/evict file.
+                try:
+                    valid = _sha256_file(path) == entry.get("sha256")
+                except OSError:
+                    valid = False
+                if not valid:
+                    self._remove_locked(key)
+                    self.corrupt += 1
+                    self.misses += 1
+                    self._save_index_locked()
+                    return None
+                self._verified.add(key)
+            entry["last_access"] = time.time()
+            self._entries.move_to_end(key)
+            self._dirty = True
+            self.hits += 1
+            self._save_index_locked()
+            return path
+
+    def get(self, key):
+        path = self.get_path(key)
+        if path is None:
+            return None
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def get_meta(self, key):
+        with self._lock:
+            self._ensure_loaded_locked()
+            entry = self._entries.get(key)
+            return dict(entry.get("meta") or {}) if entry else None
+
+    def update_meta(self, key, meta):
+        """Merge meta into an existing entry without rewriting its file; returns False if missing."""
+        with self._lock:
+            self._ensure_loaded_locked()
+            entry = self._entries.get(key)
+            if entry is None:
+                return False
+            entry["meta"] = {**(entry.get("meta") or {}), **meta}
+            self._dirty = True
+            self._save_index_locked()
+            return True
+
+    def __contains__(self, key):
+        with self._lock:
+            self._ensure_loaded_locked()
+            return key in self._entries
+
+    def put(self, key, data, meta=None):
+        """Store bytes under key (temp file + os.replace); returns the file path or None."""
+        if data is None or len(data) > self.max_bytes:
+            return None
+        with self._lock:
+            self._ensure_loaded_locked()
+            file_name = self._file_name(key)
+            path = os.path.join(self.directory, file_name)
+            fd, temp_path = tempfile.mkstemp(prefix=".put-", dir=self.directory)
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                os.replace(temp_path, path)
+            except Exception:
+                try:
+                    os.unlink(temp_path)
+                except OSError:
+                    pass
+                return None
+
+            previous = self._entries.get(key)
+            if previous is not None:
+                self._bytes -= previous["size"]
+            self._entries[key] = {
+                "file": file_name,
+                "size": len(data),
+                "sha256": hashlib.sha256(data).hexdigest(),
+                "last_access": time.time(),
+                "meta": meta or {},
+            }
+            self._entries.move_to_end(key)
+            self._bytes += len(data)
+            # Vừa ghi từ bytes đã biết checksum: không cần đọc lại để kiểm.
+            self._verified.add(key)
+            self._dirty = True
+            self._evict_locked()
+            self._save_index_locked()
+            return path if key in self._entries else None
+
+    def delete(self, key):
+        with self._lock:
+            self._ensure_loaded_locked()
+            removed = self._remove_locked(key)
+            self._save_index_locked(force=True)
+            return removed
+
+    def delete_where(self, predicate):
+        """Remove entries where predicate(key, meta) is true; returns the count removed."""
+        with self._lock:
+            self._ensure_loaded_locked()
+            keys = [key for key, entry in self._entries.items() if predicate(key, entry.get("meta") or {})]
+            for key in keys:
+                self._remove_locked(key)
+            self._save_index_locked(force=True)
+            return len(keys)
+
+    def clear(self):
+        return self.delete_where(lambda key, meta: True)
+
+    def flush(self):
+        with self._lock:
+            if self._entries is not None:
+                self._save_index_locked(force=True)
+
+    def stats(self):
+        with self._lock:
+            self._ensure_loaded_locked()
+            lookups = self.hits + self.misses
+            return {
+                "name": self.name,
+                "items": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+                "evictions": self.evictions,
+                "corrupt": self.corrupt,
+            }
+
+
+def all_disk_cache_stats():
+    with _REGISTRY_LOCK:
+        caches = list(_REGISTRY.values())
+    return {cache.name: cache.stats() for cache in caches}
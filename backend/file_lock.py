@@ -0,0 +1,22 @@
+import contextlib
+import os
+
+try:
+    import fcntl
+except ImportError:  # fcntl chỉ có trên POSIX: thiếu thì không khoá giữa các process (chạy dev 1 process).
+    fcntl = None
+
+
+@contextlib.contextmanager
+def locked_file(path):
+    """Exclusive advisory lock on `path` (created if missing), shared by every process on the host."""
+    if fcntl is None:
+        yield
+        return
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        # Đóng fd là nhả flock.
+        os.close(fd)
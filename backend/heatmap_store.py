@@ -0,0 +1,265 @@
+import math
+
+from sqlalchemy import text
+
+from db import db
+
+# Lưới gốc: round(lat/lng, 4) (~11 m), bảng user_activity_heatmap_cell.
+# Các mức thô hơn (1..3 chữ số thập phân, ~11 km / 1.1 km / 110 m) được cộng dồn sẵn vào
+# bảng pyramid cùng lúc với lưới gốc, để bản đồ thu nhỏ chỉ đọc vài trăm cell đã gộp.
+HEATMAP_CELL_TABLE = "user_activity_heatmap_cell"
+HEATMAP_PYRAMID_TABLE = "user_activity_heatmap_pyramid"
+HEATMAP_BASE_LEVEL = 4
+HEATMAP_PYRAMID_LEVELS = (1, 2, 3)
+
+# Bộ đếm theo thời gian cho mọi mức lưới: bucket 1 giờ cho dữ liệu gần, gộp dần thành bucket
+# 1 ngày (compact_heatmap_buckets) rồi bỏ hẳn, để truy vấn "1 giờ qua"/"hôm nay"/"7 ngày" chỉ
+# đọc số bucket tỉ lệ với cửa sổ chứ không quét dữ liệu thô.
+HEATMAP_BUCKET_TABLE = "user_activity_heatmap_bucket"
+HEATMAP_BUCKET_LEVELS = HEATMAP_PYRAMID_LEVELS + (HEATMAP_BASE_LEVEL,)
+
+# Kích thước cell mong muốn trên màn hình (pixel) khi chọn mức lưới theo zoom.
+_TARGET_CELL_PIXELS = 6
+
+
+def values_sql(rows, columns):
+    """`(:c_0, ...), (:c_1, ...)` plus params for a multi-row VALUES list."""
+    groups = []
+    params = {}
+    for index, row in enumerate(rows):
+        names = []
+        for column in columns:
+            name = f"{column}_{index}"
+            params[name] = row[column]
+            names.append(f":{name}")
+        groups.append(f"({', '.join(names)})")
+    return ", ".join(groups), params
+
+
+def _levels_sql(levels):
+    return ", ".join(f"({level})" for level in levels)
+
+
+def upsert_heatmap_cells(cells):
+    """
+    Add hit counts of base-grid cells ({lat_bucket, lng_bucket, hit_count, last_seen})
+    to the base table, every pyramid level and the hourly buckets, in one transaction.
+    """
+    values, params = values_sql(cells, ("lat_bucket", "lng_bucket", "hit_count", "last_seen"))
+    try:
+        db.session.execute(
+            text(
+                f"""
+                INSERT INTO {HEATMAP_CELL_TABLE} (lat_bucket, lng_bucket, hit_count, last_seen)
+                VALUES {values}
+                ON CONFLICT (lat_bucket, lng_bucket) DO UPDATE
+                SET hit_count = {HEATMAP_CELL_TABLE}.hit_count + EXCLUDED.hit_count,
+                    last_seen = GREATEST({HEATMAP_CELL_TABLE}.last_seen, EXCLUDED.last_seen)
+                """
+            ),
+            params,
+        )
+        db.session.execute(
+            text(
+                f"""
+                INSERT INTO {HEATMAP_PYRAMID_TABLE} (grid_level, lat_bucket, lng_bucket, hit_count, last_seen)
+                SELECT levels.grid_level,
+                       round(CAST(v.lat_bucket AS numeric), levels.grid_level)::double precision,
+                       round(CAST(v.lng_bucket AS numeric), levels.grid_level)::double precision,
+                       SUM(CAST(v.hit_count AS bigint)),
+                       MAX(CAST(v.last_seen AS timestamptz))
+                FROM (VALUES {values}) AS v(lat_bucket, lng_bucket, hit_count, last_seen)
+                CROSS JOIN (VALUES {_levels_sql(HEATMAP_PYRAMID_LEVELS)}) AS levels(grid_level)
+                GROUP BY 1, 2, 3
+                ON CONFLICT (grid_level, lat_bucket, lng_bucket) DO UPDATE
+                SET hit_count = {HEATMAP_PYRAMID_TABLE}.hit_count + EXCLUDED.hit_count,
+                    last_seen = GREATEST({HEATMAP_PYRAMID_TABLE}.last_seen, EXCLUDED.last_seen)
+                """
+            ),
+            params,
+        )
+        db.session.execute(
+            text(
+                f"""
+                INSERT INTO {HEATMAP_BUCKET_TABLE}
+                    (bucket_hours, bucket_start, grid_level, lat_bucket, lng_bucket, hit_count)
+                SELECT 1,
+                       date_trunc('hour', CAST(v.last_seen AS timestamptz)),
+                       levels.grid_level,
+                       round(CAST(v.lat_bucket AS numeric), levels.grid_level)::double precision,
+                       round(CAST(v.lng_bucket AS numeric), levels.grid_level)::double precision,
+                       SUM(CAST(v.hit_count AS bigint))
+                FROM (VALUES {values}) AS v(lat_bucket, lng_bucket, hit_count, last_seen)
+                CROSS JOIN (VALUES {_levels_sql(HEATMAP_BUCKET_LEVELS)}) AS levels(grid_level)
+                GROUP BY 2, 3, 4, 5
+                ON CONFLICT (bucket_hours, bucket_start, grid_level, lat_bucket, lng_bucket) DO UPDATE
+                SET hit_count = {HEATMAP_BUCKET_TABLE}.hit_count + EXCLUDED.hit_count
+                """
+            ),
+            params,
+        )
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+def compact_heatmap_buckets(hourly_retention_hours, daily_retention_days):
+    """
+    Fold hourly buckets older than hourly_retention_hours into daily buckets and drop
+    daily buckets older than daily_retention_days. Returns (hourly_folded, daily_dropped).
+    """
+    try:
+        folded = db.session.execute(
+            text(
+                f"""
+                WITH moved AS (
+                    DELETE FROM {HEATMAP_BUCKET_TABLE}
+                    WHERE bucket_hours = 1
+                      AND bucket_start < date_trunc('day', NOW() - (:hourly_hours * INTERVAL '1 hour'))
+                    RETURNING bucket_start, grid_level, lat_bucket, lng_bucket, hit_count
+                ), inserted AS (
+                    INSERT INTO {HEATMAP_BUCKET_TABLE}
+                        (bucket_hours, bucket_start, grid_level, lat_bucket, lng_bucket, hit_count)
+                    SELECT 24, date_trunc('day', bucket_start), grid_level, lat_bucket, lng_bucket, SUM(hit_count)
+                    FROM moved
+                    GROUP BY 2, 3, 4, 5
+                    ON CONFLICT (bucket_hours, bucket_start, grid_level, lat_bucket, lng_bucket) DO UPDATE
+                    SET hit_count = {HEATMAP_BUCKET_TABLE}.hit_count + EXCLUDED.hit_count
+                )
+                SELECT COUNT(*) AS total FROM moved
+                """
+            ),
+            {"hourly_hours": int(hourly_retention_hours)},
+        ).scalar()
+        dropped = db.session.execute(
+            text(
+                f"""
+                DELETE FROM {HEATMAP_BUCKET_TABLE}
+                WHERE bucket_hours = 24
+                  AND bucket_start < NOW() - (:daily_days * INTERVAL '1 day')
+                """
+            ),
+            {"daily_days": int(daily_retention_days)},
+        ).rowcount
+        db.session.commit()
+        return int(folded or 0), int(dropped or 0)
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+def backfill_heatmap_pyramid():
+    """Build the pyramid from the base table when it is empty (first deploy of the pyramid)."""
+    try:
+        result = db.session.execute(
+            text(
+                f"""
+                INSERT INTO {HEATMAP_PYRAMID_TABLE} (grid_level, lat_bucket, lng_bucket, hit_count, last_seen)
+                SELECT levels.grid_level,
+                       round(CAST(c.lat_bucket AS numeric), levels.grid_level)::double precision,
+                       round(CAST(c.lng_bucket AS numeric), levels.grid_level)::double precision,
+                       SUM(c.hit_count),
+                       MAX(c.last_seen)
+                FROM {HEATMAP_CELL_TABLE} AS c
+                CROSS JOIN (VALUES {_levels_sql(HEATMAP_PYRAMID_LEVELS)}) AS levels(grid_level)
+                WHERE NOT EXISTS (SELECT 1 FROM {HEATMAP_PYRAMID_TABLE})
+                GROUP BY 1, 2, 3
+                """
+            )
+        )
+        db.session.commit()
+        return int(result.rowcount or 0)
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+def level_for_zoom(zoom):
+    """Grid level (decimal digits) whose cells are about _TARGET_CELL_PIXELS wide at this web-map zoom."""
+    degrees_per_pixel = 360.0 / (256.0 * (2.0 ** float(zoom)))
+    level = round(-math.log10(_TARGET_CELL_PIXELS * degrees_per_pixel))
+    return max(HEATMAP_PYRAMID_LEVELS[0], min(HEATMAP_BASE_LEVEL, level))
+
+
+def _bbox_condition(level, bbox, params):
+    west, south, east, north = bbox
+    # Nới nửa cell để cell có tâm ngay ngoài mép nhưng vẫn phủ vào khung nhìn không bị mất.
+    pad = 0.5 * (10.0 ** -min(level, HEATMAP_BASE_LEVEL))
+    params.update({"west": west - pad, "south": south - pad, "east": east + pad, "north": north + pad})
+    return "lat_bucket BETWEEN :south AND :north AND lng_bucket BETWEEN :west AND :east"
+
+
+def query_heatmap_cells(level, limit, min_hits=1, bbox=None):
+    """
+    Hottest cells of one grid level (all-time counts), optionally inside bbox =
+    (west, south, east, north). Returns rows with lat, lng, intensity, last_seen.
+    """
+    table = HEATMAP_CELL_TABLE if level >= HEATMAP_BASE_LEVEL else HEATMAP_PYRAMID_TABLE
+    conditions = ["hit_count >= :min_hits"]
+    params = {"limit": int(limit), "min_hits": int(min_hits)}
+    if table == HEATMAP_PYRAMID_TABLE:
+        conditions.append("grid_level = :level")
+        params["level"] = int(level)
+    if bbox is not None:
+        conditions.append(_bbox_condition(level, bbox, params))
+
+    return db.session.execute(
+        text(
+            f"""
+            SELECT lat_bucket AS lat, lng_bucket AS lng,
+                   hit_count::double precision AS intensity, last_seen
+            FROM {table}
+            WHERE {' AND '.join(conditions)}
+            ORDER BY hit_count DESC, last_seen DESC
+            LIMIT :limit
+            """
+        ),
+        params,
+    ).mappings().all()
+
+
+def query_heatmap_window(level, window_hours, limit, min_hits=1, bbox=None, half_life_hours=None):
+    """
+    Hottest cells counted in the last window_hours, from the time buckets. With
+    half_life_hours each bucket is weighted by 0.5 ** (age / half_life) so recent
+    activity dominates. Buckets already folded into days count at day granularity.
+    """
+    conditions = [
+        "grid_level = :level",
+        "bucket_start + (bucket_hours * INTERVAL '1 hour') > NOW() - (:window_hours * INTERVAL '1 hour')",
+    ]
+    params = {
+        "level": int(min(level, HEATMAP_BASE_LEVEL)),
+        "window_hours": int(window_hours),
+        "limit": int(limit),
+        "min_hits": int(min_hits),
+    }
+    if bbox is not None:
+        conditions.append(_bbox_condition(level, bbox, params))
+
+    intensity = "SUM(hit_count)::double precision"
+    if half_life_hours:
+        # Tuổi tính từ giữa bucket: bucket 1 giờ đang chạy có trọng số gần 1.
+        intensity = (
+            "SUM(hit_count * power(0.5, GREATEST(0.0, EXTRACT(EPOCH FROM (NOW() - bucket_start)) / 3600.0"
+            " - bucket_hours / 2.0) / :half_life_hours))::double precision"
+        )
+        params["half_life_hours"] = float(half_life_hours)
+
+    return db.session.execute(
+        text(
+            f"""
+            SELECT lat_bucket AS lat, lng_bucket AS lng,
+                   {intensity} AS intensity,
+                   MAX(bucket_start) AS last_seen
+            FROM {HEATMAP_BUCKET_TABLE}
+            WHERE {' AND '.join(conditions)}
+            GROUP BY lat_bucket, lng_bucket
+            HAVING SUM(hit_count) >= :min_hits
+            ORDER BY 3 DESC
+            LIMIT :limit
+            """
+        ),
+        params,
+    ).mappings().all()
@@ -0,0 +1,221 @@
+import json
+import os
+import tempfile
+import threading
+
+from file_lock import locked_file
+
+_FORMAT = "journal-v1"
+
+
+def _fsync_directory(path):
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)) or ".", os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class AppendOnlyJournal:
+    """
+    Key/value store persisted as an append-only JSON-lines file.
+
+    Line 1 is a header {"format", "namespace"}; every later line is one record:
+      {"k": key, "v": value}        set
+      {"k": key, "d": 1}            delete (tombstone)
+      {"drop": [[rule, arg], ...]}  delete every key matching any rule
+                                    (rule "prefix", "suffix" or "contains"), or all keys if the list is empty
+
+    Writes never rewrite the file; maybe_compact() replays it into a temp file and
+    swaps it in with os.replace, so a crash leaves either the old or the new
+    file. A torn last line is skipped on replay and terminated before the next append.
+
+    Several processes may share the file: appends and compaction run under a file
+    lock (`<path>.lock`), and an append handle is reopened when another process has
+    swapped in a compacted file.
+    """
+
+    def __init__(self, path, namespace, compact_min_records=5000, compact_ratio=2.0):
+        self.path = path
+        self.namespace = namespace
+        self.compact_min_records = compact_min_records
+        self.compact_ratio = compact_ratio
+        self._lock = threading.Lock()
+        self._handle = None
+        self._records = 0
+        # Số key sống ở lần load/compact gần nhất; compact khi số record vượt compact_ratio lần.
+        self._live = 0
+        self._dirty = False
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def _file_lock(self):
+        return locked_file(self.path + ".lock")
+
+    @staticmethod
+    def _matches(key, rules):
+        if not rules:
+            return True
+        for rule, arg in rules:
+            if rule == "prefix" and key.startswith(arg):
+                return True
+            if rule == "suffix" and key.endswith(arg):
+                return True
+            if rule == "contains" and arg in key:
+                return True
+        return False
+
+    def _replay(self):
+        entries = {}
+        records = 0
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                header_line = f.readline()
+                try:
+                    header = json.loads(header_line)
+                except ValueError:
+                    return None, 0
+                if header.get("format") != _FORMAT or header.get("namespace") != self.namespace:
+                    return None, 0
+
+                # Đọc từng dòng, không json.load cả file vào bộ nhớ.
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    records += 1
+                    if "drop" in record:
+                        rules = record.get("drop") or []
+                        for key in [key for key in entries if self._matches(key, rules)]:
+                            del entries[key]
+                    elif record.get("d"):
+                        entries.pop(record.get("k"), None)
+                    elif "k" in record:
+                        entries[record["k"]] = record.get("v")
+        except FileNotFoundError:
+            return {}, 0
+        return entries, records
+
+    def load(self):
+        """Replay the journal and return {key: value}; an unreadable or foreign file yields {}."""
+        with self._lock, self._file_lock():
+            entries, records = self._replay()
+            if entries is None:
+                # Namespace/format khác: bắt đầu file mới thay vì append vào file cũ.
+                self._write_compacted_locked({})
+                entries, records = {}, 0
+            self._records = records
+            self._live = len(entries)
+            return entries
+
+    def _handle_is_current_locked(self):
+        # Process khác compact thì path trỏ sang inode mới; handle cũ ghi vào file đã bị unlink.
+        try:
+            return os.fstat(self._handle.fileno()).st_ino == os.stat(self.path).st_ino
+        except OSError:
+            return False
+
+    def _open_locked(self):
+        if self._handle is not None and not self._handle_is_current_locked():
+            self._handle.close()
+            self._handle = None
+        if self._handle is None:
+            self._handle = open(self.path, "a", encoding="utf-8")
+            if self._handle.tell() == 0:
+                self._handle.write(json.dumps({"format": _FORMAT, "namespace": self.namespace}) + "\n")
+            else:
+                with open(self.path, "rb") as f:
+                    f.seek(-1, os.SEEK_END)
+                    torn = f.read(1) != b"\n"
+                if torn:
+                    # Crash giữa lúc ghi để lại dòng dở: kết thúc nó để record kế tiếp nằm trên dòng riêng.
+                    self._handle.write("\n")
+        return self._handle
+
+    def _append_locked(self, record):
+        with self._file_lock():
+            handle = self._open_locked()
+            handle.write(json.dumps(record, ensure_ascii=False) + "\n")
+            handle.flush()
+        self._records += 1
+        self._dirty = True
+
+    def set(self, key, value):
+        with self._lock:
+            self._append_locked({"k": key, "v": value})
+
+    def delete(self, key):
+        with self._lock:
+            self._append_locked({"k": key, "d": 1})
+
+    def drop_matching(self, prefix=None, contains=None, suffixes=None):
+        rules = []
+        if prefix is not None:
+            rules.append(["prefix", prefix])
+        if contains is not None:
+            rules.append(["contains", contains])
+        for suffix in suffixes or []:
+            rules.append(["suffix", suffix])
+        with self._lock:
+            self._append_locked({"drop": rules})
+
+    def clear(self):
+        with self._lock, self._file_lock():
+            self._write_compacted_locked({})
+
+    def sync(self):
+        """fsync pending appends (call at batch boundaries, not per write)."""
+        with self._lock:
+            if self._handle is not None and self._dirty:
+                try:
+                    os.fsync(self._handle.fileno())
+                except OSError:
+                    pass
+                self._dirty = False
+
+    def _write_compacted_locked(self, entries):
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
+
+        directory = os.path.dirname(os.path.abspath(self.path)) or "."
+        fd, temp_path = tempfile.mkstemp(prefix=".journal-", dir=directory)
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(json.dumps({"format": _FORMAT, "namespace": self.namespace}) + "\n")
+                for key, value in entries.items():
+                    f.write(json.dumps({"k": key, "v": value}, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.path)
+            _fsync_directory(self.path)
+        except Exception:
+            try:
+                os.unlink(temp_path)
+            except OSError:
+                pass
+            raise
+
+        self._records = len(entries)
+        self._live = len(entries)
+        self._dirty = False
+
+    def maybe_compact(self, force=False):
+        """Rewrite the file with only live entries once it holds compact_ratio x more records than keys."""
+        with self._lock:
+            if not force and (
+                self._records < self.compact_min_records
+                or self._records < self._live * self.compact_ratio
+            ):
+                return False
+            with self._file_lock():
+                entries, _ = self._replay()
+                self._write_compacted_locked(entries or {})
+            return True
@@ -0,0 +1,251 @@
+import json
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+# Tất cả cache đã tạo, để admin xem counters qua all_cache_stats().
+_REGISTRY = weakref.WeakValueDictionary()
+_REGISTRY_LOCK = threading.Lock()
+
+
+def estimate_size_bytes(value):
+    """Rough in-memory footprint used for byte budgets (UTF-8 length for text, JSON length otherwise)."""
+    if value is None:
+        return 0
+    if isinstance(value, bytes):
+        return len(value)
+    if isinstance(value, str):
+        return len(value.encode("utf-8"))
+    try:
+        return len(json.dumps(value, ensure_ascii=False, default=str).encode("utf-8"))
+    except Exception:
+        return len(str(value))
+
+
+class _Entry:
+    __slots__ = ("value", "expires_at", "size")
+
+    def __init__(self, value, expires_at, size):
+        self.value = value
+        self.expires_at = expires_at
+        self.size = size
+
+
+class SegmentedLRUCache:
+    """
+    Thread-safe segmented LRU with per-entry TTL and byte accounting.
+
+    New keys enter the probation segment; a second hit promotes them to the
+    protected segment (PROTECTED_RATIO of capacity). Eviction takes the least
+    recently used probation entry first, so one-off scans (prewarm, bulk
+    loads) cannot flush entries that are read repeatedly.
+
+    With `scope_of(key) -> scope | None` the cache keeps a secondary index so
+    pop_scope(scope) costs O(entries in that scope) instead of a full scan.
+    """
+
+    PROTECTED_RATIO = 0.8
+
+    def __init__(self, name, max_items, max_bytes=None, ttl_seconds=None, sizeof=estimate_size_bytes, scope_of=None):
+        self.name = name
+        self.max_items = max(1, int(max_items))
+        self.max_bytes = int(max_bytes) if max_bytes else None
+        self.ttl_seconds = ttl_seconds
+        self._sizeof = sizeof
+        self._scope_of = scope_of
+        self._scopes = {}
+        self._probation = OrderedDict()
+        self._protected = OrderedDict()
+        self._protected_bytes = 0
+        self._bytes = 0
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+        with _REGISTRY_LOCK:
+            _REGISTRY[name] = self
+
+    def _expires_at(self, ttl_seconds):
+        ttl = self.ttl_seconds if ttl_seconds is None else ttl_seconds
+        if not ttl or ttl <= 0:
+            return None
+        return time.monotonic() + ttl
+
+    def _drop_locked(self, key):
+        entry = self._probation.pop(key, None)
+        if entry is None:
+            entry = self._protected.pop(key, None)
+            if entry is not None:
+                self._protected_bytes -= entry.size
+        if entry is not None:
+            self._bytes -= entry.size
+            if self._scope_of is not None:
+                self._unindex_locked(key)
+        return entry
+
+    def _index_locked(self, key):
+        scope = self._scope_of(key)
+        if scope is not None:
+            self._scopes.setdefault(scope, set()).add(key)
+
+    def _unindex_locked(self, key):
+        scope = self._scope_of(key)
+        keys = self._scopes.get(scope)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._scopes[scope]
+
+    def _over_budget_locked(self):
+        if len(self._probation) + len(self._protected) > self.max_items:
+            return True
+        return self.max_bytes is not None and self._bytes > self.max_bytes
+
+    def _evict_locked(self):
+        while self._over_budget_locked():
+            segment = self._probation if self._probation else self._protected
+            if not segment:
+                return
+            key = next(iter(segment))
+            self._drop_locked(key)
+            self.evictions += 1
+
+    def _rebalance_protected_locked(self):
+        protected_items = max(1, int(self.max_items * self.PROTECTED_RATIO))
+        protected_bytes = int(self.max_bytes * self.PROTECTED_RATIO) if self.max_bytes else None
+        while self._protected and (
+            len(self._protected) > protected_items
+            or (protected_bytes is not None and self._protected_bytes > protected_bytes)
+        ):
+            # Hạ cấp entry cũ nhất của protected về đầu MRU của probation.
+            key, entry = self._protected.popitem(last=False)
+            self._protected_bytes -= entry.size
+            self._probation[key] = entry
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._probation.get(key)
+            in_probation = entry is not None
+            if entry is None:
+                entry = self._protected.get(key)
+
+            if entry is None:
+                self.misses += 1
+                return default
+
+            if entry.expires_at is not None and entry.expires_at <= time.monotonic():
+                self._drop_locked(key)
+                self.expirations += 1
+                self.misses += 1
+                return default
+
+            self.hits += 1
+            if in_probation:
+                del self._probation[key]
+                self._protected[key] = entry
+                self._protected_bytes += entry.size
+                self._rebalance_protected_locked()
+            else:
+                self._protected.move_to_end(key)
+            return entry.value
+
+    def set(self, key, value, ttl_seconds=None):
+        size = self._sizeof(value)
+        if isinstance(key, (str, bytes)):
+            size += self._sizeof(key)
+        entry = _Entry(value, self._expires_at(ttl_seconds), size)
+        with self._lock:
+            was_protected = key in self._protected
+            self._drop_locked(key)
+            # Ghi đè key đang hot thì giữ nguyên ở protected.
+            if was_protected:
+                self._protected[key] = entry
+                self._protected_bytes += size
+            else:
+                self._probation[key] = entry
+            self._bytes += size
+            if self._scope_of is not None:
+                self._index_locked(key)
+            self._rebalance_protected_locked()
+            self._evict_locked()
+
+    def update(self, mapping, ttl_seconds=None):
+        for key, value in mapping.items():
+            self.set(key, value, ttl_seconds=ttl_seconds)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._drop_locked(key)
+        return entry.value if entry is not None else default
+
+    def pop_where(self, predicate):
+        """Remove every key for which predicate(key) is true; returns the count removed."""
+        with self._lock:
+            keys = [key for key in list(self._probation) + list(self._protected) if predicate(key)]
+            for key in keys:
+                self._drop_locked(key)
+        return len(keys)
+
+    def pop_scope(self, scope):
+        """Remove every key whose scope_of(key) == scope; returns the count removed."""
+        if self._scope_of is None:
+            raise ValueError(f"cache {self.name} was created without scope_of")
+        with self._lock:
+            keys = list(self._scopes.get(scope, ()))
+            for key in keys:
+                self._drop_locked(key)
+        return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._probation.clear()
+            self._protected.clear()
+            self._scopes.clear()
+            self._bytes = 0
+            self._protected_bytes = 0
+
+    def items(self):
+        """Live (non-expired) entries as a plain dict, e.g. for persisting to disk."""
+        now = time.monotonic()
+        with self._lock:
+            return {
+                key: entry.value
+                for segment in (self._probation, self._protected)
+                for key, entry in segment.items()
+                if entry.expires_at is None or entry.expires_at > now
+            }
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._probation or key in self._protected
+
+    def __len__(self):
+        with self._lock:
+            return len(self._probation) + len(self._protected)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "name": self.name,
+                "items": len(self._probation) + len(self._protected),
+                "protected_items": len(self._protected),
+                "scopes": len(self._scopes),
+                "bytes": self._bytes,
+                "max_items": self.max_items,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+def all_cache_stats():
+    with _REGISTRY_LOCK:
+        caches = list(_REGISTRY.values())
+    return {cache.name: cache.stats() for cache in caches}
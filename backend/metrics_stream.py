@@ -0,0 +1,128 @@
+import json
+import queue
+import threading
+import time
+
+
+class MetricsStream:
+    """
+    One producer thread shared by every connected Server-Sent Events client.
+
+    Every `interval_seconds` the producer calls `collect_fn()`, which returns
+    `(state, deltas)`: state sections are pushed only when they differ from the
+    previous tick, delta sections (lists) whenever they are non-empty. New clients
+    first receive a `snapshot` event with the latest state. The producer only runs
+    while at least one client is connected; `on_start()` / `on_stop()` are called
+    (under the stream lock) when it starts and stops.
+    """
+
+    def __init__(self, name, collect_fn, interval_seconds=5.0, max_clients=4, client_queue_size=64,
+                 on_start=None, on_stop=None):
+        self.name = name
+        self._collect_fn = collect_fn
+        self._on_start = on_start
+        self._on_stop = on_stop
+        self.interval_seconds = max(0.5, float(interval_seconds))
+        self.max_clients = max(1, int(max_clients))
+        self.client_queue_size = max(4, int(client_queue_size))
+        self._lock = threading.Lock()
+        self._clients = set()
+        self._state = {}
+        self._thread = None
+        self.ticks = 0
+        self.events = 0
+        self.dropped_clients = 0
+        self.rejected_clients = 0
+
+    def subscribe(self):
+        """Register a client queue, or return None if max_clients are already connected."""
+        client = queue.Queue(maxsize=self.client_queue_size)
+        with self._lock:
+            if len(self._clients) >= self.max_clients:
+                self.rejected_clients += 1
+                return None
+            self._clients.add(client)
+            if self._state:
+                client.put_nowait(("snapshot", dict(self._state)))
+            if self._thread is None:
+                if self._on_start is not None:
+                    self._on_start()
+                self._thread = threading.Thread(target=self._run, name=f"metrics-stream-{self.name}", daemon=True)
+                self._thread.start()
+        return client
+
+    def unsubscribe(self, client):
+        with self._lock:
+            self._clients.discard(client)
+
+    def _publish_locked(self, event, payload):
+        for client in list(self._clients):
+            try:
+                client.put_nowait((event, payload))
+            except queue.Full:
+                # Client đọc quá chậm: ngắt, EventSource sẽ tự kết nối lại và nhận snapshot mới.
+                self._clients.discard(client)
+                self.dropped_clients += 1
+        self.events += 1
+
+    def _run(self):
+        while True:
+            started_at = time.monotonic()
+            try:
+                state, deltas = self._collect_fn()
+            except Exception as exc:
+                print(f"[metrics-stream] {self.name} collect failed: {exc}")
+                state, deltas = {}, {}
+
+            with self._lock:
+                if not self._clients:
+                    self._thread = None
+                    if self._on_stop is not None:
+                        self._on_stop()
+                    return
+                self.ticks += 1
+                first_tick = not self._state
+                for section, value in (state or {}).items():
+                    if value is None or self._state.get(section) == value:
+                        continue
+                    self._state[section] = value
+                    if not first_tick:
+                        self._publish_locked(section, value)
+                if first_tick and self._state:
+                    self._publish_locked("snapshot", dict(self._state))
+                for section, items in (deltas or {}).items():
+                    if items:
+                        self._publish_locked(section, items)
+
+            time.sleep(max(0.0, self.interval_seconds - (time.monotonic() - started_at)))
+
+    def iter_events(self, client, max_seconds=300.0, keepalive_seconds=15.0):
+        """SSE text chunks for one client; ends after max_seconds so the client reconnects."""
+        deadline = time.monotonic() + max(1.0, float(max_seconds))
+        try:
+            yield f"retry: {int(self.interval_seconds * 1000)}\n\n"
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or client not in self._clients:
+                    return
+                try:
+                    event, payload = client.get(timeout=min(keepalive_seconds, remaining))
+                except queue.Empty:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False, default=str)}\n\n"
+        finally:
+            self.unsubscribe(client)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "name": self.name,
+                "clients": len(self._clients),
+                "max_clients": self.max_clients,
+                "running": self._thread is not None,
+                "ticks": self.ticks,
+                "events": self.events,
+                "dropped_clients": self.dropped_clients,
+                "rejected_clients": self.rejected_clients,
+            }
@@ -0,0 +1,92 @@
+"""Frame-level MP3 helpers used to join cached TTS sentence segments."""
+
+_BITRATES_KBPS = {
+    # (mpeg1, layer) -> bảng bitrate theo index 0..14
+    (True, 1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (True, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (True, 3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (False, 1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (False, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    (False, 3): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+_SAMPLE_RATES = {
+    3: (44100, 48000, 32000),  # MPEG-1
+    2: (22050, 24000, 16000),  # MPEG-2
+    0: (11025, 12000, 8000),   # MPEG-2.5
+}
+_VBR_TAGS = (b"Xing", b"Info", b"VBRI")
+
+
+def _frame_length(header):
+    """Byte length of the frame starting with this 4-byte header, or None if it is not a valid header."""
+    if len(header) < 4 or header[0] != 0xFF or (header[1] & 0xE0) != 0xE0:
+        return None
+    version = (header[1] >> 3) & 0x03
+    layer_bits = (header[1] >> 1) & 0x03
+    bitrate_index = header[2] >> 4
+    sample_rate_index = (header[2] >> 2) & 0x03
+    padding = (header[2] >> 1) & 0x01
+    if version == 1 or layer_bits == 0 or bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
+
+    layer = 4 - layer_bits
+    mpeg1 = version == 3
+    bitrate = _BITRATES_KBPS[(mpeg1, layer)][bitrate_index] * 1000
+    sample_rate = _SAMPLE_RATES[version][sample_rate_index]
+    if layer == 1:
+        return (12 * bitrate // sample_rate + padding) * 4
+    if layer == 3 and not mpeg1:
+        return 72 * bitrate // sample_rate + padding
+    return 144 * bitrate // sample_rate + padding
+
+
+def _skip_id3v2(data):
+    if len(data) < 10 or data[:3] != b"ID3":
+        return 0
+    # Kích thước tag là syncsafe integer 4 byte (7 bit mỗi byte), cộng footer nếu có cờ.
+    size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+    footer = 10 if data[5] & 0x10 else 0
+    return 10 + size + footer
+
+
+def iter_mp3_frames(data):
+    """Yield (offset, length) of each complete MPEG audio frame, skipping ID3 tags and junk."""
+    position = _skip_id3v2(data)
+    end = len(data)
+    if end >= 128 and data[end - 128:end - 125] == b"TAG":
+        end -= 128
+
+    while position + 4 <= end:
+        length = _frame_length(data[position:position + 4])
+        if not length:
+            position += 1
+            continue
+        if position + length > end:
+            break  # Frame cuối bị cắt dở: bỏ.
+        yield position, length
+        position += length
+
+
+def audio_frames(data):
+    """Raw audio frames of one MP3 (no ID3, no Xing/Info/VBRI header frame)."""
+    frames = []
+    for index, (offset, length) in enumerate(iter_mp3_frames(data)):
+        frame = data[offset:offset + length]
+        if index == 0 and any(tag in frame[:64] for tag in _VBR_TAGS):
+            continue
+        frames.append(frame)
+    return b"".join(frames)
+
+
+def concat_mp3(segments):
+    """
+    Join MP3 segments at frame boundaries. Returns None if any segment has no frames,
+    so callers can fall back to synthesising the whole text.
+    """
+    parts = []
+    for segment in segments:
+        frames = audio_frames(segment or b"")
+        if not frames:
+            return None
+        parts.append(frames)
+    return b"".join(parts) if parts else None
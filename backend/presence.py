@@ -0,0 +1,100 @@
+import threading
+import time
+from collections import deque
+
+
+class PresenceRegistry:
+    """
+    Devices seen within the last `window_seconds`, kept in a ring of 1-second buckets.
+
+    touch() moves a device to the bucket of its latest heartbeat; buckets that fall
+    out of the window are expired as a whole. Device and identity counts are kept
+    incrementally, so counts() is O(1) (plus expiring whole buckets).
+    """
+
+    def __init__(self, window_seconds):
+        self.window_seconds = max(1, int(window_seconds))
+        self._lock = threading.Lock()
+        self._ring = deque()  # (bucket_second, set(device_id)) theo thứ tự thời gian
+        self._buckets = {}
+        self._devices = {}  # device_id -> (identity, last_seen_epoch, bucket_second)
+        self._identities = {}  # identity -> set(device_id)
+
+    def _expire_locked(self, now):
+        cutoff = int(now) - self.window_seconds
+        while self._ring and self._ring[0][0] <= cutoff:
+            bucket_second, device_ids = self._ring.popleft()
+            del self._buckets[bucket_second]
+            for device_id in device_ids:
+                self._forget_locked(device_id)
+
+    def _forget_locked(self, device_id):
+        identity, _, _ = self._devices.pop(device_id)
+        if identity is not None:
+            devices = self._identities.get(identity)
+            if devices is not None:
+                devices.discard(device_id)
+                if not devices:
+                    del self._identities[identity]
+
+    def _bucket_locked(self, bucket_second):
+        bucket = self._buckets.get(bucket_second)
+        if bucket is not None:
+            return bucket
+        bucket = set()
+        self._buckets[bucket_second] = bucket
+        if not self._ring or self._ring[-1][0] < bucket_second:
+            self._ring.append((bucket_second, bucket))
+        else:
+            # Hiếm: seed từ DB hoặc beat đến trễ, chèn đúng thứ tự để expire vẫn tuần tự.
+            index = len(self._ring)
+            while index > 0 and self._ring[index - 1][0] > bucket_second:
+                index -= 1
+            self._ring.insert(index, (bucket_second, bucket))
+        return bucket
+
+    def touch(self, device_id, identity=None, seen_at=None):
+        """Record a heartbeat (seen_at is epoch seconds; older than the stored one is ignored)."""
+        now = time.time()
+        seen_at = now if seen_at is None else float(seen_at)
+        if seen_at <= now - self.window_seconds:
+            return
+        with self._lock:
+            self._expire_locked(now)
+            previous = self._devices.get(device_id)
+            if previous is not None:
+                if previous[1] > seen_at:
+                    return
+                self._buckets[previous[2]].discard(device_id)
+                self._forget_locked(device_id)
+
+            bucket_second = int(seen_at)
+            self._bucket_locked(bucket_second).add(device_id)
+            self._devices[device_id] = (identity, seen_at, bucket_second)
+            if identity is not None:
+                self._identities.setdefault(identity, set()).add(device_id)
+
+    def counts(self):
+        with self._lock:
+            self._expire_locked(time.time())
+            return len(self._devices), len(self._identities)
+
+    def identities(self):
+        """[(identity, last_seen_epoch, device_count)] newest first."""
+        with self._lock:
+            self._expire_locked(time.time())
+            rows = [
+                (identity, max(self._devices[device_id][1] for device_id in devices), len(devices))
+                for identity, devices in self._identities.items()
+            ]
+        rows.sort(key=lambda row: row[1], reverse=True)
+        return rows
+
+    def stats(self):
+        with self._lock:
+            return {
+                "window_seconds": self.window_seconds,
+                "devices": len(self._devices),
+                "identities": len(self._identities),
+                "buckets": len(self._ring),
+            }
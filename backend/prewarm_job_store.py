@@ -0,0 +1,211 @@
+import json
+
+from sqlalchemy import text
+
+from db import db
+
+# Một dòng cho mỗi cặp (restaurant, ngôn ngữ). Bảng được tạo ở bootstrap trong app.py.
+# status: pending -> running -> done | failed; running quá lease được coi là worker đã chết.
+PREWARM_JOB_TABLE = "prewarm_job"
+
+_ENQUEUE_SQL = f"""
+    INSERT INTO {PREWARM_JOB_TABLE}
+        (restaurant_id, target_lang, source_checksum, status, attempts, reason, run_after, created_at, updated_at)
+    VALUES (:restaurant_id, :target_lang, :source_checksum, 'pending', 0, :reason, NOW(), NOW(), NOW())
+    ON CONFLICT (restaurant_id, target_lang) DO UPDATE SET
+        source_checksum = EXCLUDED.source_checksum,
+        status = 'pending',
+        attempts = 0,
+        checkpoint = NULL,
+        last_error = NULL,
+        reason = EXCLUDED.reason,
+        run_after = NOW(),
+        locked_at = NULL,
+        updated_at = NOW()
+"""
+# Không đụng tới job đã xong/đang chạy cho đúng nội dung hiện tại: restart không làm lại ngôn ngữ đã warm.
+_ENQUEUE_UNLESS_CURRENT_SQL = _ENQUEUE_SQL + f"""
+    WHERE NOT (
+        {PREWARM_JOB_TABLE}.source_checksum = EXCLUDED.source_checksum
+        AND {PREWARM_JOB_TABLE}.status IN ('pending', 'running', 'done')
+    )
+"""
+
+
+def _loads(value):
+    if not value:
+        return None
+    if isinstance(value, dict):
+        return value
+    try:
+        return json.loads(value)
+    except ValueError:
+        return None
+
+
+def enqueue_prewarm_jobs(restaurant_id, target_langs, source_checksum, reason=None, force=False):
+    """Upsert one pending job per language; with force=False languages already done for this checksum are kept."""
+    params = [
+        {
+            "restaurant_id": int(restaurant_id),
+            "target_lang": lang,
+            "source_checksum": source_checksum,
+            "reason": reason,
+        }
+        for lang in target_langs
+    ]
+    if not params:
+        return
+    try:
+        db.session.execute(text(_ENQUEUE_SQL if force else _ENQUEUE_UNLESS_CURRENT_SQL), params)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+def claim_prewarm_jobs(limit, lease_seconds):
+    """
+    Atomically move up to `limit` runnable jobs to running and return them.
+
+    Runnable = pending and due, or running with an expired lease (the worker that
+    held it died, e.g. during a redeploy). SKIP LOCKED lets several processes claim
+    without blocking each other.
+    """
+    try:
+        rows = db.session.execute(
+            text(
+                f"""
+                WITH picked AS (
+                    SELECT id FROM {PREWARM_JOB_TABLE}
+                    WHERE (status = 'pending' AND run_after <= NOW())
+                       OR (status = 'running' AND locked_at < NOW() - (:lease_seconds * INTERVAL '1 second'))
+                    ORDER BY run_after ASC, id ASC
+                    LIMIT :limit
+                    FOR UPDATE SKIP LOCKED
+                )
+                UPDATE {PREWARM_JOB_TABLE} AS job
+                SET status = 'running', attempts = job.attempts + 1, locked_at = NOW(), updated_at = NOW()
+                FROM picked
+                WHERE job.id = picked.id
+                RETURNING job.id, job.restaurant_id, job.target_lang, job.source_checksum,
+                          job.checkpoint, job.key_checksums, job.attempts
+                """
+            ),
+            {"limit": int(limit), "lease_seconds": int(lease_seconds)},
+        ).mappings().all()
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    jobs = []
+    for row in rows:
+        job = dict(row)
+        job["checkpoint"] = _loads(job.get("checkpoint")) or {}
+        job["key_checksums"] = _loads(job.get("key_checksums"))
+        jobs.append(job)
+    return jobs
+
+
+def _update_claimed(job, assignments, params=None):
+    # Chỉ cập nhật nếu job vẫn là bản mình đã claim (chưa bị enqueue lại với nội dung mới).
+    try:
+        db.session.execute(
+            text(
+                f"""
+                UPDATE {PREWARM_JOB_TABLE}
+                SET {assignments}, updated_at = NOW()
+                WHERE id = :id AND status = 'running' AND source_checksum = :claimed_checksum
+                """
+            ),
+            {"id": job["id"], "claimed_checksum": job["source_checksum"], **(params or {})},
+        )
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+def save_prewarm_checkpoint(job, checkpoint):
+    _update_claimed(job, "checkpoint = :checkpoint, locked_at = NOW()", {"checkpoint": json.dumps(checkpoint)})
+
+
+def complete_prewarm_job(job, key_checksums):
+    _update_claimed(
+        job,
+        "status = 'done', checkpoint = NULL, last_error = NULL, locked_at = NULL, key_checksums = :key_checksums",
+        {"key_checksums": json.dumps(key_checksums, sort_keys=True)},
+    )
+
+
+def fail_prewarm_job(job, error, max_attempts, retry_seconds):
+    """Back to pending with a delay (retry_seconds * attempts), or failed after max_attempts."""
+    if job["attempts"] >= max_attempts:
+        _update_claimed(
+            job,
+            "status = 'failed', last_error = :error, locked_at = NULL",
+            {"error": str(error)[:1000]},
+        )
+        return
+    _update_claimed(
+        job,
+        "status = 'pending', last_error = :error, locked_at = NULL, "
+        "run_after = NOW() + (:delay_seconds * INTERVAL '1 second')",
+        {"error": str(error)[:1000], "delay_seconds": int(retry_seconds * job["attempts"])},
+    )
+
+
+def delete_prewarm_jobs(restaurant_id):
+    try:
+        db.session.execute(
+            text(f"DELETE FROM {PREWARM_JOB_TABLE} WHERE restaurant_id = :restaurant_id"),
+            {"restaurant_id": int(restaurant_id)},
+        )
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+_ALL_DONE_SQL = f"""
+    NOT EXISTS (
+        SELECT 1 FROM {PREWARM_JOB_TABLE}
+        WHERE restaurant_id = :restaurant_id AND status <> 'done'
+    )
+"""
+
+
+def prewarm_jobs_all_done(restaurant_id):
+    """True when every language job of the restaurant is done (none pending, running or failed)."""
+    return bool(db.session.execute(
+        text(f"SELECT {_ALL_DONE_SQL} AS all_done"),
+        {"restaurant_id": int(restaurant_id)},
+    ).scalar())
+
+
+def load_done_key_checksums(restaurant_id):
+    """
+    Per-logical-key checksums of the last completed warm of a restaurant, or None while
+    any of its language jobs is not done (a partial warm is not a valid diff base).
+    """
+    row = db.session.execute(
+        text(
+            f"""
+            SELECT key_checksums FROM {PREWARM_JOB_TABLE}
+            WHERE restaurant_id = :restaurant_id AND status = 'done' AND key_checksums IS NOT NULL
+              AND {_ALL_DONE_SQL}
+            ORDER BY updated_at DESC
+            LIMIT 1
+            """
+        ),
+        {"restaurant_id": int(restaurant_id)},
+    ).mappings().first()
+    return _loads((row or {}).get("key_checksums"))
+
+
+def prewarm_job_counts():
+    rows = db.session.execute(
+        text(f"SELECT status, COUNT(*) AS total FROM {PREWARM_JOB_TABLE} GROUP BY status")
+    ).mappings().all()
+    return {row["status"]: int(row["total"]) for row in rows}
@@ -1,13 +1,25 @@
 import asyncio
 import inspect
+import os
 import threading
 import time
+import uuid
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from rate_limit import TokenBucket
 
 
 MAX_QUEUE_LENGTH = 50
 REQUESTS_PER_SECOND = 5
-WORKER_INTERVAL_SECONDS = 1.0 / REQUESTS_PER_SECOND
+# Số job được chạy liền nhau khi queue của quán đang rảnh, sau đó về đúng nhịp REQUESTS_PER_SECOND.
+QUEUE_BURST = int((os.getenv("QUEUE_BURST") or "1").strip() or "1")
+QUEUE_BURST = max(1, min(MAX_QUEUE_LENGTH, QUEUE_BURST))
+QUEUE_MAX_WORKERS = int((os.getenv("QUEUE_MAX_WORKERS") or "8").strip() or "8")
+QUEUE_MAX_WORKERS = max(1, min(64, QUEUE_MAX_WORKERS))
+# Kết quả job async (submit_job) được giữ lại để client poll/SSE lấy về.
+JOB_RESULT_TTL_SECONDS = int((os.getenv("QUEUE_JOB_RESULT_TTL_SECONDS") or "300").strip() or "300")
+JOB_RESULT_TTL_SECONDS = max(30, min(3600, JOB_RESULT_TTL_SECONDS))
 
 
 class QueueFullError(Exception):
@@ -17,9 +29,12 @@ class QueueFullError(Exception):
 
 
 class _QueueJob:
-    def __init__(self, job_function, queue_position):
+    def __init__(self, job_function, queue_position, coalesce_key=None):
+        self.job_id = uuid.uuid4().hex
         self.job_function = job_function
         self.queue_position = queue_position
+        self.coalesce_key = coalesce_key
+        self.coalesced_count = 0
         self.done_event = threading.Event()
         self.result = None
         self.error = None
@@ -27,15 +42,32 @@ class _QueueJob:
         self.started_at = None
         self.finished_at = None
 
+    def status(self):
+        if self.finished_at is not None:
+            return "failed" if self.error is not None else "done"
+        if self.started_at is not None:
+            return "running"
+        return "queued"
+
 
 class _RestaurantQueueState:
     def __init__(self):
         self.queue = deque()
         self.is_processing = False
+        self.bucket = TokenBucket(REQUESTS_PER_SECOND, capacity=QUEUE_BURST)
 
 
 _restaurant_queues = {}
 _queue_lock = threading.Lock()
+# Dispatcher ngủ trên condition này, được đánh thức khi có job mới hoặc 1 job chạy xong.
+_dispatch_condition = threading.Condition(_queue_lock)
+_running_jobs = 0
+# (restaurant key, coalesce_key) -> job đang chờ/đang chạy; request trùng key đợi chung job này.
+_inflight_jobs = {}
+_coalesced_total = 0
+# job_id -> job cho các job submit_job; giữ JOB_RESULT_TTL_SECONDS sau khi xong.
+_job_registry = {}
+_executor = None
 _worker_started = False
 _worker_started_lock = threading.Lock()
 
@@ -47,24 +79,8 @@ def _execute_job(job_function):
     return result
 
 
-def _process_one_job_for_restaurant(restaurant_id):
-    key = str(restaurant_id)
-
-    with _queue_lock:
-        state = _restaurant_queues.get(key)
-        if state is None:
-            return
-
-        if state.is_processing:
-            return
-
-        if not state.queue:
-            return
-
-        job = state.queue.popleft()
-        state.is_processing = True
-        queue_length_after_pop = len(state.queue)
-        job.started_at = time.monotonic()
+def _run_job(key, job, queue_length_after_pop):
+    global _running_jobs
 
     waited_ms = int((job.started_at - job.enqueued_at) * 1000)
 
@@ -85,46 +101,101 @@ def _process_one_job_for_restaurant(restaurant_id):
         if job.started_at is not None:
             run_ms = int((job.finished_at - job.started_at) * 1000)
 
-        with _queue_lock:
+        with _dispatch_condition:
+            _running_jobs -= 1
+            if job.coalesce_key is not None and _inflight_jobs.get((key, job.coalesce_key)) is job:
+                _inflight_jobs.pop((key, job.coalesce_key), None)
+            coalesced_count = job.coalesced_count
             current_state = _restaurant_queues.get(key)
             queue_length_remaining = 0
             if current_state is not None:
                 queue_length_remaining = len(current_state.queue)
                 current_state.is_processing = False
-                if not current_state.queue:
-                    _restaurant_queues.pop(key, None)
+            _dispatch_condition.notify()
 
         print(
-            f"[queue] done restaurant={key} queue_position={job.queue_position} waited_ms={waited_ms} run_ms={run_ms} queue_length_remaining={queue_length_remaining}"
+            f"[queue] done restaurant={key} queue_position={job.queue_position} waited_ms={waited_ms} run_ms={run_ms} "
+            f"queue_length_remaining={queue_length_remaining} coalesced={coalesced_count}"
         )
 
         job.done_event.set()
 
 
-def _worker_loop():
-    while True:
-        time.sleep(WORKER_INTERVAL_SECONDS)
-        with _queue_lock:
-            restaurant_ids = list(_restaurant_queues.keys())
+def _dispatch_ready_jobs_locked():
+    """
+    Start every job that may run now; return seconds until the next token is due (or None).
+
+    Caller holds _queue_lock. Each restaurant runs at most one job at a time (FIFO),
+    different restaurants run in parallel up to QUEUE_MAX_WORKERS.
+    """
+    global _running_jobs
+
+    next_wake_in = None
+    for key, state in list(_restaurant_queues.items()):
+        if state.is_processing:
+            continue
+
+        if not state.queue:
+            # Chỉ bỏ state khi bucket đã đầy lại, tránh tạo state mới để "reset" rate.
+            if state.bucket.is_full():
+                _restaurant_queues.pop(key, None)
+            continue
+
+        if _running_jobs >= QUEUE_MAX_WORKERS:
+            # Hết worker: job đang chạy xong sẽ notify lại dispatcher.
+            continue
+
+        delay = state.bucket.try_acquire()
+        if delay > 0:
+            next_wake_in = delay if next_wake_in is None else min(next_wake_in, delay)
+            continue
+
+        job = state.queue.popleft()
+        state.is_processing = True
+        job.started_at = time.monotonic()
+        _running_jobs += 1
+        _executor.submit(_run_job, key, job, len(state.queue))
+
+    return next_wake_in
+
 
-        # Mỗi tick xử lý tối đa 1 job cho mỗi restaurant,
-        # đảm bảo 5 req/s/restaurant và FIFO theo từng queue.
-        for restaurant_id in restaurant_ids:
-            _process_one_job_for_restaurant(restaurant_id)
+def _dispatcher_loop():
+    with _dispatch_condition:
+        while True:
+            next_wake_in = _dispatch_ready_jobs_locked()
+            if next_wake_in is None and any(not state.queue for state in _restaurant_queues.values()):
+                # Còn state rỗng chờ bucket đầy để dọn: thức dậy sau 1 chu kỳ token.
+                next_wake_in = QUEUE_BURST / REQUESTS_PER_SECOND
+            _dispatch_condition.wait(timeout=next_wake_in)
 
 
 def _ensure_worker_started():
-    global _worker_started
+    global _worker_started, _executor
 
     with _worker_started_lock:
         if _worker_started:
             return
 
-        threading.Thread(target=_worker_loop, daemon=True).start()
+        _executor = ThreadPoolExecutor(max_workers=QUEUE_MAX_WORKERS, thread_name_prefix="queue-job")
+        threading.Thread(target=_dispatcher_loop, name="queue-dispatcher", daemon=True).start()
         _worker_started = True
 
 
-def add_to_queue(restaurant_id, job_function, timeout_seconds=None, include_meta=False):
+def get_queue_stats():
+    """Snapshot of queue depth, running jobs and single-flight coalescing counters."""
+    with _queue_lock:
+        return {
+            "restaurants_queued": sum(1 for state in _restaurant_queues.values() if state.queue),
+            "jobs_queued": sum(len(state.queue) for state in _restaurant_queues.values()),
+            "jobs_running": _running_jobs,
+            "jobs_inflight_coalescable": len(_inflight_jobs),
+            "coalesced_total": _coalesced_total,
+            "jobs_tracked": len(_job_registry),
+            "max_workers": QUEUE_MAX_WORKERS,
+        }
+
+
+def add_to_queue(restaurant_id, job_function, timeout_seconds=None, include_meta=False, coalesce_key=None):
     """
     Add one job to a restaurant-specific queue and wait for completion.
 
@@ -132,6 +203,9 @@ def add_to_queue(restaurant_id, job_function, timeout_seconds=None, include_meta
         restaurant_id: Restaurant identifier.
         job_function: Callable (sync or async) with request logic.
         timeout_seconds: Optional wait timeout.
+        coalesce_key: Optional hashable key. While a job with the same key is queued
+            or running for this restaurant, the call waits for that job and shares its
+            result (or error) instead of enqueueing a duplicate.
 
     Returns:
         Result from job_function.
@@ -146,10 +220,26 @@ def add_to_queue(restaurant_id, job_function, timeout_seconds=None, include_meta
     if not callable(job_function):
         raise ValueError("job_function must be callable")
 
+    job, coalesced = _enqueue(restaurant_id, job_function, coalesce_key)
+    return _wait_for_job(str(restaurant_id), job, timeout_seconds, include_meta, coalesced=coalesced)
+
+
+def _enqueue(restaurant_id, job_function, coalesce_key=None):
+    global _coalesced_total
+
     _ensure_worker_started()
     key = str(restaurant_id)
 
-    with _queue_lock:
+    with _dispatch_condition:
+        existing = _inflight_jobs.get((key, coalesce_key)) if coalesce_key is not None else None
+        if existing is not None:
+            existing.coalesced_count += 1
+            _coalesced_total += 1
+            print(
+                f"[queue] coalesced restaurant={key} queue_position={existing.queue_position} waiters={existing.coalesced_count + 1}"
+            )
+            return existing, True
+
         state = _restaurant_queues.get(key)
         if state is None:
             state = _RestaurantQueueState()
@@ -161,13 +251,19 @@ def add_to_queue(restaurant_id, job_function, timeout_seconds=None, include_meta
             )
 
         queue_position = len(state.queue) + 1
-        job = _QueueJob(job_function, queue_position=queue_position)
+        job = _QueueJob(job_function, queue_position=queue_position, coalesce_key=coalesce_key)
         state.queue.append(job)
+        if coalesce_key is not None:
+            _inflight_jobs[(key, coalesce_key)] = job
+        _dispatch_condition.notify()
         estimated_wait_ms = int(((queue_position - 1) / REQUESTS_PER_SECOND) * 1000)
         print(
             f"[queue] enqueue restaurant={key} queue_position={queue_position} est_wait_ms={estimated_wait_ms} queue_length={len(state.queue)}"
         )
+        return job, False
 
+
+def _wait_for_job(key, job, timeout_seconds, include_meta, coalesced=False):
     finished = job.done_event.wait(timeout=timeout_seconds)
     if not finished:
         raise TimeoutError(f"Queue job timeout for restaurant {key}")
@@ -187,6 +283,67 @@ def add_to_queue(restaurant_id, job_function, timeout_seconds=None, include_meta
             "queue_position": job.queue_position,
             "queue_wait_ms": wait_ms,
             "queue_total_ms": total_ms,
+            "coalesced": coalesced,
+            "coalesced_waiters": job.coalesced_count,
         }
 
     return job.result
+
+
+def _prune_job_registry_locked():
+    expire_before = time.monotonic() - JOB_RESULT_TTL_SECONDS
+    for job_id, job in list(_job_registry.items()):
+        if job.finished_at is not None and job.finished_at < expire_before:
+            _job_registry.pop(job_id, None)
+
+
+def submit_job(restaurant_id, job_function, coalesce_key=None):
+    """
+    Enqueue a job without waiting for it; returns (job_id, coalesced).
+
+    The result is kept for JOB_RESULT_TTL_SECONDS after completion and can be
+    read with get_job_status() or awaited with wait_for_job().
+    """
+    if restaurant_id is None:
+        raise ValueError("restaurant_id is required")
+
+    if not callable(job_function):
+        raise ValueError("job_function must be callable")
+
+    job, coalesced = _enqueue(restaurant_id, job_function, coalesce_key)
+    with _queue_lock:
+        _prune_job_registry_locked()
+        _job_registry[job.job_id] = job
+    return job.job_id, coalesced
+
+
+def _job_status_payload(job):
+    payload = {
+        "job_id": job.job_id,
+        "status": job.status(),
+        "queue_position": job.queue_position,
+        "coalesced_waiters": job.coalesced_count,
+    }
+    if job.finished_at is not None:
+        payload["result"] = job.result
+        payload["error"] = str(job.error) if job.error is not None else None
+    return payload
+
+
+def get_job_status(job_id):
+    """Status dict of a submitted job, or None if unknown/expired."""
+    with _queue_lock:
+        job = _job_registry.get(job_id)
+    if job is None:
+        return None
+    return _job_status_payload(job)
+
+
+def wait_for_job(job_id, timeout_seconds):
+    """Block up to timeout_seconds for a submitted job to finish; returns get_job_status()."""
+    with _queue_lock:
+        job = _job_registry.get(job_id)
+    if job is None:
+        return None
+    job.done_event.wait(timeout=max(0.0, float(timeout_seconds or 0)))
+    return _job_status_payload(job)
@@ -0,0 +1,84 @@
+import threading
+import time
+from contextlib import contextmanager
+
+
+class TokenBucket:
+    """
+    Classic token bucket: `rate` tokens per second, at most `capacity` stored.
+
+    Not tied to any scheduler; callers either poll try_acquire() and sleep for
+    the returned delay, or block in acquire().
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = max(0.001, float(rate))
+        self.capacity = max(1.0, float(capacity))
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self._updated_at
+        if elapsed > 0:
+            self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+            self._updated_at = now
+
+    def try_acquire(self, tokens=1):
+        """Take tokens if available. Returns 0.0 on success, else seconds until enough tokens."""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return 0.0
+            return (tokens - self._tokens) / self.rate
+
+    def acquire(self, tokens=1, timeout=None):
+        """Block until tokens are taken. Returns False if timeout expires first."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            delay = self.try_acquire(tokens)
+            if delay <= 0:
+                return True
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                delay = min(delay, remaining)
+            time.sleep(delay)
+
+    def is_full(self):
+        with self._lock:
+            self._refill(time.monotonic())
+            return self._tokens >= self.capacity
+
+
+_THREAD_LIMITS = threading.local()
+
+
+@contextmanager
+def thread_rate_limits(**buckets):
+    """
+    Attach provider buckets to the current thread, e.g. thread_rate_limits(translate=bucket).
+
+    Provider call sites call throttle("translate"); threads without an attached
+    bucket (normal request handling) are not slowed down.
+    """
+    previous = getattr(_THREAD_LIMITS, "buckets", None) or {}
+    _THREAD_LIMITS.buckets = {**previous, **buckets}
+    try:
+        yield
+    finally:
+        _THREAD_LIMITS.buckets = previous
+
+
+def current_rate_limits():
+    """Buckets attached to the current thread, to re-attach them on a worker thread."""
+    return dict(getattr(_THREAD_LIMITS, "buckets", None) or {})
+
+
+def throttle(provider):
+    bucket = (getattr(_THREAD_LIMITS, "buckets", None) or {}).get(provider)
+    if bucket is not None:
+        bucket.acquire()
@@ -0,0 +1,81 @@
+import gzip
+import hashlib
+import os
+import time
+from datetime import datetime, timezone
+
+from flask import Response, current_app, request
+
+try:
+    import brotli
+except ImportError:  # brotli là tuỳ chọn: thiếu thì chỉ phục vụ gzip/identity.
+    brotli = None
+
+_GZIP_LEVEL = int((os.getenv("PRERENDER_GZIP_LEVEL") or "6").strip() or "6")
+_GZIP_LEVEL = max(1, min(9, _GZIP_LEVEL))
+_BROTLI_QUALITY = int((os.getenv("PRERENDER_BROTLI_QUALITY") or "9").strip() or "9")
+_BROTLI_QUALITY = max(0, min(11, _BROTLI_QUALITY))
+
+
+class PrerenderedBody:
+    """A JSON body serialised once, with its compressed variants and validators."""
+
+    __slots__ = ("etag", "last_modified", "rendered_at", "bodies")
+
+    def __init__(self, etag, last_modified, bodies):
+        self.etag = etag
+        self.last_modified = last_modified
+        self.rendered_at = time.time()
+        self.bodies = bodies
+
+    @property
+    def size_bytes(self):
+        return sum(len(body) for body in self.bodies.values())
+
+
+def prerender_json(payload, last_modified=None, previous=None):
+    """
+    Serialise payload with the app JSON provider (same output as jsonify) and compress it.
+
+    If `previous` has the same body hash its Last-Modified is kept, so a re-render
+    that produced identical bytes does not look like a change to clients.
+    """
+    raw = current_app.json.dumps(payload).encode("utf-8") + b"\n"
+    etag = hashlib.sha256(raw).hexdigest()[:32]
+
+    if previous is not None and previous.etag == etag:
+        return PrerenderedBody(etag, previous.last_modified, previous.bodies)
+
+    bodies = {
+        "identity": raw,
+        "gzip": gzip.compress(raw, compresslevel=_GZIP_LEVEL),
+    }
+    if brotli is not None:
+        bodies["br"] = brotli.compress(raw, quality=_BROTLI_QUALITY)
+
+    if last_modified is None or previous is not None:
+        # Nội dung đổi so với bản trước: Last-Modified phải tiến lên để If-Modified-Since không trả 304 sai.
+        last_modified = time.time()
+    return PrerenderedBody(etag, datetime.fromtimestamp(int(last_modified), tz=timezone.utc), bodies)
+
+
+def _pick_encoding(bodies):
+    accepted = request.accept_encodings
+    for encoding in ("br", "gzip"):
+        if encoding in bodies and accepted[encoding] > 0:
+            return encoding
+    return "identity"
+
+
+def prerendered_response(prerendered, cache_control="no-cache"):
+    """Build a response from a PrerenderedBody, answering If-None-Match/If-Modified-Since with 304."""
+    encoding = _pick_encoding(prerendered.bodies)
+    response = Response(prerendered.bodies[encoding], mimetype="application/json")
+    if encoding != "identity":
+        response.headers["Content-Encoding"] = encoding
+    response.headers["Vary"] = "Accept-Encoding"
+    response.headers["Cache-Control"] = cache_control
+    # ETag yếu: cùng nội dung JSON dù nén br/gzip hay không.
+    response.set_etag(prerendered.etag, weak=True)
+    response.last_modified = prerendered.last_modified
+    return response.make_conditional(request)
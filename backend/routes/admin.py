@@ -1,12 +1,32 @@
-from flask import request, jsonify, session
+from flask import request, jsonify, session, Response
 from models import Restaurant, MenuItem, Tag, RestaurantImage, AdminUser, restaurant_tags, LocationVisit
 from db import db
 from auth import admin_required
 from validators import validate_restaurant, validate_menu_item, validate_tag, validate_restaurant_image
 from supabase_client import upload_image, delete_image, supabase_client, ensure_bucket_exists, get_public_url_for_path
 from translate import invalidate_translation_cache, cleanup_expired_translation_cache
-from tts import invalidate_tts_cache, cleanup_expired_tts_cache, TTS_BUCKET
-from cache_warmup import schedule_restaurant_rewarm
+from tts import invalidate_tts_cache, cleanup_expired_tts_cache, get_tts_engine_stats, TTS_BUCKET
+from cache_warmup import (
+    schedule_restaurant_rewarm,
+    get_prewarm_progress,
+    get_prewarm_job_stats,
+    invalidate_changed_restaurant_content,
+)
+from catalog import refresh_catalog_restaurants
+from queue_manager import get_queue_stats
+from memory_cache import all_cache_stats
+from write_behind import all_write_behind_stats
+from disk_cache import all_disk_cache_stats
+from tile_cache import get_tile_cache_stats
+from activity_tracker import (
+    ONLINE_WINDOW_SECONDS,
+    drain_recent_heatmap_hits,
+    get_heartbeat_stats,
+    get_online_presence,
+    set_recent_heatmap_hits_enabled,
+)
+from metrics_stream import MetricsStream
+from heatmap_store import HEATMAP_BASE_LEVEL, level_for_zoom, query_heatmap_cells, query_heatmap_window
 import os
 import json
 import uuid
@@ -16,45 +36,56 @@ import string
 import unicodedata
 import time
 from datetime import datetime
-from sqlalchemy import func, text
+from sqlalchemy import func
 from werkzeug.security import generate_password_hash
 from urllib.parse import urlencode
 from urllib.request import Request, urlopen
 
 def register_admin_routes(app):
-    online_window_seconds = int((os.getenv("HEARTBEAT_ONLINE_WINDOW_SECONDS") or "45").strip() or "45")
-    online_window_seconds = max(15, min(300, online_window_seconds))
+    online_window_seconds = ONLINE_WINDOW_SECONDS
+
+    metrics_stream_interval_seconds = float((os.getenv("ADMIN_METRICS_STREAM_INTERVAL_SECONDS") or "3").strip() or "3")
+    metrics_stream_interval_seconds = max(1.0, min(60.0, metrics_stream_interval_seconds))
+    metrics_stream_max_clients = int((os.getenv("ADMIN_METRICS_STREAM_MAX_CLIENTS") or "2").strip() or "2")
+    metrics_stream_max_clients = max(1, min(50, metrics_stream_max_clients))
+    metrics_stream_max_seconds = int((os.getenv("ADMIN_METRICS_STREAM_MAX_SECONDS") or "300").strip() or "300")
+    metrics_stream_max_seconds = max(30, min(3600, metrics_stream_max_seconds))
+    metrics_top_refresh_seconds = int((os.getenv("ADMIN_METRICS_TOP_REFRESH_SECONDS") or "30").strip() or "30")
+    metrics_top_refresh_seconds = max(5, min(3600, metrics_top_refresh_seconds))
 
     def invalidate_restaurant_content_cache(restaurant_id, reason="admin-crud"):
         try:
-            invalidate_translation_cache(cache_scope_id=restaurant_id)
+            refresh_catalog_restaurants([restaurant_id])
         except Exception:
             pass
+        # Chỉ bỏ cache của các field có source đổi; rewarm diff theo checksum.
         try:
-            invalidate_tts_cache(restaurant_id=restaurant_id)
+            invalidate_changed_restaurant_content(restaurant_id)
         except Exception:
             pass
         try:
             schedule_restaurant_rewarm(
                 restaurant_id,
                 reason=reason,
-                clear_existing=True,
                 flask_app=app,
             )
         except Exception:
             pass
 
     def invalidate_translation_for_restaurants(restaurant_ids, reason="admin-tag-update"):
+        try:
+            refresh_catalog_restaurants(restaurant_ids, include_tags=True)
+        except Exception:
+            pass
         for restaurant_id in sorted({rid for rid in (restaurant_ids or []) if rid is not None}):
             try:
-                invalidate_translation_cache(cache_scope_id=restaurant_id)
+                invalidate_changed_restaurant_content(restaurant_id)
             except Exception:
                 pass
             try:
                 schedule_restaurant_rewarm(
                     restaurant_id,
                     reason=reason,
-                    clear_existing=True,
                     flask_app=app,
                 )
             except Exception:
@@ -489,6 +520,49 @@ def register_admin_routes(app):
             }
         })
 
+    @app.route("/admin/queue/stats", methods=["GET"])
+    @admin_required
+    def queue_stats():
+        admin_only_error = require_admin_only()
+        if admin_only_error:
+            return admin_only_error
+
+        return jsonify({
+            "status": "success",
+            "queue": get_queue_stats(),
+            "tts_engine": get_tts_engine_stats(),
+            "heartbeat": get_heartbeat_stats(),
+            "metrics_stream": dashboard_metrics_stream.stats(),
+        })
+
+    @app.route("/admin/cache/stats", methods=["GET"])
+    @admin_required
+    def memory_cache_stats():
+        admin_only_error = require_admin_only()
+        if admin_only_error:
+            return admin_only_error
+
+        return jsonify({
+            "status": "success",
+            "caches": all_cache_stats(),
+            "write_behind": all_write_behind_stats(),
+            "disk": all_disk_cache_stats(),
+            "map_tiles": get_tile_cache_stats(),
+        })
+
+    @app.route("/admin/cache/prewarm-progress", methods=["GET"])
+    @admin_required
+    def prewarm_progress():
+        admin_only_error = require_admin_only()
+        if admin_only_error:
+            return admin_only_error
+
+        return jsonify({
+            "status": "success",
+            "runs": get_prewarm_progress(),
+            "jobs": get_prewarm_job_stats(),
+        })
+
     @app.route("/admin/cache/tts-health", methods=["GET"])
     @admin_required
     def tts_storage_health_check():
@@ -581,55 +655,87 @@ def register_admin_routes(app):
             return admin_only_error
 
         try:
-            counts_row = db.session.execute(
-                text(
-                    """
-                    SELECT
-                        COUNT(DISTINCT device_id)::int AS online_devices,
-                        COUNT(DISTINCT COALESCE(user_id::text, user_identity))::int AS online_users
-                    FROM user_activity
-                    WHERE last_seen > NOW() - (:window_seconds * INTERVAL '1 second')
-                    """
-                ),
-                {"window_seconds": online_window_seconds}
-            ).mappings().first() or {}
-
-            online_users_rows = db.session.execute(
-                text(
-                    """
-                    SELECT
-                        COALESCE(user_id::text, user_identity) AS online_identity,
-                        MAX(last_seen) AS last_seen,
-                        COUNT(DISTINCT device_id)::int AS device_count
-                    FROM user_activity
-                    WHERE COALESCE(user_id::text, user_identity) IS NOT NULL
-                      AND last_seen > NOW() - (:window_seconds * INTERVAL '1 second')
-                    GROUP BY COALESCE(user_id::text, user_identity)
-                    ORDER BY MAX(last_seen) DESC
-                    """
-                ),
-                {"window_seconds": online_window_seconds}
-            ).mappings().all()
-
-            online_user_list = [
-                {
-                    "user_id": row.get("online_identity"),
-                    "last_seen": row.get("last_seen").isoformat() if row.get("last_seen") else None,
-                    "device_count": int(row.get("device_count") or 0),
-                }
-                for row in online_users_rows
-            ]
-
+            presence = get_online_presence()
             return jsonify({
                 "status": "success",
                 "window_seconds": online_window_seconds,
-                "online_devices": int(counts_row.get("online_devices") or 0),
-                "online_users": int(counts_row.get("online_users") or 0),
-                "online_user_list": online_user_list,
+                **presence,
             })
         except Exception as exc:
             return jsonify({"status": "error", "message": f"online users query failed: {exc}"}), 500
 
+    top_restaurants_state = {"value": None, "refreshed_at": None}
+
+    def _collect_dashboard_metrics():
+        # Chạy trên thread producer của MetricsStream: 1 lần mỗi interval dù có bao nhiêu dashboard.
+        with app.app_context():
+            presence = get_online_presence()
+            state = {
+                "online": {
+                    "window_seconds": online_window_seconds,
+                    "online_devices": presence["online_devices"],
+                    "online_users": presence["online_users"],
+                },
+            }
+
+            now = time.monotonic()
+            refreshed_at = top_restaurants_state["refreshed_at"]
+            if refreshed_at is None or now - refreshed_at >= metrics_top_refresh_seconds:
+                try:
+                    top_restaurants_state["value"] = {
+                        "byVisits": _query_top_restaurants("visits", 5),
+                        "byDuration": _query_top_restaurants("duration", 5),
+                        "byAudio": _query_top_restaurants("audio", 5),
+                    }
+                except Exception as exc:
+                    db.session.rollback()
+                    print(f"[metrics-stream] top restaurants skipped: {exc}")
+                top_restaurants_state["refreshed_at"] = now
+            state["top_restaurants"] = top_restaurants_state["value"]
+
+        return state, {"heatmap": drain_recent_heatmap_hits()}
+
+    dashboard_metrics_stream = MetricsStream(
+        "admin_dashboard",
+        _collect_dashboard_metrics,
+        interval_seconds=metrics_stream_interval_seconds,
+        max_clients=metrics_stream_max_clients,
+        on_start=lambda: set_recent_heatmap_hits_enabled(True),
+        on_stop=lambda: set_recent_heatmap_hits_enabled(False),
+    )
+
+    @app.route("/admin/metrics/stream", methods=["GET"])
+    @app.route("/api/admin/metrics/stream", methods=["GET"])
+    @admin_required
+    def stream_dashboard_metrics():
+        """
+        Server-Sent Events cho dashboard admin:
+        - snapshot: trạng thái mới nhất khi vừa kết nối (online, top_restaurants)
+        - online / top_restaurants: chỉ gửi khi thay đổi
+        - heatmap: các cell vừa được đếm thêm [{lat, lng, hits}] kể từ khi stream chạy (client cộng
+          dồn vào heatmap "tất cả", bỏ qua khi đang xem theo cửa sổ thời gian). Với nhiều worker
+          gunicorn, mỗi stream chỉ thấy hit của worker phục vụ nó; heatmap đầy đủ vẫn lấy từ /admin/heatmap.
+        Stream tự đóng sau ADMIN_METRICS_STREAM_MAX_SECONDS; EventSource tự kết nối lại.
+        """
+        admin_only_error = require_admin_only()
+        if admin_only_error:
+            return admin_only_error
+
+        client = dashboard_metrics_stream.subscribe()
+        if client is None:
+            # Mỗi stream giữ 1 thread gunicorn: quá giới hạn thì client quay về polling.
+            return jsonify({"status": "error", "message": "Too many metrics streams"}), 503
+
+        response = Response(
+            dashboard_metrics_stream.iter_events(client, max_seconds=metrics_stream_max_seconds),
+            mimetype="text/event-stream",
+        )
+        response.headers["Cache-Control"] = "no-cache"
+        response.headers["X-Accel-Buffering"] = "no"
+        # Client ngắt trước khi stream bắt đầu thì generator không chạy finally: nhả slot ở đây.
+        response.call_on_close(lambda: dashboard_metrics_stream.unsubscribe(client))
+        return response
+
     # ======================
     # MENU CRUD
     # ======================
@@ -752,6 +858,10 @@ def register_admin_routes(app):
         
         db.session.add(tag)
         db.session.commit()
+        try:
+            refresh_catalog_restaurants([], include_tags=True)
+        except Exception:
+            pass
         
         return jsonify({
             "status": "success",
@@ -1096,27 +1206,54 @@ def register_admin_routes(app):
             limit = max(100, min(5000, limit))
             min_hits = max(1, min(1000, min_hits))
 
-            rows = db.session.execute(
-                text(
-                    """
-                    SELECT
-                        lat_bucket AS lat,
-                        lng_bucket AS lng,
-                        hit_count::double precision AS intensity,
-                        last_seen
-                    FROM user_activity_heatmap_cell
-                    WHERE hit_count >= :min_hits
-                    ORDER BY hit_count DESC, last_seen DESC
-                    LIMIT :limit
-                    """
-                ),
-                {
-                    "limit": limit,
-                    "min_hits": min_hits,
-                }
-            ).mappings().all()
+            # bbox=west,south,east,north (Leaflet toBBoxString) + zoom: trả cell của mức lưới hợp zoom
+            # trong khung nhìn. Không truyền thì giữ hành vi cũ (lưới gốc, toàn bộ).
+            level = HEATMAP_BASE_LEVEL
+            bbox = None
+            bbox_raw = (request.args.get("bbox") or "").strip()
+            if bbox_raw:
+                try:
+                    west, south, east, north = (float(part) for part in bbox_raw.split(","))
+                except ValueError:
+                    return jsonify({"status": "error", "message": "bbox must be west,south,east,north"}), 400
+                if not (west <= east and south <= north):
+                    return jsonify({"status": "error", "message": "bbox must be west,south,east,north"}), 400
+                # Leaflet có thể trả toạ độ vượt ±180 khi kéo bản đồ qua kinh tuyến đổi ngày.
+                bbox = (max(-180.0, west), max(-90.0, south), min(180.0, east), min(90.0, north))
+            zoom_raw = request.args.get("zoom")
+            if zoom_raw not in (None, ""):
+                try:
+                    level = level_for_zoom(max(0.0, min(22.0, float(zoom_raw))))
+                except ValueError:
+                    return jsonify({"status": "error", "message": "zoom must be a number"}), 400
+
+            # window_hours: chỉ đếm hit trong N giờ gần nhất (bucket theo giờ/ngày);
+            # decay_half_life_hours: hit cũ giảm trọng số theo nửa chu kỳ. Không truyền = tổng tích luỹ.
+            window_hours = None
+            half_life_hours = None
+            try:
+                if request.args.get("window_hours") not in (None, ""):
+                    window_hours = max(1, min(24 * 3650, int(request.args.get("window_hours"))))
+                if request.args.get("decay_half_life_hours") not in (None, ""):
+                    half_life_hours = max(0.1, min(24.0 * 365, float(request.args.get("decay_half_life_hours"))))
+            except ValueError:
+                return jsonify({"status": "error", "message": "window_hours / decay_half_life_hours must be numbers"}), 400
+            if half_life_hours is not None and window_hours is None:
+                window_hours = 24 * 3650
+
+            if window_hours is not None:
+                rows = query_heatmap_window(
+                    level,
+                    window_hours,
+                    limit,
+                    min_hits=min_hits,
+                    bbox=bbox,
+                    half_life_hours=half_life_hours,
+                )
+            else:
+                rows = query_heatmap_cells(level, limit, min_hits=min_hits, bbox=bbox)
 
-            return jsonify([
+            response = jsonify([
                 {
                     "lat": float(row.get("lat")),
                     "lng": float(row.get("lng")),
@@ -1125,11 +1262,79 @@ def register_admin_routes(app):
                 for row in rows
                 if row.get("lat") is not None and row.get("lng") is not None
             ])
+            response.headers["X-Heatmap-Grid-Level"] = str(level)
+            return response
         except Exception as e:
             print(f"Error in get_heatmap_data: {str(e)}")
             # Return empty array if table doesn't exist yet
             return jsonify([])
 
+    def _query_top_restaurants(metric, limit):
+        """Top restaurants by visits / duration / audio, calculated from location_visit and restaurant analytics."""
+        if metric == 'visits':
+            # Top by visit count (number of location_visit records)
+            results = db.session.query(
+                Restaurant.id,
+                Restaurant.name,
+                func.count(LocationVisit.id).label('visit_count')
+            ).join(
+                LocationVisit, Restaurant.id == LocationVisit.restaurant_id
+            ).filter(
+                Restaurant.is_active == True
+            ).group_by(
+                Restaurant.id, Restaurant.name
+            ).order_by(
+                func.count(LocationVisit.id).desc()
+            ).limit(limit).all()
+
+            return [{
+                'id': r.id,
+                'name': r.name,
+                'visit_count': r.visit_count
+            } for r in results]
+
+        elif metric == 'duration':
+            # Top by average visit duration from restaurant analytics (stored in seconds).
+            # This is more stable than aggregating raw location_visit rows, because
+            # analytics is updated during tracking flow and already normalized per restaurant.
+            results = db.session.query(
+                Restaurant.id,
+                Restaurant.name,
+                Restaurant.avg_visit_duration
+            ).filter(
+                Restaurant.is_active == True,
+                Restaurant.avg_visit_duration > 0
+            ).order_by(
+                Restaurant.avg_visit_duration.desc()
+            ).limit(limit).all()
+
+            return [{
+                'id': r.id,
+                'name': r.name,
+                'avg_visit_duration': round((r.avg_visit_duration or 0) / 60.0, 1)
+            } for r in results]
+
+        elif metric == 'audio':
+            # Top by average audio duration (from restaurant table)
+            results = db.session.query(
+                Restaurant.id,
+                Restaurant.name,
+                Restaurant.avg_audio_duration
+            ).filter(
+                Restaurant.is_active == True,
+                Restaurant.avg_audio_duration > 0
+            ).order_by(
+                Restaurant.avg_audio_duration.desc()
+            ).limit(limit).all()
+
+            return [{
+                'id': r.id,
+                'name': r.name,
+                'avg_audio_duration': r.avg_audio_duration
+            } for r in results]
+
+        return []
+
     @app.route("/admin/restaurants/top", methods=["GET"])
     @admin_required
     def get_top_restaurants():
@@ -1141,79 +1346,8 @@ def register_admin_routes(app):
         try:
             metric = request.args.get('metric', 'visits')  # visits, duration, audio
             limit = int(request.args.get('limit', 5))
-            
-            # Base query for active restaurants with visits
-            base_query = db.session.query(
-                Restaurant.id,
-                Restaurant.name,
-                Restaurant.lat,
-                Restaurant.lng
-            ).filter(Restaurant.is_active == True)
-            
-            if metric == 'visits':
-                # Top by visit count (number of location_visit records)
-                results = db.session.query(
-                    Restaurant.id,
-                    Restaurant.name,
-                    func.count(LocationVisit.id).label('visit_count')
-                ).join(
-                    LocationVisit, Restaurant.id == LocationVisit.restaurant_id
-                ).filter(
-                    Restaurant.is_active == True
-                ).group_by(
-                    Restaurant.id, Restaurant.name
-                ).order_by(
-                    func.count(LocationVisit.id).desc()
-                ).limit(limit).all()
-                
-                return jsonify([{
-                    'id': r.id,
-                    'name': r.name,
-                    'visit_count': r.visit_count
-                } for r in results])
-                
-            elif metric == 'duration':
-                # Top by average visit duration from restaurant analytics (stored in seconds).
-                # This is more stable than aggregating raw location_visit rows, because
-                # analytics is updated during tracking flow and already normalized per restaurant.
-                results = db.session.query(
-                    Restaurant.id,
-                    Restaurant.name,
-                    Restaurant.avg_visit_duration
-                ).filter(
-                    Restaurant.is_active == True,
-                    Restaurant.avg_visit_duration > 0
-                ).order_by(
-                    Restaurant.avg_visit_duration.desc()
-                ).limit(limit).all()
-                
-                return jsonify([{
-                    'id': r.id,
-                    'name': r.name,
-                    'avg_visit_duration': round((r.avg_visit_duration or 0) / 60.0, 1)
-                } for r in results])
-                
-            elif metric == 'audio':
-                # Top by average audio duration (from restaurant table)
-                results = db.session.query(
-                    Restaurant.id,
-                    Restaurant.name,
-                    Restaurant.avg_audio_duration
-                ).filter(
-                    Restaurant.is_active == True,
-                    Restaurant.avg_audio_duration > 0
-                ).order_by(
-                    Restaurant.avg_audio_duration.desc()
-                ).limit(limit).all()
-                
-                return jsonify([{
-                    'id': r.id,
-                    'name': r.name,
-                    'avg_audio_duration': r.avg_audio_duration
-                } for r in results])
-            
-            return jsonify([])
-            
+            return jsonify(_query_top_restaurants(metric, limit))
+
         except Exception as e:
             print(f"Error in get_top_restaurants: {str(e)}")
             import traceback
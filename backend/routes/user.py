@@ -1,41 +1,135 @@
-from flask import request, jsonify, current_app, session
-from models import Restaurant, Tag, LocationVisit, db
-from services import calculate_distance, generate_narration
+from flask import request, jsonify, current_app, session, Response
+from models import Restaurant, LocationVisit, db
+from services import generate_narration, haversine_distances
 from translate import translate_text, translate_texts, LANGUAGE_LABELS
 from tts import text_to_speech
-from queue_manager import add_to_queue, QueueFullError
-from sqlalchemy import and_, or_, text, func
+from queue_manager import add_to_queue, submit_job, get_job_status, wait_for_job, QueueFullError
+from catalog import get_catalog_snapshot, get_restaurant_analytics, with_restaurant_analytics
+from response_cache import prerender_json, prerendered_response
+from memory_cache import SegmentedLRUCache
+from activity_tracker import record_heartbeat
+from sqlalchemy import and_, or_, text
 from threading import Lock
 import copy
 import hashlib
 import json
 import uuid
 import math
+import time
 import os
-from datetime import datetime, timedelta, timezone
+from datetime import datetime
 
 
-_RESTAURANT_TRANSLATION_CACHE = {}
-_RESTAURANT_CACHE_LOCK = Lock()
 _RESTAURANT_CACHE_MAX_ITEMS = 5000
+_RESTAURANT_CACHE_MAX_BYTES = int((os.getenv("RESTAURANT_TRANSLATION_CACHE_MAX_BYTES") or "33554432").strip() or "33554432")
+_RESTAURANT_CACHE_MAX_BYTES = max(1024 * 1024, _RESTAURANT_CACHE_MAX_BYTES)
+# Payload dịch cache-only (allow_network=False) có thể còn field tiếng Việt, TTL để lần sau dịch đủ.
+_RESTAURANT_CACHE_TTL_SECONDS = int((os.getenv("RESTAURANT_TRANSLATION_CACHE_TTL_SECONDS") or "1800").strip() or "1800")
+_RESTAURANT_CACHE_TTL_SECONDS = max(60, min(86400, _RESTAURANT_CACHE_TTL_SECONDS))
+_RESTAURANT_TRANSLATION_CACHE = SegmentedLRUCache(
+    "restaurant_translation",
+    max_items=_RESTAURANT_CACHE_MAX_ITEMS,
+    max_bytes=_RESTAURANT_CACHE_MAX_BYTES,
+    ttl_seconds=_RESTAURANT_CACHE_TTL_SECONDS,
+)
+_RESTAURANT_LIST_RENDERS = {}
+_RESTAURANT_LIST_RENDER_LOCKS = {}
+_RESTAURANT_LIST_RENDER_LOCK = Lock()
+# Bản dịch có thể fallback về tiếng Việt khi provider lỗi, nên render non-vi được làm lại định kỳ.
+_RESTAURANT_LIST_TRANSLATED_TTL_SECONDS = int((os.getenv("RESTAURANT_LIST_TRANSLATED_TTL_SECONDS") or "300").strip() or "300")
+_RESTAURANT_LIST_TRANSLATED_TTL_SECONDS = max(30, min(86400, _RESTAURANT_LIST_TRANSLATED_TTL_SECONDS))
+# Long-poll/SSE chờ audio job: giới hạn thời gian giữ 1 request thread.
+_AUDIO_LONG_POLL_MAX_SECONDS = int((os.getenv("AUDIO_LONG_POLL_MAX_SECONDS") or "20").strip() or "20")
+_AUDIO_LONG_POLL_MAX_SECONDS = max(1, min(60, _AUDIO_LONG_POLL_MAX_SECONDS))
+_AUDIO_SSE_KEEPALIVE_SECONDS = 10
 _DEMO_ORDER_LOCK = Lock()
 _DEMO_ORDER_SEQUENCE = 0
 _DEMO_ORDERS = []
 
 
 def _cache_restaurant_payload(signature, payload):
-    with _RESTAURANT_CACHE_LOCK:
-        if len(_RESTAURANT_TRANSLATION_CACHE) >= _RESTAURANT_CACHE_MAX_ITEMS:
-            _RESTAURANT_TRANSLATION_CACHE.clear()
-        _RESTAURANT_TRANSLATION_CACHE[signature] = payload
+    _RESTAURANT_TRANSLATION_CACHE.set(signature, payload)
 
 
 def _get_restaurant_payload_from_cache(signature):
-    with _RESTAURANT_CACHE_LOCK:
-        cached = _RESTAURANT_TRANSLATION_CACHE.get(signature)
+    cached = _RESTAURANT_TRANSLATION_CACHE.get(signature)
     return copy.deepcopy(cached) if cached is not None else None
 
 
+def _audio_job_payload(job_status):
+    audio_status = {"queued": "pending", "running": "pending", "done": "ready"}.get(job_status["status"], "failed")
+    result = job_status.get("result")
+    audio_url, audio_language = result if isinstance(result, tuple) else (result, None)
+    return {
+        "status": "success",
+        "job_id": job_status["job_id"],
+        "audio_status": audio_status,
+        "audio_url": audio_url,
+        "audio_language": audio_language,
+        "queue_position": job_status.get("queue_position"),
+    }
+
+
+def _restaurant_list_render_is_fresh(entry, render_version, target_lang):
+    if entry is None or entry[0] != render_version:
+        return False
+    if target_lang == "vi":
+        return True
+    return (time.time() - entry[1].rendered_at) < _RESTAURANT_LIST_TRANSLATED_TTL_SECONDS
+
+
+def _restaurant_list_lang(raw_lang):
+    """Supported language code for the pre-rendered list ("en-US" -> "en"); unknown codes fall back to "vi"."""
+    code = str(raw_lang or "").strip().replace("_", "-").lower()
+    if code in LANGUAGE_LABELS:
+        return code
+    base = code.split("-", 1)[0]
+    return base if base in LANGUAGE_LABELS else "vi"
+
+
+def _get_restaurant_list_render(target_lang):
+    """Pre-rendered /restaurants body for the current catalogue version and language."""
+    # Chỉ ngôn ngữ hỗ trợ mới thành key cache render: lang tuỳ ý không tạo thêm bản render toàn catalogue.
+    target_lang = _restaurant_list_lang(target_lang)
+    snapshot = get_catalog_snapshot()
+    analytics_version, analytics = get_restaurant_analytics()
+    # Bộ đếm analytics có version riêng: lượt ghé mới chỉ render lại khi map bộ đếm được nạp lại (theo TTL).
+    render_version = (snapshot.version, analytics_version)
+    with _RESTAURANT_LIST_RENDER_LOCK:
+        entry = _RESTAURANT_LIST_RENDERS.get(target_lang)
+        if _restaurant_list_render_is_fresh(entry, render_version, target_lang):
+            return entry[1]
+        lang_lock = _RESTAURANT_LIST_RENDER_LOCKS.setdefault(target_lang, Lock())
+
+    # Mỗi ngôn ngữ render 1 lần; request đồng thời cùng ngôn ngữ chờ kết quả thay vì dịch lại.
+    with lang_lock:
+        with _RESTAURANT_LIST_RENDER_LOCK:
+            entry = _RESTAURANT_LIST_RENDERS.get(target_lang)
+        if _restaurant_list_render_is_fresh(entry, render_version, target_lang):
+            return entry[1]
+
+        restaurant_payloads = list(snapshot.restaurants)
+        if target_lang != "vi":
+            restaurant_payloads = [
+                _translate_restaurant_data(payload, target_lang)
+                for payload in restaurant_payloads
+            ]
+        # Ghép bộ đếm sau khi dịch: chúng không nằm trong chữ ký cache bản dịch.
+        restaurant_payloads = [
+            with_restaurant_analytics(payload, analytics) for payload in restaurant_payloads
+        ]
+
+        rendered = prerender_json(
+            {"status": "success", "restaurants": restaurant_payloads},
+            last_modified=snapshot.built_at,
+            previous=entry[1] if entry is not None else None,
+        )
+
+        with _RESTAURANT_LIST_RENDER_LOCK:
+            _RESTAURANT_LIST_RENDERS[target_lang] = (render_version, rendered)
+        return rendered
+
+
 def _build_restaurant_translation_signature(restaurant_data, target_lang):
     source = json.dumps(
         {"lang": target_lang, "restaurant": restaurant_data},
@@ -121,25 +215,6 @@ def _translate_restaurant_data(restaurant_data, target_lang, allow_network=True)
 
 
 def register_user_routes(app):
-    heatmap_cooldown_seconds = int((os.getenv("HEATMAP_SPAM_COOLDOWN_SECONDS") or "12").strip() or "12")
-    heatmap_cooldown_seconds = max(3, min(300, heatmap_cooldown_seconds))
-
-    heatmap_min_move_meters = float((os.getenv("HEATMAP_SPAM_MIN_MOVE_METERS") or "20").strip() or "20")
-    heatmap_min_move_meters = max(0.0, min(1000.0, heatmap_min_move_meters))
-
-    def _distance_meters(lat1, lng1, lat2, lng2):
-        r = 6371000.0
-        phi1 = math.radians(lat1)
-        phi2 = math.radians(lat2)
-        delta_phi = math.radians(lat2 - lat1)
-        delta_lambda = math.radians(lng2 - lng1)
-        a = (
-            math.sin(delta_phi / 2.0) ** 2
-            + math.cos(phi1) * math.cos(phi2) * math.sin(delta_lambda / 2.0) ** 2
-        )
-        c = 2.0 * math.atan2(math.sqrt(a), math.sqrt(1.0 - a))
-        return r * c
-
     def _parse_coordinate(raw_value, min_value, max_value, field_name):
         if raw_value is None or str(raw_value).strip() == "":
             return None
@@ -164,19 +239,6 @@ def register_user_routes(app):
 
         return identity
 
-    def _user_profile_exists(candidate_user_id):
-        if not candidate_user_id:
-            return False
-        try:
-            found = db.session.execute(
-                text("SELECT 1 FROM user_profile WHERE id = :user_id LIMIT 1"),
-                {"user_id": candidate_user_id}
-            ).first()
-            return found is not None
-        except Exception:
-            # Keep heartbeat path resilient if schema differs across environments.
-            return False
-
     @app.route("/heartbeat", methods=["POST"])
     @app.route("/api/heartbeat", methods=["POST"])
     def heartbeat():
@@ -201,7 +263,6 @@ def register_user_routes(app):
         user_id_provided = "user_id" in data
         raw_user_id = data.get("user_id")
         user_id = None
-        user_identity = None
 
         if raw_user_id is not None and str(raw_user_id).strip() != "":
             try:
@@ -211,17 +272,6 @@ def register_user_routes(app):
                 user_id_provided = False
                 user_id = None
 
-        if user_id and not _user_profile_exists(user_id):
-            # Avoid FK violations on user_activity.user_id when client sends unknown UUID.
-            user_id = None
-            user_id_provided = False
-
-        session_identity = _derive_session_user_identity()
-        if user_id_provided and user_id:
-            user_identity = f"user_profile:{user_id}"
-        else:
-            user_identity = session_identity
-
         try:
             heartbeat_lat = _parse_coordinate(data.get("latitude"), -90.0, 90.0, "latitude")
             heartbeat_lng = _parse_coordinate(data.get("longitude"), -180.0, 180.0, "longitude")
@@ -231,186 +281,29 @@ def register_user_routes(app):
         if (heartbeat_lat is None) != (heartbeat_lng is None):
             return jsonify({"status": "error", "message": "latitude and longitude must be provided together"}), 400
 
-        try:
-            # Bước 1: update heartbeat cho device đã tồn tại.
-            set_clauses = ["last_seen = NOW()"]
-            update_params = {"device_id": device_id, "user_identity": user_identity}
-
-            if user_id_provided:
-                set_clauses.append("user_id = :user_id")
-                update_params["user_id"] = user_id
-            else:
-                # Ensure logged-out devices are not counted as online users.
-                set_clauses.append("user_id = NULL")
-
-            set_clauses.append("user_identity = :user_identity")
-
-            if heartbeat_lat is not None and heartbeat_lng is not None:
-                set_clauses.extend([
-                    "last_lat = :last_lat",
-                    "last_lng = :last_lng",
-                ])
-                update_params["last_lat"] = heartbeat_lat
-                update_params["last_lng"] = heartbeat_lng
-
-            update_sql = text(
-                f"""
-                UPDATE user_activity
-                SET {', '.join(set_clauses)}
-                WHERE device_id = :device_id
-                RETURNING id, device_id, user_id, last_seen
-                """
-            )
-
-            updated_rows = db.session.execute(update_sql, update_params).mappings().all()
-
-            # Bước 2: nếu chưa có device thì insert mới.
-            if updated_rows:
-                row = dict(updated_rows[0])
-                action = "updated"
-
-                # Historical environments may contain duplicate rows for one device_id.
-                # Keep one canonical row and remove duplicates so online counters stay stable.
-                if len(updated_rows) > 1:
-                    keep_id = row.get("id")
-                    if keep_id:
-                        db.session.execute(
-                            text(
-                                """
-                                DELETE FROM user_activity
-                                WHERE device_id = :device_id
-                                  AND id <> :keep_id
-                                """
-                            ),
-                            {
-                                "device_id": device_id,
-                                "keep_id": keep_id,
-                            }
-                        )
-                        action = "deduplicated_updated"
-            else:
-                inserted_row = db.session.execute(
-                    text(
-                        """
-                        INSERT INTO user_activity (device_id, user_id, user_identity, last_seen, last_lat, last_lng)
-                        VALUES (:device_id, :user_id, :user_identity, NOW(), :last_lat, :last_lng)
-                        RETURNING id, device_id, user_id, user_identity, last_seen
-                        """
-                    ),
-                    {
-                        "device_id": device_id,
-                        "user_id": user_id,
-                        "user_identity": user_identity,
-                        "last_lat": heartbeat_lat,
-                        "last_lng": heartbeat_lng,
-                    }
-                ).mappings().first()
-
-                row = dict(inserted_row or {})
-                action = "inserted"
-
-            heatmap_counted = False
-            if heartbeat_lat is not None and heartbeat_lng is not None:
-                try:
-                    state_row = db.session.execute(
-                        text(
-                            """
-                            SELECT last_counted_at, last_lat, last_lng
-                            FROM user_activity_heatmap_device_state
-                            WHERE device_id = :device_id
-                            """
-                        ),
-                        {"device_id": device_id}
-                    ).mappings().first()
-
-                    should_count = True
-                    if state_row:
-                        last_counted_at = state_row.get("last_counted_at")
-                        last_lat = state_row.get("last_lat")
-                        last_lng = state_row.get("last_lng")
-
-                        cooldown_passed = True
-                        if last_counted_at is not None:
-                            if last_counted_at.tzinfo is None:
-                                last_counted_at = last_counted_at.replace(tzinfo=timezone.utc)
-                            cooldown_passed = (datetime.now(timezone.utc) - last_counted_at) >= timedelta(seconds=heatmap_cooldown_seconds)
-
-                        moved_enough = False
-                        if last_lat is not None and last_lng is not None:
-                            moved_enough = _distance_meters(
-                                float(last_lat),
-                                float(last_lng),
-                                float(heartbeat_lat),
-                                float(heartbeat_lng),
-                            ) >= heatmap_min_move_meters
-
-                        should_count = cooldown_passed or moved_enough
-
-                    if should_count:
-                        lat_bucket = round(float(heartbeat_lat), 4)
-                        lng_bucket = round(float(heartbeat_lng), 4)
-
-                        db.session.execute(
-                            text(
-                                """
-                                INSERT INTO user_activity_heatmap_cell (lat_bucket, lng_bucket, hit_count, last_seen)
-                                VALUES (:lat_bucket, :lng_bucket, 1, NOW())
-                                ON CONFLICT (lat_bucket, lng_bucket)
-                                DO UPDATE
-                                SET hit_count = user_activity_heatmap_cell.hit_count + 1,
-                                    last_seen = NOW()
-                                """
-                            ),
-                            {
-                                "lat_bucket": lat_bucket,
-                                "lng_bucket": lng_bucket,
-                            }
-                        )
-                        heatmap_counted = True
-
-                    db.session.execute(
-                        text(
-                            """
-                            INSERT INTO user_activity_heatmap_device_state (device_id, user_id, last_counted_at, last_lat, last_lng, updated_at)
-                            VALUES (:device_id, :user_id, :last_counted_at, :last_lat, :last_lng, NOW())
-                            ON CONFLICT (device_id)
-                            DO UPDATE
-                            SET user_id = EXCLUDED.user_id,
-                                last_counted_at = EXCLUDED.last_counted_at,
-                                last_lat = EXCLUDED.last_lat,
-                                last_lng = EXCLUDED.last_lng,
-                                updated_at = NOW()
-                            """
-                        ),
-                        {
-                            "device_id": device_id,
-                            "user_id": user_id,
-                            "last_counted_at": datetime.now(timezone.utc) if heatmap_counted else (state_row or {}).get("last_counted_at"),
-                            "last_lat": heartbeat_lat if heatmap_counted else (state_row or {}).get("last_lat"),
-                            "last_lng": heartbeat_lng if heatmap_counted else (state_row or {}).get("last_lng"),
-                        }
-                    )
-                except Exception as heatmap_exc:
-                    current_app.logger.warning("heartbeat heatmap write skipped: %s", heatmap_exc)
-
-            db.session.commit()
+        # Chỉ ghi vào buffer trong bộ nhớ; activity_tracker flush theo lô xuống DB.
+        beat = record_heartbeat(
+            current_app._get_current_object(),
+            device_id,
+            user_id=user_id if user_id_provided else None,
+            session_identity=_derive_session_user_identity(),
+            lat=heartbeat_lat,
+            lng=heartbeat_lng,
+        )
 
-            return jsonify({
-                "status": "success",
-                "action": action,
-                "heartbeat": {
-                    "id": row.get("id"),
-                    "device_id": row.get("device_id"),
-                    "user_id": str(row.get("user_id")) if row.get("user_id") else None,
-                    "user_identity": row.get("user_identity") if row.get("user_identity") else user_identity,
-                    "last_seen": row.get("last_seen").isoformat() if row.get("last_seen") else None,
-                    "has_location": heartbeat_lat is not None and heartbeat_lng is not None,
-                    "heatmap_counted": heatmap_counted,
-                }
-            })
-        except Exception as exc:
-            db.session.rollback()
-            return jsonify({"status": "error", "message": f"heartbeat failed: {exc}"}), 500
+        return jsonify({
+            "status": "success",
+            "action": "buffered",
+            "heartbeat": {
+                "id": None,
+                "device_id": device_id,
+                "user_id": beat["user_id"],
+                "user_identity": beat["user_identity"],
+                "last_seen": beat["seen_at"].isoformat(),
+                "has_location": heartbeat_lat is not None and heartbeat_lng is not None,
+                "heatmap_counted": beat["heatmap_counted"],
+            }
+        })
 
     @app.route("/languages", methods=["GET"])
     def get_languages():
@@ -484,27 +377,14 @@ def register_user_routes(app):
     def get_restaurants():
         """Lấy danh sách tất cả quán đang active với tags và images"""
         target_lang = request.args.get('lang', 'vi')
-        restaurants = Restaurant.query.filter_by(is_active=True).all()
-        restaurant_payloads = [r.to_dict(include_details=True) for r in restaurants]
-
-        if target_lang != 'vi':
-            restaurant_payloads = [
-                _translate_restaurant_data(payload, target_lang)
-                for payload in restaurant_payloads
-            ]
-
-        return jsonify({
-            "status": "success",
-            "restaurants": restaurant_payloads
-        })
+        return prerendered_response(_get_restaurant_list_render(target_lang))
 
     @app.route("/tags", methods=["GET"])
     def get_tags():
         """Lấy danh sách tags với translation support (public endpoint)"""
         target_lang = request.args.get('lang', 'vi')
-        tags = Tag.query.all()
-
-        tags_data = [tag.to_dict() for tag in tags]
+        # Copy từng tag vì bản dịch ghi đè field ngay trên dict.
+        tags_data = [dict(tag) for tag in get_catalog_snapshot().tags]
 
         if target_lang != 'vi':
             texts = []
@@ -546,34 +426,38 @@ def register_user_routes(app):
         user_lng = data.get("longitude")
         language = data.get("language", "vi")
         allow_network_translation = bool(data.get("allow_network_translation", False))
+        # async_audio: trả về ngay với audio_job_id, audio URL lấy qua long-poll/SSE.
+        async_audio = bool(data.get("async_audio", False))
 
-        restaurants = Restaurant.query.filter_by(is_active=True).all()
-
-        nearest = None
-        min_dist = float("inf")
+        try:
+            user_lat = float(user_lat)
+            user_lng = float(user_lng)
+        except (TypeError, ValueError):
+            return jsonify({"status": "error", "message": "latitude and longitude are required"}), 400
 
-        for r in restaurants:
-            dist = calculate_distance(user_lat, user_lng, r.lat, r.lng)
-            if dist < min_dist:
-                min_dist = dist
-                nearest = r
+        # Tra quán gần nhất qua spatial index của catalogue snapshot, không query DB.
+        snapshot = get_catalog_snapshot()
+        nearest_id, min_dist = snapshot.spatial_index.nearest(user_lat, user_lng)
+        nearest = snapshot.get(nearest_id) if nearest_id is not None else None
+        if nearest is None:
+            return jsonify({"status": "error", "message": "No active restaurant found"}), 404
 
         narration_vi = generate_narration(nearest, min_dist)
         narration_final = translate_text(
             narration_vi,
             language,
-            cache_scope_id=nearest.id,
+            cache_scope_id=nearest_id,
             cache_note="restaurant_narration",
-            cache_logical_key=f"restaurant:{nearest.id}:narration",
+            cache_logical_key=f"restaurant:{nearest_id}:narration",
         )
 
         def _build_audio_url():
-            primary = text_to_speech(narration_final, language, restaurant_id=nearest.id)
+            primary = text_to_speech(narration_final, language, restaurant_id=nearest_id)
             if primary:
                 return primary, language
 
             if language != "en":
-                fallback_en = text_to_speech(narration_final, "en", restaurant_id=nearest.id)
+                fallback_en = text_to_speech(narration_final, "en", restaurant_id=nearest_id)
                 if fallback_en:
                     return fallback_en, "en"
 
@@ -581,32 +465,42 @@ def register_user_routes(app):
 
         # Queue theo restaurant để hạn chế đồng thời khi nhiều người cùng nghe audio.
         try:
-            audio_url, queue_meta = add_to_queue(
-                nearest.id,
-                _build_audio_url,
-                include_meta=True,
-            )
+            # Cả đoàn khách tới cùng POI: gộp các job TTS giống hệt nhau thành 1 lần chạy.
+            narration_hash = hashlib.sha256(narration_final.encode("utf-8")).hexdigest()
+            coalesce_key = ("narration_audio", language, narration_hash)
+            audio_job_id = None
+            if async_audio:
+                audio_job_id, coalesced = submit_job(nearest_id, _build_audio_url, coalesce_key=coalesce_key)
+                audio_url = (None, None)
+                queue_meta = {"coalesced": coalesced}
+            else:
+                audio_url, queue_meta = add_to_queue(
+                    nearest_id,
+                    _build_audio_url,
+                    include_meta=True,
+                    coalesce_key=coalesce_key,
+                )
         except QueueFullError:
             return jsonify({
                 "status": "error",
                 "message": "Too Many Requests: queue is full for this restaurant"
             }), 429
         
-        # Lấy bán kính POI từ database (mặc định 0.030 km nếu không có)
-        poi_radius = nearest.poi_radius_km if hasattr(nearest, 'poi_radius_km') and nearest.poi_radius_km else 0.030
+        # Lấy bán kính POI của quán (mặc định 0.030 km nếu không có)
+        poi_radius = nearest.get("poi_radius_km") or 0.030
         
         # Message khi chưa đến gần quán
-        out_of_range_msg_vi = f'🚶 Bạn hãy tới gần quán "{nearest.name}" để nghe thuyết minh'
+        out_of_range_msg_vi = f'🚶 Bạn hãy tới gần quán "{nearest["name"]}" để nghe thuyết minh'
         out_of_range_msg = translate_text(
             out_of_range_msg_vi,
             language,
-            cache_scope_id=nearest.id,
+            cache_scope_id=nearest_id,
             cache_note="restaurant_proximity_hint",
-            cache_logical_key=f"restaurant:{nearest.id}:proximity_hint",
+            cache_logical_key=f"restaurant:{nearest_id}:proximity_hint",
         )
 
         # Get restaurant data and reuse cached translation if unchanged.
-        restaurant_data = nearest.to_dict(include_details=True)
+        restaurant_data = nearest
         if language != 'vi':
             # /location defaults to cache-only for tracking performance.
             # Marker-click flow can opt in network translation for complete translated fields.
@@ -615,6 +509,7 @@ def register_user_routes(app):
                 language,
                 allow_network=allow_network_translation,
             )
+        restaurant_data = with_restaurant_analytics(restaurant_data, get_restaurant_analytics()[1])
 
         return jsonify({
             "status": "success",
@@ -624,12 +519,57 @@ def register_user_routes(app):
             "audio_language": audio_url[1] if isinstance(audio_url, tuple) else language,
             "queue_wait_ms": queue_meta.get("queue_wait_ms", 0),
             "queue_position": queue_meta.get("queue_position", 1),
+            "queue_coalesced": queue_meta.get("coalesced", False),
+            "audio_job_id": audio_job_id,
+            "audio_status": "pending" if audio_job_id else ("ready" if audio_url[0] else "failed"),
             "distance_km": round(min_dist, 3),
             "poi_radius_km": poi_radius,
             "nearest_place": restaurant_data,
             "out_of_range_message": out_of_range_msg
         })
 
+    @app.route("/location/audio/<job_id>", methods=["GET"])
+    def get_location_audio(job_id):
+        """Long-poll audio job của /location (async_audio); ?wait=N giây, 0 = trả ngay."""
+        try:
+            wait_seconds = float(request.args.get("wait", 0))
+        except (TypeError, ValueError):
+            wait_seconds = 0
+        wait_seconds = max(0.0, min(float(_AUDIO_LONG_POLL_MAX_SECONDS), wait_seconds))
+
+        job_status = wait_for_job(job_id, wait_seconds) if wait_seconds > 0 else get_job_status(job_id)
+        if job_status is None:
+            return jsonify({"status": "error", "message": "Audio job not found or expired"}), 404
+        return jsonify(_audio_job_payload(job_status))
+
+    @app.route("/location/audio/<job_id>/events", methods=["GET"])
+    def stream_location_audio(job_id):
+        """Server-Sent Events: 1 event `audio` khi job xong (hoặc `timeout`), rồi đóng stream."""
+        if get_job_status(job_id) is None:
+            return jsonify({"status": "error", "message": "Audio job not found or expired"}), 404
+
+        def _events():
+            deadline = time.monotonic() + _AUDIO_LONG_POLL_MAX_SECONDS
+            while True:
+                remaining = deadline - time.monotonic()
+                job_status = wait_for_job(job_id, min(_AUDIO_SSE_KEEPALIVE_SECONDS, max(0.0, remaining)))
+                if job_status is None:
+                    yield "event: error\ndata: {\"message\": \"Audio job expired\"}\n\n"
+                    return
+                if job_status["status"] in ("done", "failed"):
+                    yield f"event: audio\ndata: {json.dumps(_audio_job_payload(job_status), ensure_ascii=False)}\n\n"
+                    return
+                if remaining <= 0:
+                    # Client mở lại stream (EventSource tự reconnect) nếu vẫn cần chờ.
+                    yield f"event: timeout\ndata: {json.dumps(_audio_job_payload(job_status), ensure_ascii=False)}\n\n"
+                    return
+                yield ": keep-alive\n\n"
+
+        response = Response(_events(), mimetype="text/event-stream")
+        response.headers["Cache-Control"] = "no-cache"
+        response.headers["X-Accel-Buffering"] = "no"
+        return response
+
     @app.route("/orders", methods=["POST"])
     def create_order():
         """
@@ -715,7 +655,9 @@ def register_user_routes(app):
             
             # Bước 1: Lấy toàn bộ quán active (không loại cứng theo tag).
             # Tag preference sẽ được xử lý bằng heuristic scoring ở bước sau.
-            restaurants = Restaurant.query.filter_by(is_active=True).all()
+            snapshot = get_catalog_snapshot()
+            analytics = get_restaurant_analytics()[1]
+            restaurants = [with_restaurant_analytics(restaurant, analytics) for restaurant in snapshot.restaurants]
             
             if not restaurants:
                 return jsonify({
@@ -723,25 +665,8 @@ def register_user_routes(app):
                     "message": "Không tìm thấy quán phù hợp với tiêu chí"
                 })
             
-            # Bước 2: Tính giá trung bình menu theo từng quán (aggregate 1 lần)
-            from models import MenuItem
-
-            restaurant_ids = [r.id for r in restaurants]
-            avg_price_rows = (
-                db.session.query(
-                    MenuItem.restaurant_id,
-                    func.avg(MenuItem.price).label("avg_price"),
-                )
-                .filter(MenuItem.restaurant_id.in_(restaurant_ids))
-                .group_by(MenuItem.restaurant_id)
-                .all()
-            )
-
-            avg_price_by_restaurant = {
-                int(row.restaurant_id): float(row.avg_price)
-                for row in avg_price_rows
-                if row.restaurant_id is not None and row.avg_price is not None
-            }
+            # Bước 2: Giá trung bình menu theo từng quán (đã tính sẵn trong catalogue snapshot)
+            avg_price_by_restaurant = snapshot.avg_menu_price_by_id
 
             # Fallback mềm khi quán chưa có menu: dùng mặt bằng trung bình hiện có.
             global_avg_price = (
@@ -750,17 +675,27 @@ def register_user_routes(app):
                 else 50000
             )
 
+            # Khoảng cách user -> mọi quán tính 1 lần theo batch.
+            distances_from_user = None
+            if user_lat and user_lng:
+                distances_from_user = haversine_distances(
+                    user_lat,
+                    user_lng,
+                    [restaurant["lat"] for restaurant in restaurants],
+                    [restaurant["lng"] for restaurant in restaurants],
+                )
+
             # Bước 3: Gán điểm cho từng quán (Scoring)
             scored_restaurants = []
-            for restaurant in restaurants:
+            for idx, restaurant in enumerate(restaurants):
                 score = 0
                 
                 # Match preference: số lượng tags khớp (boost mạnh nhưng không loại quán không khớp)
-                matching_tags = len([tag for tag in restaurant.tags if tag.id in selected_tag_ids])
+                matching_tags = len([tag for tag in restaurant["tags"] if tag["id"] in selected_tag_ids])
                 score += matching_tags * 25
                 
                 # Price fit: dùng giá trung bình của toàn bộ menu quán.
-                avg_price = avg_price_by_restaurant.get(restaurant.id, global_avg_price)
+                avg_price = avg_price_by_restaurant.get(restaurant["id"], global_avg_price)
                 
                 if avg_price < budget / 3:
                     score += 5
@@ -769,8 +704,8 @@ def register_user_routes(app):
                 
                 # Time fit: ưu tiên quán gần (tính khoảng cách nếu có vị trí user)
                 distance_from_user = None
-                if user_lat and user_lng:
-                    distance_from_user = calculate_distance(user_lat, user_lng, restaurant.lat, restaurant.lng)
+                if distances_from_user is not None:
+                    distance_from_user = float(distances_from_user[idx])
                     if distance_from_user < 0.5:  # < 500m
                         score += 8
                     elif distance_from_user < 1:  # < 1km
@@ -892,29 +827,39 @@ def register_user_routes(app):
             
             # Find if near any restaurant
             restaurant_id = None
-            restaurants = Restaurant.query.filter_by(is_active=True).all()
-            
-            for r in restaurants:
-                distance = calculate_distance(lat, lng, r.lat, r.lng)
-                if distance <= r.poi_radius_km:
-                    restaurant_id = r.id
-                    # Update restaurant analytics khi duration >= 10s
-                    if duration_seconds >= 10:
-                        # Tính trung bình đúng cho avg_visit_duration (giây)
-                        # Công thức: New_Avg = (Old_Avg * Old_Count + New_Value) / (Old_Count + 1)
-                        if r.visit_count == 0 or r.avg_visit_duration == 0:
-                            r.avg_visit_duration = duration_seconds
-                        else:
-                            r.avg_visit_duration = int(
-                                (r.avg_visit_duration * r.visit_count + duration_seconds) / (r.visit_count + 1)
-                            )
-                        
-                        # Tăng visit_count SAU KHI tính average
-                        r.visit_count += 1
-                        
-                        # Commit ngay để lưu analytics
-                        db.session.commit()
-                    break
+            restaurants = get_catalog_snapshot().restaurants
+            nearby = None
+            if restaurants:
+                distances = haversine_distances(
+                    lat,
+                    lng,
+                    [item["lat"] for item in restaurants],
+                    [item["lng"] for item in restaurants],
+                )
+                nearby = next(
+                    (candidate for idx, candidate in enumerate(restaurants) if distances[idx] <= candidate["poi_radius_km"]),
+                    None,
+                )
+
+            if nearby is not None:
+                restaurant_id = nearby["id"]
+                # Update restaurant analytics khi duration >= 10s
+                r = Restaurant.query.get(restaurant_id) if duration_seconds >= 10 else None
+                if r is not None:
+                    # Tính trung bình đúng cho avg_visit_duration (giây)
+                    # Công thức: New_Avg = (Old_Avg * Old_Count + New_Value) / (Old_Count + 1)
+                    if r.visit_count == 0 or r.avg_visit_duration == 0:
+                        r.avg_visit_duration = duration_seconds
+                    else:
+                        r.avg_visit_duration = int(
+                            (r.avg_visit_duration * r.visit_count + duration_seconds) / (r.visit_count + 1)
+                        )
+
+                    # Tăng visit_count SAU KHI tính average
+                    r.visit_count += 1
+
+                    # Commit ngay để lưu analytics
+                    db.session.commit()
             
             # Save location visit
             visit = LocationVisit(
@@ -994,7 +939,7 @@ def build_greedy_tour(scored_restaurants, time_limit, budget, strategy="best_sco
     Xây dựng tour bằng thuật toán greedy
     
     Args:
-        scored_restaurants: List of {restaurant, score, avg_price, matching_tags}
+        scored_restaurants: List of {restaurant (catalogue payload dict), score, avg_price, matching_tags}
         time_limit: Thời gian tối đa (phút)
         budget: Ngân sách tối đa (VND)
         strategy: Chiến lược ("best_score", "nearest", "cheapest")
@@ -1033,13 +978,13 @@ def build_greedy_tour(scored_restaurants, time_limit, budget, strategy="best_sco
         # Bucket thấp hơn => phù hợp hơn.
         return max(0.0, 24.0 - (float(bucket) * 6.0))
 
-    def _candidate_priority(item, last_restaurant):
+    def _candidate_priority(item, leg_distance_km=None):
         """
         Chấm điểm heuristic có bias theo strategy.
         - Mỗi strategy chỉ bias mạnh hơn 1 tiêu chí (distance hoặc price).
         - Vẫn giữ score/tags làm nền để tránh chọn "cứng" theo 1 cột.
+        - leg_distance_km: khoảng cách từ quán vừa chọn (None ở điểm xuất phát).
         """
-        restaurant = item["restaurant"]
         score = float(item.get("score") or 0.0)
         avg_price = float(item.get("avg_price") or 0.0)
         matching_tags = int(item.get("matching_tags") or 0)
@@ -1049,14 +994,7 @@ def build_greedy_tour(scored_restaurants, time_limit, budget, strategy="best_sco
         user_distance_bucket = _distance_bucket(user_distance_km)
         user_distance_bonus = _bucket_bonus(user_distance_bucket)
 
-        if last_restaurant is not None:
-            leg_distance_km = calculate_distance(
-                last_restaurant.lat,
-                last_restaurant.lng,
-                restaurant.lat,
-                restaurant.lng,
-            )
-        else:
+        if leg_distance_km is None:
             leg_distance_km = user_distance_km
 
         leg_distance_bucket = _distance_bucket(leg_distance_km)
@@ -1117,10 +1055,10 @@ def build_greedy_tour(scored_restaurants, time_limit, budget, strategy="best_sco
         feasible_candidates = []
         for item in remaining_candidates:
             restaurant = item["restaurant"]
-            if restaurant.id in excluded_restaurant_ids:
+            if restaurant["id"] in excluded_restaurant_ids:
                 continue
             avg_price = float(item["avg_price"])
-            eat_time = restaurant.avg_eat_time or default_eat_time
+            eat_time = restaurant["avg_eat_time"] or default_eat_time
 
             if total_time + eat_time <= time_limit and total_cost + avg_price <= budget:
                 feasible_candidates.append(item)
@@ -1128,25 +1066,39 @@ def build_greedy_tour(scored_restaurants, time_limit, budget, strategy="best_sco
         if not feasible_candidates:
             break
 
-        chosen_item = max(feasible_candidates, key=lambda candidate: _candidate_priority(candidate, last_selected_restaurant))
+        # Khoảng cách chặng từ quán vừa chọn tới mọi ứng viên: 1 lần batch thay vì từng cặp.
+        leg_distances = [None] * len(feasible_candidates)
+        if last_selected_restaurant is not None:
+            leg_distances = haversine_distances(
+                last_selected_restaurant["lat"],
+                last_selected_restaurant["lng"],
+                [candidate["restaurant"]["lat"] for candidate in feasible_candidates],
+                [candidate["restaurant"]["lng"] for candidate in feasible_candidates],
+            ).tolist()
+
+        chosen_pos = max(
+            range(len(feasible_candidates)),
+            key=lambda pos: _candidate_priority(feasible_candidates[pos], leg_distances[pos]),
+        )
+        chosen_item = feasible_candidates[chosen_pos]
         remaining_candidates.remove(chosen_item)
 
         restaurant = chosen_item["restaurant"]
         avg_price = float(chosen_item["avg_price"])
-        eat_time = restaurant.avg_eat_time or default_eat_time
+        eat_time = restaurant["avg_eat_time"] or default_eat_time
 
         tour.append({
-            "id": restaurant.id,
-            "name": restaurant.name,
-            "description": restaurant.description,
-            "lat": restaurant.lat,
-            "lng": restaurant.lng,
+            "id": restaurant["id"],
+            "name": restaurant["name"],
+            "description": restaurant["description"],
+            "lat": restaurant["lat"],
+            "lng": restaurant["lng"],
             "avg_eat_time": eat_time,
             "avg_price": round(avg_price),
             "score": chosen_item["score"],
             "matching_tags": chosen_item["matching_tags"],
-            "tags": [{"id": tag.id, "name": tag.name, "icon": tag.icon, "color": tag.color} for tag in restaurant.tags],
-            "images": [{"image_url": img.image_url, "is_primary": img.is_primary} for img in restaurant.images[:2]]  # Chỉ lấy 2 ảnh đầu
+            "tags": [{"id": tag["id"], "name": tag["name"], "icon": tag["icon"], "color": tag["color"]} for tag in restaurant["tags"]],
+            "images": [{"image_url": img["image_url"], "is_primary": img["is_primary"]} for img in restaurant["images"][:2]]  # Chỉ lấy 2 ảnh đầu
         })
         total_time += eat_time
         total_cost += avg_price
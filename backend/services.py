@@ -1,7 +1,12 @@
 import math
 
+import numpy as np
+
+EARTH_RADIUS_KM = 6371
+
+
 def calculate_distance(lat1, lng1, lat2, lng2):
-    R = 6371
+    R = EARTH_RADIUS_KM
     dlat = math.radians(lat2 - lat1)
     dlng = math.radians(lng2 - lng1)
 
@@ -13,17 +18,66 @@ def calculate_distance(lat1, lng1, lat2, lng2):
     return R * c
 
 
+def _haversine_from_radians(lat1, lng1, lat2, lng2):
+    a = (
+        np.sin((lat2 - lat1) / 2.0) ** 2
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2.0) ** 2
+    )
+    # Sai số làm tròn có thể đẩy a ra ngoài [0, 1] với 2 điểm gần như đối cực.
+    a = np.clip(a, 0.0, 1.0)
+    return EARTH_RADIUS_KM * 2.0 * np.arctan2(np.sqrt(a), np.sqrt(1.0 - a))
+
+
+def haversine_distances(origin_lat, origin_lng, lats, lngs):
+    """
+    Khoảng cách (km) từ 1 điểm gốc tới mảng toạ độ, tính vector hoá bằng NumPy.
+
+    Trả về ndarray cùng độ dài với `lats`/`lngs`, kết quả khớp calculate_distance.
+    """
+    lats = np.radians(np.asarray(lats, dtype=np.float64))
+    lngs = np.radians(np.asarray(lngs, dtype=np.float64))
+    return _haversine_from_radians(
+        math.radians(float(origin_lat)),
+        math.radians(float(origin_lng)),
+        lats,
+        lngs,
+    )
+
+
+def haversine_distance_matrix(lats, lngs, other_lats=None, other_lngs=None):
+    """
+    Ma trận khoảng cách (km) giữa 2 tập toạ độ, shape (len(lats), len(other_lats)).
+
+    Bỏ trống `other_lats`/`other_lngs` để tính ma trận đối xứng trong cùng 1 tập.
+    """
+    lats = np.radians(np.asarray(lats, dtype=np.float64))
+    lngs = np.radians(np.asarray(lngs, dtype=np.float64))
+    if other_lats is None or other_lngs is None:
+        other_lats, other_lngs = lats, lngs
+    else:
+        other_lats = np.radians(np.asarray(other_lats, dtype=np.float64))
+        other_lngs = np.radians(np.asarray(other_lngs, dtype=np.float64))
+
+    return _haversine_from_radians(
+        lats[:, np.newaxis],
+        lngs[:, np.newaxis],
+        other_lats[np.newaxis, :],
+        other_lngs[np.newaxis, :],
+    )
+
+
 def generate_narration(restaurant, distance_km):
-    menu_items = restaurant.menu_items[:3]
+    """restaurant: payload dạng Restaurant.to_dict(include_details=True)."""
+    menu_items = (restaurant.get("menu") or [])[:3]
 
     if menu_items:
-        menu_names = ", ".join([m.name for m in menu_items])
+        menu_names = ", ".join([m["name"] for m in menu_items])
         menu_text = f"Quán có các món tiêu biểu như {menu_names}."
     else:
         menu_text = "Quán có thực đơn đa dạng."
 
     return (
-        f"{restaurant.name}. "
-        f"{restaurant.description}. "
+        f"{restaurant.get('name')}. "
+        f"{restaurant.get('description')}. "
         f"{menu_text} "
     )
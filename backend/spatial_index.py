@@ -0,0 +1,133 @@
+import math
+import os
+
+import numpy as np
+
+from services import haversine_distances
+
+_KM_PER_DEGREE = 2 * math.pi * 6371 / 360
+# Geodesic theo kinh độ có thể "võng" về phía cực, giữ biên an toàn khi cắt tỉa.
+_LOWER_BOUND_SAFETY = 0.95
+
+_CELL_DEGREES = float((os.getenv("SPATIAL_INDEX_CELL_DEGREES") or "0.01").strip() or "0.01")
+_CELL_DEGREES = max(0.001, min(1.0, _CELL_DEGREES))
+
+
+class SpatialGrid:
+    """
+    Uniform lat/lng grid over restaurant coordinates.
+
+    Nearest lookups scan rings of cells around the query point and stop once
+    no unvisited cell can hold a closer point, so cost depends on local density
+    instead of catalogue size.
+    """
+
+    def __init__(self, points, cell_degrees=_CELL_DEGREES):
+        self.cell_degrees = float(cell_degrees)
+        grouped = {}
+        all_ids = []
+        all_lats = []
+        all_lngs = []
+
+        for point_id, lat, lng in points or []:
+            if lat is None or lng is None:
+                continue
+            lat = float(lat)
+            lng = float(lng)
+            bucket = grouped.setdefault(self._cell_of(lat, lng), ([], [], []))
+            bucket[0].append(point_id)
+            bucket[1].append(lat)
+            bucket[2].append(lng)
+            all_ids.append(point_id)
+            all_lats.append(lat)
+            all_lngs.append(lng)
+
+        self._cells = {
+            cell: (ids, np.asarray(lats, dtype=np.float64), np.asarray(lngs, dtype=np.float64))
+            for cell, (ids, lats, lngs) in grouped.items()
+        }
+        self._ids = all_ids
+        self._lats = np.asarray(all_lats, dtype=np.float64)
+        self._lngs = np.asarray(all_lngs, dtype=np.float64)
+
+        rows = [cell[0] for cell in self._cells]
+        cols = [cell[1] for cell in self._cells]
+        self._min_row = min(rows) if rows else 0
+        self._max_row = max(rows) if rows else 0
+        self._min_col = min(cols) if cols else 0
+        self._max_col = max(cols) if cols else 0
+
+    def __len__(self):
+        return len(self._ids)
+
+    def _cell_of(self, lat, lng):
+        return (int(math.floor(lat / self.cell_degrees)), int(math.floor(lng / self.cell_degrees)))
+
+    def _ring_cells(self, row0, col0, ring):
+        if ring == 0:
+            yield (row0, col0)
+            return
+        for col in range(col0 - ring, col0 + ring + 1):
+            yield (row0 - ring, col)
+            yield (row0 + ring, col)
+        for row in range(row0 - ring + 1, row0 + ring):
+            yield (row, col0 - ring)
+            yield (row, col0 + ring)
+
+    def _unvisited_lower_bound_km(self, lat, ring):
+        # Điểm ở ring >= `ring` cách ô trung tâm tối thiểu (ring - 1) ô theo lat hoặc lng.
+        gap_degrees = max(0, ring - 1) * self.cell_degrees
+        lat_gap_km = gap_degrees * _KM_PER_DEGREE
+        widest_lat = min(90.0, abs(lat) + (ring + 1) * self.cell_degrees)
+        lng_gap_km = gap_degrees * _KM_PER_DEGREE * math.cos(math.radians(widest_lat))
+        return min(lat_gap_km, lng_gap_km) * _LOWER_BOUND_SAFETY
+
+    def _scan_all(self, lat, lng):
+        distances = haversine_distances(lat, lng, self._lats, self._lngs)
+        best_pos = int(np.argmin(distances))
+        return self._ids[best_pos], float(distances[best_pos])
+
+    def nearest(self, lat, lng):
+        """Return (point_id, distance_km) of the closest point, or (None, inf) when empty."""
+        if not self._ids:
+            return None, float("inf")
+
+        lat = float(lat)
+        lng = float(lng)
+        row0, col0 = self._cell_of(lat, lng)
+        max_ring = max(
+            abs(row0 - self._min_row),
+            abs(row0 - self._max_row),
+            abs(col0 - self._min_col),
+            abs(col0 - self._max_col),
+        )
+        occupied_cells = len(self._cells)
+
+        best_id = None
+        best_dist = float("inf")
+
+        for ring in range(0, max_ring + 1):
+            if best_id is not None and self._unvisited_lower_bound_km(lat, ring) > best_dist:
+                break
+
+            # Khi vòng quét dài hơn số ô có dữ liệu (user ở xa khu vực có quán),
+            # tính vector hoá trên toàn bộ điểm thay vì dò từng ô rỗng.
+            if ring > 0 and 8 * ring > occupied_cells:
+                return self._scan_all(lat, lng)
+
+            buckets = [self._cells[cell] for cell in self._ring_cells(row0, col0, ring) if cell in self._cells]
+            if not buckets:
+                continue
+
+            ring_ids = [point_id for bucket in buckets for point_id in bucket[0]]
+            distances = haversine_distances(
+                lat,
+                lng,
+                np.concatenate([bucket[1] for bucket in buckets]),
+                np.concatenate([bucket[2] for bucket in buckets]),
+            )
+            ring_pos = int(np.argmin(distances))
+            if distances[ring_pos] < best_dist:
+                best_id, best_dist = ring_ids[ring_pos], float(distances[ring_pos])
+
+        return best_id, best_dist
@@ -0,0 +1,188 @@
+"""
+Local disk cache for the map tile proxy.
+
+Tiles are kept in a DiskCache (byte budget, LRU eviction) keyed by provider/z/x/y
+with the upstream ETag / Last-Modified. A fresh tile is served from disk. A stale
+tile is also served from disk, and a conditional request in the background
+(If-None-Match / If-Modified-Since) refreshes it. Only a miss waits for upstream,
+and concurrent misses for the same tile share one fetch.
+"""
+import os
+import re
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from urllib.error import HTTPError, URLError
+from urllib.request import Request, urlopen
+
+from disk_cache import DiskCache
+
+MAP_TILE_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache", "map_tiles")
+_MAP_TILE_CACHE_MAX_BYTES = int((os.getenv("MAP_TILE_CACHE_MAX_BYTES") or str(256 * 1024 * 1024)).strip() or "0")
+_MAP_TILE_CACHE_MAX_BYTES = max(8 * 1024 * 1024, _MAP_TILE_CACHE_MAX_BYTES)
+# Thời gian coi tile là mới khi upstream không gửi max-age; max-age của upstream bị kẹp trong [min, max].
+_MAP_TILE_FRESH_SECONDS = int((os.getenv("MAP_TILE_FRESH_SECONDS") or "86400").strip() or "86400")
+_MAP_TILE_FRESH_SECONDS = max(60, min(30 * 86400, _MAP_TILE_FRESH_SECONDS))
+_MAP_TILE_MAX_FRESH_SECONDS = max(_MAP_TILE_FRESH_SECONDS, 7 * 86400)
+_MAP_TILE_UPSTREAM_TIMEOUT_SECONDS = 8
+_MAP_TILE_REVALIDATE_WORKERS = 2
+
+_MAX_AGE_RE = re.compile(r"(?:^|,)\s*max-age\s*=\s*(\d+)", re.IGNORECASE)
+
+_TILE_DISK_CACHE = DiskCache("map_tiles", MAP_TILE_CACHE_DIR, _MAP_TILE_CACHE_MAX_BYTES)
+_REVALIDATE_POOL = ThreadPoolExecutor(max_workers=_MAP_TILE_REVALIDATE_WORKERS, thread_name_prefix="tile-revalidate")
+_IN_FLIGHT = {}
+_IN_FLIGHT_LOCK = threading.Lock()
+_STATS_LOCK = threading.Lock()
+_STATS = {"hit": 0, "stale": 0, "miss": 0, "revalidated": 0, "refreshed": 0, "upstream_errors": 0}
+
+
+class TileUpstreamError(Exception):
+    """Upstream failed and no cached tile exists; `status` is the HTTP status to return."""
+
+    def __init__(self, status):
+        super().__init__(f"upstream status {status}")
+        self.status = status
+
+
+def _count(name):
+    with _STATS_LOCK:
+        _STATS[name] += 1
+
+
+def _tile_key(provider, z, x, y):
+    return f"{provider}/{z}/{x}/{y}"
+
+
+def _fresh_seconds(cache_control):
+    match = _MAX_AGE_RE.search(cache_control or "")
+    if not match:
+        return _MAP_TILE_FRESH_SECONDS
+    return max(_MAP_TILE_FRESH_SECONDS // 24, min(_MAP_TILE_MAX_FRESH_SECONDS, int(match.group(1))))
+
+
+def _fetch_upstream(upstream_url, meta=None):
+    """
+    GET the tile, conditionally when meta has validators.
+    Returns (body, meta) for 200, (None, meta) for 304; raises TileUpstreamError otherwise.
+    """
+    headers = {
+        "User-Agent": "NearBiteMapProxy/1.0",
+        "Accept": "image/avif,image/webp,image/apng,image/*,*/*;q=0.8",
+    }
+    if meta and meta.get("etag"):
+        headers["If-None-Match"] = meta["etag"]
+    if meta and meta.get("last_modified"):
+        headers["If-Modified-Since"] = meta["last_modified"]
+
+    try:
+        with urlopen(Request(upstream_url, headers=headers), timeout=_MAP_TILE_UPSTREAM_TIMEOUT_SECONDS) as response:
+            body = response.read()
+            return body, {
+                "content_type": response.headers.get("Content-Type", "image/png"),
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+                "fresh_seconds": _fresh_seconds(response.headers.get("Cache-Control")),
+                "fetched_at": time.time(),
+            }
+    except HTTPError as exc:
+        if exc.code == 304 and meta:
+            return None, {
+                "fresh_seconds": _fresh_seconds(exc.headers.get("Cache-Control") if exc.headers else None),
+                "fetched_at": time.time(),
+            }
+        raise TileUpstreamError(int(exc.code or 502))
+    except (URLError, TimeoutError):
+        raise TileUpstreamError(504)
+    except TileUpstreamError:
+        raise
+    except Exception:
+        raise TileUpstreamError(502)
+
+
+def _refresh(key, upstream_url, meta):
+    body, new_meta = _fetch_upstream(upstream_url, meta)
+    if body is None:
+        _TILE_DISK_CACHE.update_meta(key, new_meta)
+        _count("revalidated")
+        return _TILE_DISK_CACHE.get(key), {**meta, **new_meta}
+    _TILE_DISK_CACHE.put(key, body, new_meta)
+    _count("refreshed")
+    return body, new_meta
+
+
+def _run_in_flight(key, fn, *args):
+    """Run fn once per key at a time; concurrent callers wait for the same Future."""
+    with _IN_FLIGHT_LOCK:
+        future = _IN_FLIGHT.get(key)
+        owner = future is None
+        if owner:
+            future = Future()
+            _IN_FLIGHT[key] = future
+    if not owner:
+        try:
+            return future.result(timeout=_MAP_TILE_UPSTREAM_TIMEOUT_SECONDS * 2)
+        except TimeoutError:
+            raise TileUpstreamError(504)
+
+    try:
+        future.set_result(fn(*args))
+    except Exception as exc:
+        future.set_exception(exc)
+    finally:
+        with _IN_FLIGHT_LOCK:
+            _IN_FLIGHT.pop(key, None)
+    return future.result()
+
+
+def _revalidate_in_background(key, upstream_url, meta):
+    with _IN_FLIGHT_LOCK:
+        if key in _IN_FLIGHT:
+            return
+
+    def _task():
+        try:
+            _run_in_flight(key, _refresh, key, upstream_url, meta)
+        except TileUpstreamError as exc:
+            # Giữ bản cũ (stale-if-error); lần request sau sẽ thử lại.
+            _count("upstream_errors")
+            print(f"[map-tiles] revalidate failed key={key} status={exc.status}")
+
+    _REVALIDATE_POOL.submit(_task)
+
+
+def get_tile(provider, z, x, y, upstream_url):
+    """
+    Returns (body, content_type, cache_state) with cache_state HIT / STALE / MISS.
+    Raises TileUpstreamError when the tile is not cached and upstream fails.
+    """
+    key = _tile_key(provider, z, x, y)
+    meta = _TILE_DISK_CACHE.get_meta(key)
+    if meta is not None:
+        body = _TILE_DISK_CACHE.get(key)
+        if body is not None:
+            age = time.time() - float(meta.get("fetched_at") or 0)
+            if age < float(meta.get("fresh_seconds") or _MAP_TILE_FRESH_SECONDS):
+                _count("hit")
+                return body, meta.get("content_type") or "image/png", "HIT"
+            _count("stale")
+            _revalidate_in_background(key, upstream_url, meta)
+            return body, meta.get("content_type") or "image/png", "STALE"
+
+    _count("miss")
+    try:
+        body, meta = _run_in_flight(key, _refresh, key, upstream_url, None)
+    except TileUpstreamError:
+        _count("upstream_errors")
+        raise
+    if body is None:
+        raise TileUpstreamError(502)
+    return body, meta.get("content_type") or "image/png", "MISS"
+
+
+def get_tile_cache_stats():
+    with _STATS_LOCK:
+        stats = dict(_STATS)
+    with _IN_FLIGHT_LOCK:
+        stats["in_flight"] = len(_IN_FLIGHT)
+    return stats
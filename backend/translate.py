@@ -7,6 +7,10 @@ import hashlib
 import re
 from datetime import datetime, timedelta, timezone
 from supabase_client import supabase_client
+from memory_cache import SegmentedLRUCache
+from journal_store import AppendOnlyJournal
+from write_behind import WriteBehindBuffer
+from rate_limit import throttle
 
 # Map language codes để tương thích với Google Translate
 LANG_MAP = {
@@ -45,9 +49,19 @@ LANGUAGE_LABELS = {
 }
 
 
-_TRANSLATION_CACHE = {}
 _CACHE_LOCK = Lock()
 _MAX_CACHE_ITEMS = 20000
+_MEMORY_CACHE_MAX_BYTES = int((os.getenv("TRANSLATION_MEMORY_CACHE_MAX_BYTES") or "67108864").strip() or "67108864")
+_MEMORY_CACHE_MAX_BYTES = max(1024 * 1024, _MEMORY_CACHE_MAX_BYTES)
+_MEMORY_CACHE_TTL_SECONDS = int((os.getenv("TRANSLATION_MEMORY_CACHE_TTL_SECONDS") or "21600").strip() or "21600")
+_MEMORY_CACHE_TTL_SECONDS = max(60, min(7 * 86400, _MEMORY_CACHE_TTL_SECONDS))
+# Hết hạn/evict khỏi RAM vẫn còn bản persistent (Supabase) nên chỉ tốn 1 lần lookup lại.
+_TRANSLATION_CACHE = SegmentedLRUCache(
+    "translation",
+    max_items=_MAX_CACHE_ITEMS,
+    max_bytes=_MEMORY_CACHE_MAX_BYTES,
+    ttl_seconds=_MEMORY_CACHE_TTL_SECONDS,
+)
 _MAX_WORKERS = int((os.getenv("TRANSLATION_MAX_WORKERS") or "4").strip() or "4")
 _MAX_WORKERS = max(2, min(8, _MAX_WORKERS))
 _TRANSLATION_EXECUTOR = ThreadPoolExecutor(max_workers=_MAX_WORKERS)
@@ -57,12 +71,21 @@ _SINGLE_TIMEOUT_SECONDS = 2.5
 _PREWARM_SINGLE_TIMEOUT_SECONDS = 8
 _PREWARM_RETRY = 2
 _PREWARM_LANG_WORKERS = 3
+# Snapshot JSON cũ, chỉ dùng để seed journal lần đầu.
 _CACHE_FILE = os.path.join(os.path.dirname(__file__), "translation_cache.json")
-_CACHE_SAVE_EVERY = 20
-_pending_cache_writes = 0
+_CACHE_JOURNAL_FILE = os.path.join(os.path.dirname(__file__), "translation_cache.journal")
+_disk_cache_loaded = False
 _CACHE_TTL_SECONDS = int((os.getenv("TRANSLATION_CACHE_TTL_SECONDS") or "3600").strip() or "3600")
 _CACHE_TTL_SECONDS = max(60, min(86400, _CACHE_TTL_SECONDS))
 _PERSISTENT_CACHE_TABLE = os.getenv("TRANSLATION_CACHE_TABLE", "translation_cache_entry").strip() or "translation_cache_entry"
+# Số key mỗi request bulk (in_ / upsert) để URL và payload REST không quá dài.
+_PERSISTENT_BULK_CHUNK = 150
+_PERSISTENT_FLUSH_INTERVAL_SECONDS = float((os.getenv("TRANSLATION_PERSIST_FLUSH_SECONDS") or "2").strip() or "2")
+_PERSISTENT_FLUSH_INTERVAL_SECONDS = max(0.2, min(60.0, _PERSISTENT_FLUSH_INTERVAL_SECONDS))
+_PERSISTENT_MAX_PENDING = int((os.getenv("TRANSLATION_PERSIST_MAX_PENDING") or "5000").strip() or "5000")
+_PERSISTENT_MAX_PENDING = max(_PERSISTENT_BULK_CHUNK, min(100000, _PERSISTENT_MAX_PENDING))
+# Invalidate chờ tối đa chừng này cho batch upsert đang chạy trước khi delete.
+_PERSISTENT_DISCARD_WAIT_SECONDS = 10.0
 _CACHE_NAMESPACE = (
     (os.getenv("CACHE_NAMESPACE") or "").strip()
     or "stable-v1"
@@ -72,6 +95,7 @@ _FAST_FAIL_TRANSLATION = (os.getenv("FAST_FAIL_TRANSLATION") or "false").strip()
 }
 _TRANSLATION_RETRY = int((os.getenv("TRANSLATION_RETRY") or "2").strip() or "2")
 _TRANSLATION_RETRY = max(1, min(5, _TRANSLATION_RETRY))
+_CACHE_JOURNAL = AppendOnlyJournal(_CACHE_JOURNAL_FILE, namespace=_CACHE_NAMESPACE)
 
 SCOPED_TRANSLATION_NOTES = {
     "restaurant_narration",
@@ -109,6 +133,11 @@ def _source_checksum(text):
     return hashlib.sha256(normalized_text.encode("utf-8")).hexdigest()
 
 
+def source_checksum(text):
+    """Checksum stored next to persistent rows; lets callers detect which source texts changed."""
+    return _source_checksum(text)
+
+
 def _resolve_cache_scope_id(cache_scope_id=None, cache_note=None):
     """
     Keep per-restaurant cache only for truly restaurant-specific messages.
@@ -211,7 +240,97 @@ def _persistent_cache_get(target_lang, text, cache_scope_id=None, cache_note=Non
     return None
 
 
-def _persistent_cache_set(
+def _persistent_cache_get_many(target_lang, texts, cache_scope_id=None, cache_note=None, cache_logical_keys=None):
+    """
+    Bulk version of _persistent_cache_get: one `in_` query per chunk of keys instead of
+    one or two round trips per text. Returns a list aligned with texts (None = miss).
+    """
+    results = [None] * len(texts)
+    if not supabase_client or not texts:
+        return results
+
+    effective_scope_id = _resolve_cache_scope_id(cache_scope_id=cache_scope_id, cache_note=cache_note)
+    normalized_note = _normalize_cache_note(cache_note)
+    use_legacy_keys = cache_scope_id is not None and effective_scope_id is None
+    logical_keys = cache_logical_keys if cache_logical_keys and len(cache_logical_keys) == len(texts) else [None] * len(texts)
+
+    normalized_texts = [_normalize_source_text(text) for text in texts]
+    canonical_keys = []
+    legacy_keys = []
+    for idx, normalized_text in enumerate(normalized_texts):
+        canonical_keys.append(_persistent_cache_key(
+            target_lang,
+            normalized_text,
+            cache_scope_id=effective_scope_id,
+            cache_note=normalized_note,
+            cache_logical_key=logical_keys[idx],
+        ))
+        # Backward compatibility: previous versions scoped all restaurant texts.
+        legacy_keys.append(_persistent_cache_key(
+            target_lang,
+            normalized_text,
+            cache_scope_id=cache_scope_id,
+            cache_note=normalized_note,
+            cache_logical_key=logical_keys[idx],
+        ) if use_legacy_keys else None)
+
+    lookup_keys = list(dict.fromkeys(
+        [key for key in canonical_keys] + [key for key in legacy_keys if key is not None]
+    ))
+
+    rows_by_key = {}
+    try:
+        for i in range(0, len(lookup_keys), _PERSISTENT_BULK_CHUNK):
+            response = (
+                supabase_client
+                .table(_PERSISTENT_CACHE_TABLE)
+                .select("cache_key,translated_text,expires_at,source_checksum")
+                .in_("cache_key", lookup_keys[i:i + _PERSISTENT_BULK_CHUNK])
+                .execute()
+            )
+            for row in response.data or []:
+                if row and row.get("cache_key"):
+                    rows_by_key[row["cache_key"]] = row
+    except Exception:
+        return results
+
+    legacy_write_through = []
+    for idx, normalized_text in enumerate(normalized_texts):
+        row = rows_by_key.get(canonical_keys[idx])
+        if row is not None:
+            # If a stable logical key is used and source changed, force refresh.
+            if logical_keys[idx] is not None:
+                stored_checksum = (row.get("source_checksum") or "").strip()
+                if stored_checksum and stored_checksum != _source_checksum(normalized_text):
+                    continue
+            value = row.get("translated_text")
+            if _is_valid_translated_value(target_lang, normalized_text, value):
+                results[idx] = value
+            continue
+
+        legacy_row = rows_by_key.get(legacy_keys[idx]) if legacy_keys[idx] is not None else None
+        if legacy_row is None:
+            continue
+        legacy_value = legacy_row.get("translated_text")
+        if _is_valid_translated_value(target_lang, normalized_text, legacy_value):
+            results[idx] = legacy_value
+            legacy_write_through.append({
+                "target_lang": target_lang,
+                "text": normalized_text,
+                "translated": legacy_value,
+                "cache_scope_id": None,
+                "cache_note": normalized_note,
+                "cache_logical_key": logical_keys[idx],
+            })
+
+    if legacy_write_through:
+        # Write-through to new canonical global keys for future fast hits.
+        _persistent_cache_set_many(legacy_write_through)
+
+    return results
+
+
+def _persistent_cache_payload(
     target_lang,
     text,
     translated,
@@ -220,62 +339,122 @@ def _persistent_cache_set(
     cache_logical_key=None,
     ttl_seconds=None,
 ):
-    if not supabase_client:
-        return
-
     ttl = _CACHE_TTL_SECONDS if ttl_seconds is None else max(60, int(ttl_seconds))
     effective_scope_id = _resolve_cache_scope_id(cache_scope_id=cache_scope_id, cache_note=cache_note)
     normalized_text = _normalize_source_text(text)
     normalized_note = _normalize_cache_note(cache_note)
     normalized_logical_key = _normalize_cache_logical_key(cache_logical_key, normalized_text)
 
-    try:
-        cache_key = _persistent_cache_key(
-            target_lang,
-            normalized_text,
-            cache_scope_id=effective_scope_id,
-            cache_note=normalized_note,
-            cache_logical_key=normalized_logical_key,
+    cache_key = _persistent_cache_key(
+        target_lang,
+        normalized_text,
+        cache_scope_id=effective_scope_id,
+        cache_note=normalized_note,
+        cache_logical_key=normalized_logical_key,
+    )
+    return {
+        "cache_key": cache_key,
+        "restaurant_id": effective_scope_id,
+        "target_lang": target_lang,
+        "note": normalized_note,
+        "logical_key": normalized_logical_key,
+        "source_checksum": _source_checksum(normalized_text),
+        "source_text": normalized_text,
+        "translated_text": translated,
+        "expires_at": _expires_at_iso(ttl),
+        "updated_at": _utc_now_iso(),
+    }
+
+
+def _upsert_persistent_payloads(payloads):
+    # Flush callback của write-behind buffer: 1 REST upsert cho mỗi _PERSISTENT_BULK_CHUNK dòng.
+    for i in range(0, len(payloads), _PERSISTENT_BULK_CHUNK):
+        (
+            supabase_client
+            .table(_PERSISTENT_CACHE_TABLE)
+            .upsert(payloads[i:i + _PERSISTENT_BULK_CHUNK], on_conflict="cache_key")
+            .execute()
         )
-        payload = {
-            "cache_key": cache_key,
-            "restaurant_id": effective_scope_id,
-            "target_lang": target_lang,
-            "note": normalized_note,
-            "logical_key": normalized_logical_key,
-            "source_checksum": _source_checksum(normalized_text),
-            "source_text": normalized_text,
-            "translated_text": translated,
-            "expires_at": _expires_at_iso(ttl),
-            "updated_at": _utc_now_iso(),
-        }
-
-        supabase_client.table(_PERSISTENT_CACHE_TABLE).upsert(payload, on_conflict="cache_key").execute()
+
+
+_PERSISTENT_WRITE_BUFFER = WriteBehindBuffer(
+    "translation_persistent",
+    _upsert_persistent_payloads,
+    max_batch=_PERSISTENT_BULK_CHUNK,
+    flush_interval=_PERSISTENT_FLUSH_INTERVAL_SECONDS,
+    max_pending=_PERSISTENT_MAX_PENDING,
+)
+
+
+def _persistent_cache_set_many(entries):
+    """
+    Queue persistent translation rows for a bulk upsert by the write-behind buffer.
+
+    entries: iterable of dicts with the keyword arguments of _persistent_cache_payload.
+    Pending writes for the same cache_key are coalesced (last one wins).
+    """
+    if not supabase_client:
+        return
+
+    try:
+        for entry in entries or []:
+            payload = _persistent_cache_payload(**entry)
+            _PERSISTENT_WRITE_BUFFER.put(payload["cache_key"], payload)
     except Exception:
         return
 
 
+def _persistent_cache_set(
+    target_lang,
+    text,
+    translated,
+    cache_scope_id=None,
+    cache_note=None,
+    cache_logical_key=None,
+    ttl_seconds=None,
+):
+    _persistent_cache_set_many([{
+        "target_lang": target_lang,
+        "text": text,
+        "translated": translated,
+        "cache_scope_id": cache_scope_id,
+        "cache_note": cache_note,
+        "cache_logical_key": cache_logical_key,
+        "ttl_seconds": ttl_seconds,
+    }])
+
+
 def invalidate_translation_cache(cache_scope_id=None):
     """Invalidate translation cache globally or by restaurant scope."""
     try:
-        with _CACHE_LOCK:
-            if cache_scope_id is None:
-                _TRANSLATION_CACHE.clear()
-            else:
-                legacy_prefix = f"{cache_scope_id}::"
-                logical_marker = f"::restaurant:{cache_scope_id}:"
-                keys = [
-                    key for key in _TRANSLATION_CACHE.keys()
-                    if key.startswith(legacy_prefix) or logical_marker in key
-                ]
-                for key in keys:
-                    _TRANSLATION_CACHE.pop(key, None)
+        if cache_scope_id is None:
+            _TRANSLATION_CACHE.clear()
+            _CACHE_JOURNAL.clear()
+        else:
+            legacy_prefix = f"{cache_scope_id}::"
+            logical_marker = f"::restaurant:{cache_scope_id}:"
+            _TRANSLATION_CACHE.pop_where(
+                lambda key: key.startswith(legacy_prefix) or logical_marker in key
+            )
+            _CACHE_JOURNAL.drop_matching(prefix=legacy_prefix, contains=logical_marker)
     except Exception:
         pass
 
     if not supabase_client:
         return
 
+    # Bản ghi chưa flush của scope bị invalidate không được ghi đè lại sau lệnh delete: bỏ bản đang chờ,
+    # chờ batch đang upsert xong (và không cho nó retry) rồi mới delete.
+    if cache_scope_id is None:
+        _PERSISTENT_WRITE_BUFFER.discard(timeout=_PERSISTENT_DISCARD_WAIT_SECONDS)
+    else:
+        scope_logical_prefix = f"restaurant:{cache_scope_id}:"
+        _PERSISTENT_WRITE_BUFFER.discard(
+            lambda payload: str(payload.get("restaurant_id")) == str(cache_scope_id)
+            or str(payload.get("logical_key") or "").startswith(scope_logical_prefix),
+            timeout=_PERSISTENT_DISCARD_WAIT_SECONDS,
+        )
+
     try:
         query = supabase_client.table(_PERSISTENT_CACHE_TABLE).delete()
         if cache_scope_id is None:
@@ -290,6 +469,35 @@ def invalidate_translation_cache(cache_scope_id=None):
         pass
 
 
+def invalidate_translation_keys(logical_keys, target_lang=None):
+    """
+    Drop in-memory/journal entries for specific logical keys (all languages, or one).
+
+    Persistent rows are kept: lookups by logical key compare their source_checksum,
+    so a row whose source text changed is treated as a miss and overwritten.
+    """
+    logical_keys = {str(key).strip() for key in (logical_keys or []) if str(key or "").strip()}
+    if not logical_keys:
+        return 0
+
+    _load_cache_from_disk()
+
+    # Key bộ nhớ có dạng "{scope}::{lang}::{logical_key}".
+    def _matches(key):
+        parts = key.split("::", 2)
+        if len(parts) != 3 or parts[2] not in logical_keys:
+            return False
+        return target_lang is None or parts[1] == target_lang
+
+    removed = _TRANSLATION_CACHE.pop_where(_matches)
+    lang_marker = f"::{target_lang}" if target_lang else ""
+    try:
+        _CACHE_JOURNAL.drop_matching(suffixes=[f"{lang_marker}::{key}" for key in sorted(logical_keys)])
+    except Exception:
+        pass
+    return removed
+
+
 def cleanup_expired_translation_cache(limit=1000, max_batches=5):
     # Time-based cleanup intentionally disabled.
     # Cache rows are replaced via stable catalog keys + explicit invalidation on content changes.
@@ -307,67 +515,80 @@ def _is_valid_translated_value(target_lang, original_text, translated_text):
     return value != str(original_text).strip()
 
 
-def _load_cache_from_disk():
+def _clean_disk_entries(raw_entries):
+    cleaned = {}
+    for cache_key, translated_value in (raw_entries or {}).items():
+        parts = str(cache_key).split("::")
+        if len(parts) >= 3:
+            # New format: scope::lang::logical_key
+            lang = parts[1]
+            original_text = "placeholder"
+        elif len(parts) == 2:
+            # Legacy format: lang::text
+            lang, original_text = parts
+        else:
+            continue
+
+        if _is_valid_translated_value(lang, original_text, translated_value):
+            cleaned[cache_key] = translated_value
+    return cleaned
+
+
+def _read_legacy_cache_file():
     if not os.path.exists(_CACHE_FILE):
-        return
+        return {}
 
-    try:
-        with open(_CACHE_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
-
-        raw_entries = {}
-        if isinstance(data, dict) and "entries" in data:
-            if data.get("namespace") != _CACHE_NAMESPACE:
-                return
-            raw_entries = data.get("entries") or {}
-        elif isinstance(data, dict):
-            # Backward compatibility with previous flat cache format.
-            raw_entries = data
-
-        if isinstance(raw_entries, dict):
-            cleaned = {}
-            for cache_key, translated_value in raw_entries.items():
-                parts = str(cache_key).split("::")
-                if len(parts) >= 3:
-                    # New format: scope::lang::logical_key
-                    lang = parts[1]
-                    original_text = "placeholder"
-                elif len(parts) == 2:
-                    # Legacy format: lang::text
-                    lang, original_text = parts
-                else:
-                    continue
+    with open(_CACHE_FILE, "r", encoding="utf-8") as f:
+        data = json.load(f)
 
-                if _is_valid_translated_value(lang, original_text, translated_value):
-                    cleaned[cache_key] = translated_value
+    if isinstance(data, dict) and "entries" in data:
+        if data.get("namespace") != _CACHE_NAMESPACE:
+            return {}
+        return data.get("entries") or {}
+    if isinstance(data, dict):
+        # Backward compatibility with previous flat cache format.
+        return data
+    return {}
 
-            _TRANSLATION_CACHE.update(cleaned)
-    except Exception:
-        # Ignore cache load errors and continue with empty in-memory cache.
-        pass
 
+def _load_cache_from_disk():
+    """Replay the translation journal into memory once, on first cache lookup."""
+    global _disk_cache_loaded
 
-def _save_cache_to_disk(force=False):
-    global _pending_cache_writes
+    if _disk_cache_loaded:
+        return
 
     with _CACHE_LOCK:
-        if not force and _pending_cache_writes < _CACHE_SAVE_EVERY:
+        if _disk_cache_loaded:
             return
+        _disk_cache_loaded = True
 
         try:
-            with open(_CACHE_FILE, "w", encoding="utf-8") as f:
-                payload = {
-                    "namespace": _CACHE_NAMESPACE,
-                    "entries": _TRANSLATION_CACHE
-                }
-                json.dump(payload, f, ensure_ascii=False)
-            _pending_cache_writes = 0
-        except Exception:
-            # Ignore disk save errors; in-memory cache still works.
-            pass
+            if _CACHE_JOURNAL.exists():
+                raw_entries = _CACHE_JOURNAL.load()
+            else:
+                # Lần đầu chạy bản có journal: chuyển snapshot JSON cũ sang journal.
+                raw_entries = _clean_disk_entries(_read_legacy_cache_file())
+                _CACHE_JOURNAL.load()
+                for cache_key, translated_value in raw_entries.items():
+                    _CACHE_JOURNAL.set(cache_key, translated_value)
+                _CACHE_JOURNAL.sync()
 
+            _TRANSLATION_CACHE.update(_clean_disk_entries(raw_entries))
+        except Exception as exc:
+            # Ignore cache load errors and continue with empty in-memory cache.
+            print(f"[translate] translation cache journal load skipped: {exc}")
 
-_load_cache_from_disk()
+
+def _save_cache_to_disk():
+    """Make appended journal records durable and compact the journal when it has grown."""
+    try:
+        _CACHE_JOURNAL.sync()
+        if _CACHE_JOURNAL.maybe_compact():
+            print("[translate] translation cache journal compacted")
+    except Exception:
+        # Ignore disk save errors; in-memory cache still works.
+        pass
 
 
 def _cache_key(target_lang, text, cache_scope_id=None, cache_logical_key=None):
@@ -377,7 +598,7 @@ def _cache_key(target_lang, text, cache_scope_id=None, cache_logical_key=None):
     return f"{scope}::{target_lang}::{logical}"
 
 
-def _cache_get(target_lang, text, cache_scope_id=None, cache_note=None, cache_logical_key=None):
+def _memory_cache_get(target_lang, text, cache_scope_id=None, cache_note=None, cache_logical_key=None):
     normalized_text = _normalize_source_text(text)
     effective_scope_id = _resolve_cache_scope_id(cache_scope_id=cache_scope_id, cache_note=cache_note)
     key = _cache_key(
@@ -386,20 +607,69 @@ def _cache_get(target_lang, text, cache_scope_id=None, cache_note=None, cache_lo
         effective_scope_id,
         cache_logical_key=cache_logical_key,
     )
-    with _CACHE_LOCK:
-        cached = _TRANSLATION_CACHE.get(key)
+    _load_cache_from_disk()
+    cached = _TRANSLATION_CACHE.get(key)
     if cached is not None:
-        return cached
+        return cached, key
 
     # Backward compatibility with old in-memory scoped keys.
     if cache_scope_id is not None and effective_scope_id is None:
         legacy_key = _cache_key(target_lang, normalized_text, cache_scope_id)
-        with _CACHE_LOCK:
-            legacy_cached = _TRANSLATION_CACHE.get(legacy_key)
+        legacy_cached = _TRANSLATION_CACHE.get(legacy_key)
         if legacy_cached is not None:
-            with _CACHE_LOCK:
-                _TRANSLATION_CACHE[key] = legacy_cached
-            return legacy_cached
+            _TRANSLATION_CACHE.set(key, legacy_cached)
+            return legacy_cached, key
+
+    return None, key
+
+
+def _cache_get_many(target_lang, texts, cache_scope_id=None, cache_note=None, cache_logical_keys=None):
+    """Memory lookups for every text, then one bulk persistent lookup for the misses."""
+    logical_keys = cache_logical_keys if cache_logical_keys and len(cache_logical_keys) == len(texts) else [None] * len(texts)
+    results = [None] * len(texts)
+    memory_keys = [None] * len(texts)
+    missing_positions = []
+
+    for idx, text in enumerate(texts):
+        results[idx], memory_keys[idx] = _memory_cache_get(
+            target_lang,
+            text,
+            cache_scope_id=cache_scope_id,
+            cache_note=cache_note,
+            cache_logical_key=logical_keys[idx],
+        )
+        if results[idx] is None:
+            missing_positions.append(idx)
+
+    if not missing_positions:
+        return results
+
+    persistent_values = _persistent_cache_get_many(
+        target_lang,
+        [texts[idx] for idx in missing_positions],
+        cache_scope_id=cache_scope_id,
+        cache_note=cache_note,
+        cache_logical_keys=[logical_keys[idx] for idx in missing_positions],
+    )
+    for idx, value in zip(missing_positions, persistent_values):
+        if value is not None:
+            _TRANSLATION_CACHE.set(memory_keys[idx], value)
+            results[idx] = value
+
+    return results
+
+
+def _cache_get(target_lang, text, cache_scope_id=None, cache_note=None, cache_logical_key=None):
+    normalized_text = _normalize_source_text(text)
+    cached, key = _memory_cache_get(
+        target_lang,
+        normalized_text,
+        cache_scope_id=cache_scope_id,
+        cache_note=cache_note,
+        cache_logical_key=cache_logical_key,
+    )
+    if cached is not None:
+        return cached
 
     persistent = _persistent_cache_get(
         target_lang,
@@ -409,35 +679,43 @@ def _cache_get(target_lang, text, cache_scope_id=None, cache_note=None, cache_lo
         cache_logical_key=cache_logical_key,
     )
     if persistent is not None:
-        with _CACHE_LOCK:
-            _TRANSLATION_CACHE[key] = persistent
+        _TRANSLATION_CACHE.set(key, persistent)
         return persistent
 
     return None
 
 
-def _cache_set(target_lang, text, translated, cache_scope_id=None, cache_note=None, cache_logical_key=None):
+def _cache_set(
+    target_lang,
+    text,
+    translated,
+    cache_scope_id=None,
+    cache_note=None,
+    cache_logical_key=None,
+    write_persistent=True,
+):
     normalized_text = _normalize_source_text(text)
     effective_scope_id = _resolve_cache_scope_id(cache_scope_id=cache_scope_id, cache_note=cache_note)
 
     if not _is_valid_translated_value(target_lang, normalized_text, translated):
         return
 
-    global _pending_cache_writes
     key = _cache_key(
         target_lang,
         normalized_text,
         effective_scope_id,
         cache_logical_key=cache_logical_key,
     )
-    with _CACHE_LOCK:
-        if len(_TRANSLATION_CACHE) >= _MAX_CACHE_ITEMS:
-            # Clear whole cache when full to keep implementation lightweight.
-            _TRANSLATION_CACHE.clear()
-        _TRANSLATION_CACHE[key] = translated
-        _pending_cache_writes += 1
+    _load_cache_from_disk()
+    _TRANSLATION_CACHE.set(key, translated)
+    try:
+        _CACHE_JOURNAL.set(key, translated)
+    except Exception:
+        pass
+
+    if not write_persistent:
+        return
 
-    _save_cache_to_disk()
     _persistent_cache_set(
         target_lang,
         normalized_text,
@@ -462,6 +740,8 @@ def _translate_single_mymemory(text, mapped_lang):
 
 
 def _call_with_timeout(fn, timeout_seconds):
+    # Mọi lời gọi provider dịch đi qua đây; prewarm gắn token bucket cho thread của nó.
+    throttle("translate")
     future = _TRANSLATION_EXECUTOR.submit(fn)
     try:
         return future.result(timeout=timeout_seconds)
@@ -561,18 +841,18 @@ def translate_texts(
     missing_unique = []
     missing_seen = set()
 
+    if not force_refresh:
+        results = _cache_get_many(
+            mapped_lang,
+            normalized_texts,
+            cache_scope_id=cache_scope_id,
+            cache_note=cache_note,
+            cache_logical_keys=normalized_logical_keys,
+        )
+
     for idx, text in enumerate(normalized_texts):
-        if not force_refresh:
-            cached = _cache_get(
-                mapped_lang,
-                text,
-                cache_scope_id=cache_scope_id,
-                cache_note=cache_note,
-                cache_logical_key=normalized_logical_keys[idx],
-            )
-            if cached is not None:
-                results[idx] = cached
-                continue
+        if results[idx] is not None:
+            continue
 
         if text not in missing_seen:
             missing_seen.add(text)
@@ -615,8 +895,7 @@ def translate_texts(
                     if _is_valid_translated_value(mapped_lang, original, translated_value):
                         translated_lookup[original] = translated_value
 
-            _save_cache_to_disk(force=True)
-
+        persistent_entries = []
         for idx, text in enumerate(normalized_texts):
             if results[idx] is None:
                 translated_value = translated_lookup.get(text)
@@ -628,15 +907,32 @@ def translate_texts(
                         cache_scope_id=cache_scope_id,
                         cache_note=cache_note,
                         cache_logical_key=normalized_logical_keys[idx],
+                        write_persistent=False,
                     )
+                    persistent_entries.append({
+                        "target_lang": mapped_lang,
+                        "text": text,
+                        "translated": translated_value,
+                        "cache_scope_id": cache_scope_id,
+                        "cache_note": cache_note,
+                        "cache_logical_key": normalized_logical_keys[idx],
+                    })
+                    results[idx] = translated_value
+                elif force_refresh:
+                    # Dịch lại thất bại: giữ bản dịch cũ nếu có.
+                    results[idx] = _cache_get(
+                        mapped_lang,
+                        text,
+                        cache_scope_id=cache_scope_id,
+                        cache_note=cache_note,
+                        cache_logical_key=normalized_logical_keys[idx],
+                    ) or text
+                else:
+                    results[idx] = text
 
-                results[idx] = _cache_get(
-                    mapped_lang,
-                    text,
-                    cache_scope_id=cache_scope_id,
-                    cache_note=cache_note,
-                    cache_logical_key=normalized_logical_keys[idx],
-                ) or text
+        if persistent_entries:
+            _persistent_cache_set_many(persistent_entries)
+            _save_cache_to_disk()
 
         return results
     except Exception:
@@ -677,7 +973,8 @@ def prewarm_translation_cache(texts, target_langs):
         mapped_lang = LANG_MAP.get(lang, lang)
 
         # Ensure all texts exist in cache for this language.
-        missing = [text for text in unique_texts if _cache_get(mapped_lang, text) is None]
+        cached_values = _cache_get_many(mapped_lang, unique_texts)
+        missing = [text for text, cached in zip(unique_texts, cached_values) if cached is None]
         if not missing:
             return
 
@@ -706,4 +1003,4 @@ def prewarm_translation_cache(texts, target_langs):
                     # Keep prewarm best-effort; one language failure must not block others.
                     pass
 
-    _save_cache_to_disk(force=True)
+    _save_cache_to_disk()
@@ -1,6 +1,9 @@
 import os
 import hashlib
 import re
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from io import BytesIO
 from datetime import datetime, timedelta, timezone
 from urllib.request import Request, urlopen
@@ -12,11 +15,13 @@ from supabase_client import (
     get_public_url_for_path,
     get_signed_url_for_path,
 )
+from rate_limit import current_rate_limits, thread_rate_limits, throttle
+from memory_cache import SegmentedLRUCache
+from disk_cache import DiskCache
+from mp3_concat import concat_mp3
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 TTS_DIR = os.path.join(BASE_DIR, "static", "tts")
-MAX_FILES = 100  # Số file audio tối đa
-CLEANUP_COUNT = 50  # Số file sẽ xóa khi đạt giới hạn
 TTS_BUCKET = (os.getenv("TTS_BUCKET") or "tts-audio").strip() or "tts-audio"
 TTS_TABLE = (os.getenv("TTS_CACHE_TABLE") or "tts_cache_entry").strip() or "tts_cache_entry"
 TTS_CACHE_TTL_SECONDS = int((os.getenv("TTS_CACHE_TTL_SECONDS") or "3600").strip() or "3600")
@@ -25,7 +30,53 @@ TTS_CACHE_NAMESPACE = (
     (os.getenv("CACHE_NAMESPACE") or "").strip()
     or "stable-v1"
 )
-_IN_MEMORY_TTS_CACHE = {}
+_TTS_MEMORY_CACHE_MAX_ITEMS = int((os.getenv("TTS_MEMORY_CACHE_MAX_ITEMS") or "5000").strip() or "5000")
+_TTS_MEMORY_CACHE_MAX_ITEMS = max(100, min(200000, _TTS_MEMORY_CACHE_MAX_ITEMS))
+# Engine TTS: pool synth (gTTS) -> pool upload (Storage) -> pool index (bảng cache).
+_TTS_SYNTH_WORKERS = int((os.getenv("TTS_SYNTH_WORKERS") or "3").strip() or "3")
+_TTS_SYNTH_WORKERS = max(1, min(16, _TTS_SYNTH_WORKERS))
+_TTS_UPLOAD_WORKERS = int((os.getenv("TTS_UPLOAD_WORKERS") or "4").strip() or "4")
+_TTS_UPLOAD_WORKERS = max(1, min(16, _TTS_UPLOAD_WORKERS))
+_TTS_INDEX_WORKERS = int((os.getenv("TTS_INDEX_WORKERS") or "2").strip() or "2")
+_TTS_INDEX_WORKERS = max(1, min(8, _TTS_INDEX_WORKERS))
+_TTS_PER_LANG_CONCURRENCY = int((os.getenv("TTS_PER_LANG_CONCURRENCY") or "2").strip() or "2")
+_TTS_PER_LANG_CONCURRENCY = max(1, min(8, _TTS_PER_LANG_CONCURRENCY))
+_TTS_ENGINE_TIMEOUT_SECONDS = int((os.getenv("TTS_ENGINE_TIMEOUT_SECONDS") or "60").strip() or "60")
+_TTS_ENGINE_TIMEOUT_SECONDS = max(5, min(300, _TTS_ENGINE_TIMEOUT_SECONDS))
+
+# Cache MP3 theo từng câu (dùng chung mọi quán): sửa một câu chỉ synth lại câu đó rồi nối frame.
+_TTS_SEGMENT_CACHE_ENABLED = (os.getenv("TTS_SEGMENT_CACHE") or "true").strip().lower() in {"1", "true", "yes", "on"}
+_TTS_SEGMENT_MEMORY_MAX_BYTES = int((os.getenv("TTS_SEGMENT_MEMORY_MAX_BYTES") or str(32 * 1024 * 1024)).strip() or "0")
+_TTS_SEGMENT_MEMORY_MAX_BYTES = max(1024 * 1024, _TTS_SEGMENT_MEMORY_MAX_BYTES)
+TTS_SEGMENT_DIR = os.path.join(TTS_DIR, "segments")
+# Tầng đĩa cục bộ: /static/tts phục vụ thẳng từ đây (Range/ETag), không cần vòng qua Storage.
+TTS_AUDIO_CACHE_DIR = os.path.join(TTS_DIR, "cache")
+_TTS_DISK_CACHE_MAX_BYTES = int((os.getenv("TTS_DISK_CACHE_MAX_BYTES") or str(256 * 1024 * 1024)).strip() or "0")
+_TTS_DISK_CACHE_MAX_BYTES = max(8 * 1024 * 1024, _TTS_DISK_CACHE_MAX_BYTES)
+_TTS_SEGMENT_DISK_MAX_BYTES = int((os.getenv("TTS_SEGMENT_DISK_MAX_BYTES") or str(64 * 1024 * 1024)).strip() or "0")
+_TTS_SEGMENT_DISK_MAX_BYTES = max(4 * 1024 * 1024, _TTS_SEGMENT_DISK_MAX_BYTES)
+_TTS_SERVE_LOCAL = (os.getenv("TTS_SERVE_LOCAL") or "true").strip().lower() in {"1", "true", "yes", "on"}
+_TTS_LOCAL_MISS_TTL_SECONDS = int((os.getenv("TTS_LOCAL_MISS_TTL_SECONDS") or "60").strip() or "60")
+_TTS_LOCAL_MISS_TTL_SECONDS = max(5, min(3600, _TTS_LOCAL_MISS_TTL_SECONDS))
+_LOCAL_AUDIO_NAME_RE = re.compile(r"[A-Za-z0-9_-]{1,64}\.mp3")
+TTS_SEGMENT_STORAGE_PREFIX = "segments"
+_SENTENCE_SPLIT_RE = re.compile(r"(?<=[.!?…。！？])\s+")
+# URL audio theo "{scope}::{lang}::{hash}"; TTL bằng TTS_CACHE_TTL_SECONDS vì URL ký có hạn theo TTL đó.
+_IN_MEMORY_TTS_CACHE = SegmentedLRUCache(
+    "tts_url",
+    max_items=_TTS_MEMORY_CACHE_MAX_ITEMS,
+    ttl_seconds=TTS_CACHE_TTL_SECONDS,
+    scope_of=lambda key: key.split("::", 1)[0],
+)
+_TTS_SEGMENT_CACHE = SegmentedLRUCache(
+    "tts_segment",
+    max_items=4000,
+    max_bytes=_TTS_SEGMENT_MEMORY_MAX_BYTES,
+)
+TTS_DISK_CACHE = DiskCache("tts_audio", TTS_AUDIO_CACHE_DIR, _TTS_DISK_CACHE_MAX_BYTES)
+# Hash không có row trong bảng cache: /static/tts/<hash>.mp3 trả 404 ngay thay vì hỏi Supabase mỗi lần.
+_LOCAL_AUDIO_MISSES = SegmentedLRUCache("tts_local_miss", max_items=20000, ttl_seconds=_TTS_LOCAL_MISS_TTL_SECONDS)
+_TTS_SEGMENT_DISK_CACHE = DiskCache("tts_segment", TTS_SEGMENT_DIR, _TTS_SEGMENT_DISK_MAX_BYTES)
 _GTTS_LANGUAGE_MAP = tts_langs()
 
 
@@ -57,24 +108,6 @@ TTS_LANG_MAP = {
     "vi": "vi"
 }
 
-def cleanup_old_files():
-    """Xóa các file audio cũ nhất khi vượt quá giới hạn"""
-    try:
-        files = [f for f in os.listdir(TTS_DIR) if f.endswith('.mp3')]
-        if len(files) > MAX_FILES:
-            # Sắp xếp theo thời gian sửa đổi (cũ nhất trước)
-            files_with_time = [(f, os.path.getmtime(os.path.join(TTS_DIR, f))) for f in files]
-            files_sorted = sorted(files_with_time, key=lambda x: x[1])
-            
-            # Xóa các file cũ nhất
-            for i in range(CLEANUP_COUNT):
-                if i < len(files_sorted):
-                    file_to_remove = os.path.join(TTS_DIR, files_sorted[i][0])
-                    os.remove(file_to_remove)
-    except Exception as e:
-        pass
-
-
 def _utc_now():
     return datetime.now(timezone.utc)
 
@@ -161,7 +194,14 @@ def _list_storage_paths_recursive(prefix, bucket_name=TTS_BUCKET, page_size=100,
     return sorted(set(collected))
 
 
-def _upload_audio_bytes_to_storage(audio_bytes, mapped_lang, text_hash, restaurant_id=None, ttl_seconds=3600):
+def _upload_audio_bytes_to_storage(
+    audio_bytes,
+    mapped_lang,
+    text_hash,
+    restaurant_id=None,
+    ttl_seconds=3600,
+    verify_playable=True,
+):
     if not supabase_client or not audio_bytes:
         return None
 
@@ -178,6 +218,12 @@ def _upload_audio_bytes_to_storage(audio_bytes, mapped_lang, text_hash, restaura
             }
         )
         public_url = get_public_url_for_path(storage_path, bucket_name=TTS_BUCKET)
+        if not verify_playable:
+            # Client nghe qua /static/tts cục bộ; Storage chỉ là bản lưu bền, không cần probe HTTP.
+            return {
+                "storage_path": storage_path,
+                "public_url": public_url,
+            }
         resolved_url = _resolve_playable_storage_url(storage_path, public_url, ttl_seconds=ttl_seconds)
         if not resolved_url:
             return None
@@ -325,8 +371,9 @@ def _persistent_tts_get(cache_key):
 
 
 def _persistent_tts_set(cache_key, restaurant_id, mapped_lang, text_hash, storage_path, public_url, ttl_seconds):
+    """Upsert the cache row; returns whether it was written."""
     if not supabase_client:
-        return
+        return False
 
     try:
         payload = {
@@ -341,7 +388,9 @@ def _persistent_tts_set(cache_key, restaurant_id, mapped_lang, text_hash, storag
         }
         supabase_client.table(TTS_TABLE).upsert(payload, on_conflict="cache_key").execute()
     except Exception:
-        return
+        return False
+    _LOCAL_AUDIO_MISSES.pop(text_hash)
+    return True
 
 
 def invalidate_tts_cache(restaurant_id=None):
@@ -349,11 +398,14 @@ def invalidate_tts_cache(restaurant_id=None):
     try:
         if restaurant_id is None:
             _IN_MEMORY_TTS_CACHE.clear()
+            _TTS_SEGMENT_CACHE.clear()
+            _TTS_SEGMENT_DISK_CACHE.clear()
+            TTS_DISK_CACHE.clear()
         else:
-            prefix = f"{restaurant_id}::"
-            stale = [key for key in _IN_MEMORY_TTS_CACHE.keys() if key.startswith(prefix)]
-            for key in stale:
-                _IN_MEMORY_TTS_CACHE.pop(key, None)
+            _IN_MEMORY_TTS_CACHE.pop_scope(str(restaurant_id))
+            TTS_DISK_CACHE.delete_where(
+                lambda key, meta: str(meta.get("restaurant_id")) == str(restaurant_id)
+            )
     except Exception:
         pass
 
@@ -373,6 +425,9 @@ def invalidate_tts_cache(restaurant_id=None):
         if restaurant_id is not None:
             prefix = f"restaurant-{int(restaurant_id)}"
             paths.extend(_list_storage_paths_recursive(prefix, bucket_name=TTS_BUCKET))
+        else:
+            # Segment câu dùng chung giữa các quán nên chỉ xoá khi invalidate toàn bộ.
+            paths.extend(_list_storage_paths_recursive(TTS_SEGMENT_STORAGE_PREFIX, bucket_name=TTS_BUCKET))
 
         paths = list({p for p in paths if p})
         if paths:
@@ -395,116 +450,459 @@ def cleanup_expired_tts_cache(limit=200, max_batches=10):
     return 0
 
 
-def text_to_speech(text, lang, restaurant_id=None, ttl_seconds=None):
-    os.makedirs(TTS_DIR, exist_ok=True)
-    ttl = TTS_CACHE_TTL_SECONDS if ttl_seconds is None else max(60, int(ttl_seconds))
-
-    # Map language code cho gTTS
-    mapped_lang = TTS_LANG_MAP.get(lang, "vi")
-
-    # Tạo filename/cache key dựa trên text + language + scope
-    hash_input = f"{text}_{mapped_lang}".encode('utf-8')
-    file_hash = hashlib.md5(hash_input).hexdigest()
-    filename = f"{file_hash}.mp3"
-    filepath = os.path.join(TTS_DIR, filename)
-    scope = str(restaurant_id) if restaurant_id is not None else "global"
-    memory_cache_key = f"{scope}::{mapped_lang}::{file_hash}"
-
-    cached_url = _IN_MEMORY_TTS_CACHE.get(memory_cache_key)
-    if cached_url:
-        return cached_url
+class _TTSRequest:
+    __slots__ = (
+        "text",
+        "mapped_lang",
+        "restaurant_id",
+        "ttl",
+        "file_hash",
+        "filename",
+        "filepath",
+        "memory_cache_key",
+        "persistent_key",
+        "rate_limits",
+        "future",
+    )
+
+    def __init__(self, text, lang, restaurant_id=None, ttl_seconds=None):
+        self.text = text
+        self.ttl = TTS_CACHE_TTL_SECONDS if ttl_seconds is None else max(60, int(ttl_seconds))
+        # Map language code cho gTTS
+        self.mapped_lang = TTS_LANG_MAP.get(lang, "vi")
+        self.restaurant_id = restaurant_id
+
+        # Tạo filename/cache key dựa trên text + language + scope
+        hash_input = f"{text}_{self.mapped_lang}".encode('utf-8')
+        self.file_hash = hashlib.md5(hash_input).hexdigest()
+        self.filename = f"{self.file_hash}.mp3"
+        self.filepath = os.path.join(TTS_DIR, self.filename)
+        scope = str(restaurant_id) if restaurant_id is not None else "global"
+        self.memory_cache_key = f"{scope}::{self.mapped_lang}::{self.file_hash}"
+        self.persistent_key = _persistent_key(text, self.mapped_lang, restaurant_id=restaurant_id)
+        # Bucket rate-limit của thread gọi (vd. prewarm) được gắn lại trên thread synth.
+        self.rate_limits = current_rate_limits()
+        self.future = None
+
+
+def _index_uploaded_audio(request, upload_result):
+    return _persistent_tts_set(
+        cache_key=request.persistent_key,
+        restaurant_id=request.restaurant_id,
+        mapped_lang=request.mapped_lang,
+        text_hash=request.file_hash,
+        storage_path=upload_result["storage_path"],
+        public_url=upload_result["public_url"],
+        ttl_seconds=request.ttl,
+    )
+
+
+def _local_audio_url(request):
+    return f"/static/tts/{request.filename}"
+
+
+def _lookup_existing_audio(request):
+    """Disk tier, persistent row, or a legacy local file backfilled to Storage; None if audio must be synthesized."""
+    if _TTS_SERVE_LOCAL and request.filename in TTS_DISK_CACHE:
+        return _local_audio_url(request)
 
     if supabase_client:
-        persistent_key = _persistent_key(text, mapped_lang, restaurant_id=restaurant_id)
-        persistent_url = _persistent_tts_get(persistent_key)
+        persistent_url = _persistent_tts_get(request.persistent_key)
         if persistent_url:
-            _IN_MEMORY_TTS_CACHE[memory_cache_key] = persistent_url
-            return persistent_url
+            # File sẽ được tải từ Storage về tầng đĩa ở lần phát đầu tiên (resolve_local_tts_audio).
+            return _local_audio_url(request) if _TTS_SERVE_LOCAL else persistent_url
 
     # If local file already exists, try backfilling it to Supabase first.
-    if os.path.exists(filepath):
-        if supabase_client:
-            try:
-                with open(filepath, "rb") as f:
-                    existing_audio_bytes = f.read()
-                upload_result = _upload_audio_bytes_to_storage(
-                    existing_audio_bytes,
-                    mapped_lang,
-                    file_hash,
-                    restaurant_id=restaurant_id,
-                    ttl_seconds=ttl,
-                )
-                if upload_result:
-                    persistent_key = _persistent_key(text, mapped_lang, restaurant_id=restaurant_id)
-                    _persistent_tts_set(
-                        cache_key=persistent_key,
-                        restaurant_id=restaurant_id,
-                        mapped_lang=mapped_lang,
-                        text_hash=file_hash,
-                        storage_path=upload_result["storage_path"],
-                        public_url=upload_result["public_url"],
-                        ttl_seconds=ttl,
-                    )
-                    _IN_MEMORY_TTS_CACHE[memory_cache_key] = upload_result["public_url"]
+    if not os.path.exists(request.filepath):
+        return None
+
+    if supabase_client:
+        try:
+            with open(request.filepath, "rb") as f:
+                existing_audio_bytes = f.read()
+            upload_result = _upload_audio_bytes_to_storage(
+                existing_audio_bytes,
+                request.mapped_lang,
+                request.file_hash,
+                restaurant_id=request.restaurant_id,
+                ttl_seconds=request.ttl,
+                verify_playable=not _TTS_SERVE_LOCAL,
+            )
+            if upload_result:
+                indexed = _index_uploaded_audio(request, upload_result)
+                if not _TTS_SERVE_LOCAL or not indexed:
                     return upload_result["public_url"]
-            except Exception:
-                pass
+        except Exception:
+            pass
 
-        local_url = f"/static/tts/{filename}"
-        _IN_MEMORY_TTS_CACHE[memory_cache_key] = local_url
-        return local_url
+    return _local_audio_url(request)
 
-    # Cleanup nếu cần
-    cleanup_old_files()
 
-    audio_bytes = None
+def _synthesize_audio_bytes(text, mapped_lang, on_new_segment=None):
+    if _TTS_SEGMENT_CACHE_ENABLED:
+        try:
+            audio_bytes = _synthesize_from_segments(text, mapped_lang, on_new_segment=on_new_segment)
+        except Exception as exc:
+            print(f"[tts] segment synthesis failed lang={mapped_lang} error={exc}")
+            audio_bytes = None
+        if audio_bytes:
+            return audio_bytes
+
+    throttle("tts")
     try:
-        audio_bytes = _generate_tts_bytes(text, mapped_lang)
+        return _generate_tts_bytes(text, mapped_lang)
     except Exception:
         # If target language generation fails entirely, keep strict behavior:
         # do not auto-downgrade to Vietnamese for non-Vietnamese requests.
         if mapped_lang != "vi":
             return None
 
-        # Vietnamese baseline fallback keeps existing behavior when vi generation fails.
+    # Vietnamese baseline fallback keeps existing behavior when vi generation fails.
+    try:
+        fallback_buffer = BytesIO()
+        gTTS(text=text, lang="vi", slow=False, tld='com').write_to_fp(fallback_buffer)
+        return fallback_buffer.getvalue()
+    except Exception:
+        return None
+
+
+def split_sentences(text):
+    return [part.strip() for part in _SENTENCE_SPLIT_RE.split(str(text or "").strip()) if part.strip()]
+
+
+def _segment_hash(sentence, mapped_lang):
+    normalized = re.sub(r"\s+", " ", sentence).strip()
+    source = f"{TTS_CACHE_NAMESPACE}::{mapped_lang}::{normalized}"
+    return hashlib.sha256(source.encode("utf-8")).hexdigest()
+
+
+def _segment_storage_path(segment_hash, mapped_lang):
+    return f"{TTS_SEGMENT_STORAGE_PREFIX}/{mapped_lang}/{segment_hash}.mp3"
+
+
+def _load_segment(segment_hash, mapped_lang):
+    """Memory -> disk tier -> Storage; returns the segment MP3 bytes or None."""
+    memory_key = f"{mapped_lang}::{segment_hash}"
+    audio_bytes = _TTS_SEGMENT_CACHE.get(memory_key)
+    if audio_bytes is not None:
+        return audio_bytes
+
+    audio_bytes = _TTS_SEGMENT_DISK_CACHE.get(memory_key)
+
+    if not audio_bytes and supabase_client:
         try:
-            fallback_buffer = BytesIO()
-            gTTS(text=text, lang="vi", slow=False, tld='com').write_to_fp(fallback_buffer)
-            audio_bytes = fallback_buffer.getvalue()
+            audio_bytes = supabase_client.storage.from_(TTS_BUCKET).download(
+                _segment_storage_path(segment_hash, mapped_lang)
+            )
         except Exception:
-            return None
+            audio_bytes = None
+        if audio_bytes:
+            _TTS_SEGMENT_DISK_CACHE.put(memory_key, audio_bytes, meta={"lang": mapped_lang})
 
-    if supabase_client:
-        upload_result = _upload_audio_bytes_to_storage(
+    if audio_bytes:
+        _TTS_SEGMENT_CACHE.set(memory_key, audio_bytes)
+    return audio_bytes or None
+
+
+def _store_segment(segment_hash, mapped_lang, audio_bytes):
+    memory_key = f"{mapped_lang}::{segment_hash}"
+    _TTS_SEGMENT_CACHE.set(memory_key, audio_bytes)
+    _TTS_SEGMENT_DISK_CACHE.put(memory_key, audio_bytes, meta={"lang": mapped_lang})
+
+
+def _upload_segment(segment_hash, mapped_lang, audio_bytes):
+    if not supabase_client:
+        return
+    try:
+        ensure_bucket_exists(TTS_BUCKET)
+        supabase_client.storage.from_(TTS_BUCKET).upload(
+            _segment_storage_path(segment_hash, mapped_lang),
             audio_bytes,
-            mapped_lang,
-            file_hash,
-            restaurant_id=restaurant_id,
-            ttl_seconds=ttl,
+            {"content-type": "audio/mpeg", "upsert": "true"},
         )
-        if upload_result:
+    except Exception as exc:
+        print(f"[tts] segment upload failed lang={mapped_lang} error={exc}")
+
+
+def _synthesize_from_segments(text, mapped_lang, on_new_segment=None):
+    """
+    Build narration audio from per-sentence segments; only sentences missing from the
+    segment cache are sent to gTTS. Returns None to fall back to whole-text synthesis.
+    """
+    sentences = split_sentences(text)
+    if len(sentences) < 2:
+        return None
+
+    segments = []
+    for sentence in sentences:
+        segment_hash = _segment_hash(sentence, mapped_lang)
+        audio_bytes = _load_segment(segment_hash, mapped_lang)
+        if audio_bytes is None:
+            throttle("tts")
             try:
-                persistent_key = _persistent_key(text, mapped_lang, restaurant_id=restaurant_id)
-                _persistent_tts_set(
-                    cache_key=persistent_key,
-                    restaurant_id=restaurant_id,
-                    mapped_lang=mapped_lang,
-                    text_hash=file_hash,
-                    storage_path=upload_result["storage_path"],
-                    public_url=upload_result["public_url"],
-                    ttl_seconds=ttl,
-                )
+                audio_bytes = _generate_tts_bytes(sentence, mapped_lang)
             except Exception:
-                pass
-            _IN_MEMORY_TTS_CACHE[memory_cache_key] = upload_result["public_url"]
-            return upload_result["public_url"]
+                return None
+            _store_segment(segment_hash, mapped_lang, audio_bytes)
+            if on_new_segment is not None:
+                on_new_segment(segment_hash, mapped_lang, audio_bytes)
+        segments.append(audio_bytes)
+    return concat_mp3(segments)
+
+
+def _write_local_audio(request, audio_bytes):
+    path = TTS_DISK_CACHE.put(
+        request.filename,
+        audio_bytes,
+        meta={"restaurant_id": request.restaurant_id, "lang": request.mapped_lang},
+    )
+    return _local_audio_url(request) if path else None
+
+
+def _download_audio_by_hash(text_hash):
+    if not supabase_client:
+        return None, None
+    try:
+        rows = (
+            supabase_client
+            .table(TTS_TABLE)
+            .select("storage_path,restaurant_id,language_code")
+            .eq("text_hash", text_hash)
+            .limit(1)
+            .execute()
+        ).data or []
+        if not rows or not rows[0].get("storage_path"):
+            _LOCAL_AUDIO_MISSES.set(text_hash, True)
+            return None, None
+        audio_bytes = supabase_client.storage.from_(TTS_BUCKET).download(rows[0]["storage_path"])
+        return audio_bytes or None, rows[0]
+    except Exception as exc:
+        print(f"[tts] storage download failed hash={text_hash} error={exc}")
+        return None, None
+
+
+def resolve_local_tts_audio(filename):
+    """
+    Local file path for /static/tts/<filename>: disk tier, then the legacy static/tts
+    directory, then a one-time download from Storage into the disk tier.
+    """
+    if not _LOCAL_AUDIO_NAME_RE.fullmatch(str(filename or "")):
+        return None
+
+    path = TTS_DISK_CACHE.get_path(filename)
+    if path:
+        return path
+
+    legacy_path = os.path.join(TTS_DIR, filename)
+    if os.path.isfile(legacy_path):
+        return legacy_path
+
+    text_hash = filename[:-len(".mp3")]
+    if _LOCAL_AUDIO_MISSES.get(text_hash):
+        return None
+    audio_bytes, row = _download_audio_by_hash(text_hash)
+    if not audio_bytes:
+        return None
+    return TTS_DISK_CACHE.put(
+        filename,
+        audio_bytes,
+        meta={"restaurant_id": row.get("restaurant_id"), "lang": row.get("language_code")},
+    )
+
+
+class TTSEngine:
+    """
+    Pipelined TTS: synth pool (gTTS) -> upload pool (Storage) -> index pool (cache row).
+
+    - Requests with the same persistent key share one Future while in flight.
+    - At most `per_lang_limit` syntheses per language run at once; extra requests wait
+      in a per-language backlog instead of holding a pool thread.
+    - The Future resolves as soon as the audio URL exists. A Storage URL is returned
+      right after upload and the cache-row upsert finishes afterwards on the index pool;
+      a local /static/tts URL only after the row is written, because another worker
+      or instance serves that URL by looking the hash up in the cache table.
+    """
+
+    def __init__(self, synth_workers, upload_workers, index_workers, per_lang_limit):
+        self.per_lang_limit = per_lang_limit
+        self._synth_pool = ThreadPoolExecutor(max_workers=synth_workers, thread_name_prefix="tts-synth")
+        self._upload_pool = ThreadPoolExecutor(max_workers=upload_workers, thread_name_prefix="tts-upload")
+        self._index_pool = ThreadPoolExecutor(max_workers=index_workers, thread_name_prefix="tts-index")
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self._running_by_lang = {}
+        self._backlog_by_lang = {}
+        self.requested = 0
+        self.deduplicated = 0
+        self.synthesized = 0
+        self.uploaded = 0
+        self.indexed = 0
+        self.failures = 0
+
+    def request(self, request):
+        """Return a Future resolving to the audio URL (or None); joins an in-flight request for the same key."""
+        with self._lock:
+            self.requested += 1
+            existing = self._inflight.get(request.persistent_key)
+            if existing is not None:
+                self.deduplicated += 1
+                return existing
+            request.future = Future()
+            self._inflight[request.persistent_key] = request.future
+
+        # Chỉ request đầu tiên (leader) tra DB/file và gửi đi synth; các request trùng chờ cùng Future.
+        try:
+            existing_url = _lookup_existing_audio(request)
+        except Exception:
+            existing_url = None
+        if existing_url:
+            self._finish(request, existing_url)
+        else:
+            self._schedule_synth(request)
+        return request.future
+
+    def _schedule_synth(self, request):
+        lang = request.mapped_lang
+        with self._lock:
+            running = self._running_by_lang.get(lang, 0)
+            if running >= self.per_lang_limit:
+                self._backlog_by_lang.setdefault(lang, deque()).append(request)
+                return
+            self._running_by_lang[lang] = running + 1
+        self._synth_pool.submit(self._synth, request)
+
+    def _release_lang_slot(self, lang):
+        with self._lock:
+            backlog = self._backlog_by_lang.get(lang)
+            if backlog:
+                # Giữ nguyên slot, chuyển cho request kế tiếp cùng ngôn ngữ.
+                next_request = backlog.popleft()
+                if not backlog:
+                    del self._backlog_by_lang[lang]
+            else:
+                next_request = None
+                self._running_by_lang[lang] = self._running_by_lang.get(lang, 1) - 1
+                if self._running_by_lang[lang] <= 0:
+                    del self._running_by_lang[lang]
+        if next_request is not None:
+            self._synth_pool.submit(self._synth, next_request)
+
+    def _synth(self, request):
+        audio_bytes = None
+        try:
+            with thread_rate_limits(**request.rate_limits):
+                audio_bytes = _synthesize_audio_bytes(
+                    request.text,
+                    request.mapped_lang,
+                    on_new_segment=self._persist_segment,
+                )
+        except Exception as exc:
+            print(f"[tts] synth failed lang={request.mapped_lang} restaurant_id={request.restaurant_id} error={exc}")
+        finally:
+            self._release_lang_slot(request.mapped_lang)
+
+        if not audio_bytes:
+            self._finish(request, None)
+            return
+        with self._lock:
+            self.synthesized += 1
+        self._upload_pool.submit(self._upload, request, audio_bytes)
+
+    def _upload(self, request, audio_bytes):
+        audio_url = None
+        try:
+            local_url = _write_local_audio(request, audio_bytes) if _TTS_SERVE_LOCAL else None
+
+            if supabase_client:
+                upload_result = _upload_audio_bytes_to_storage(
+                    audio_bytes,
+                    request.mapped_lang,
+                    request.file_hash,
+                    restaurant_id=request.restaurant_id,
+                    ttl_seconds=request.ttl,
+                    verify_playable=not _TTS_SERVE_LOCAL,
+                )
+                if upload_result:
+                    with self._lock:
+                        self.uploaded += 1
+                    if local_url:
+                        # Index ngay trên thread upload: chưa có row thì worker khác trả 404 cho URL cục bộ,
+                        # nên khi index lỗi thì trả URL Storage.
+                        audio_url = local_url if self._index(request, upload_result) else upload_result["public_url"]
+                    else:
+                        audio_url = upload_result["public_url"]
+                        self._index_pool.submit(self._index, request, upload_result)
+
+            # Local fallback is valid for every language when storage is unavailable.
+            if not audio_url:
+                audio_url = local_url or _write_local_audio(request, audio_bytes)
+        finally:
+            self._finish(request, audio_url)
+
+    def _persist_segment(self, segment_hash, mapped_lang, audio_bytes):
+        self._index_pool.submit(_upload_segment, segment_hash, mapped_lang, audio_bytes)
+
+    def _index(self, request, upload_result):
+        try:
+            if not _index_uploaded_audio(request, upload_result):
+                return False
+            with self._lock:
+                self.indexed += 1
+            return True
+        except Exception:
+            return False
+
+    def _finish(self, request, audio_url):
+        if request.future.done():
+            return
+        # Ghi cache bộ nhớ trước khi bỏ khỏi in-flight để request sau không bị lọt giữa hai bước.
+        if audio_url:
+            _IN_MEMORY_TTS_CACHE.set(request.memory_cache_key, audio_url)
+        with self._lock:
+            if self._inflight.get(request.persistent_key) is request.future:
+                del self._inflight[request.persistent_key]
+            if not audio_url:
+                self.failures += 1
+        if not request.future.done():
+            request.future.set_result(audio_url)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "inflight": len(self._inflight),
+                "running_by_lang": dict(self._running_by_lang),
+                "backlog": sum(len(backlog) for backlog in self._backlog_by_lang.values()),
+                "per_lang_limit": self.per_lang_limit,
+                "requested": self.requested,
+                "deduplicated": self.deduplicated,
+                "synthesized": self.synthesized,
+                "uploaded": self.uploaded,
+                "indexed": self.indexed,
+                "failures": self.failures,
+            }
+
+
+_TTS_ENGINE = TTSEngine(
+    synth_workers=_TTS_SYNTH_WORKERS,
+    upload_workers=_TTS_UPLOAD_WORKERS,
+    index_workers=_TTS_INDEX_WORKERS,
+    per_lang_limit=_TTS_PER_LANG_CONCURRENCY,
+)
+
+
+def get_tts_engine_stats():
+    return _TTS_ENGINE.stats()
+
+
+def text_to_speech(text, lang, restaurant_id=None, ttl_seconds=None):
+    os.makedirs(TTS_DIR, exist_ok=True)
+    request = _TTSRequest(text, lang, restaurant_id=restaurant_id, ttl_seconds=ttl_seconds)
+
+    cached_url = _IN_MEMORY_TTS_CACHE.get(request.memory_cache_key)
+    if cached_url:
+        return cached_url
 
-    # Local fallback is valid for every language when storage is unavailable.
     try:
-        with open(filepath, "wb") as f:
-            f.write(audio_bytes)
-        local_url = f"/static/tts/{filename}"
-        _IN_MEMORY_TTS_CACHE[memory_cache_key] = local_url
-        return local_url
+        return _TTS_ENGINE.request(request).result(timeout=_TTS_ENGINE_TIMEOUT_SECONDS)
     except Exception:
         return None
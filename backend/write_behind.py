@@ -0,0 +1,266 @@
+import atexit
+import threading
+import time
+import weakref
+
+_REGISTRY = weakref.WeakValueDictionary()
+_REGISTRY_LOCK = threading.Lock()
+
+
+class WriteBehindBuffer:
+    """
+    Collects writes keyed by identity and hands them to `flush_fn(items)` in batches
+    from a background thread.
+
+    - A later put() for the same key replaces the pending item (coalescing), or is
+      combined with it by `merge_fn(pending, item)` when one is given.
+    - A batch is flushed when `max_batch` items are pending or `flush_interval`
+      seconds passed since the oldest pending write.
+    - At most `max_pending` items are held. When full, put() waits up to
+      `block_timeout` for the flusher (back-pressure); if still full the caller
+      writes its item synchronously so nothing is dropped.
+    - A failed batch goes back into the pending set (combined with newer writes of
+      the same key via `merge_fn`, otherwise the newer write wins) and is retried
+      with exponential backoff from `retry_backoff` up to `max_retry_backoff`
+      seconds. An item is dropped only after `max_attempts` failed flushes.
+    - Remaining items are flushed at interpreter exit.
+    """
+
+    def __init__(self, name, flush_fn, max_batch=150, flush_interval=2.0, max_pending=5000, block_timeout=1.0,
+                 merge_fn=None, max_attempts=5, retry_backoff=1.0, max_retry_backoff=60.0):
+        self.name = name
+        self._flush_fn = flush_fn
+        self._merge_fn = merge_fn
+        self.max_batch = max(1, int(max_batch))
+        self.flush_interval = max(0.05, float(flush_interval))
+        self.max_pending = max(self.max_batch, int(max_pending))
+        self.block_timeout = max(0.0, float(block_timeout))
+        self.max_attempts = max(1, int(max_attempts))
+        self.retry_backoff = max(0.05, float(retry_backoff))
+        self.max_retry_backoff = max(self.retry_backoff, float(max_retry_backoff))
+        self._pending = {}
+        self._attempts = {}  # key -> số lần flush thất bại liên tiếp của item đang chờ
+        self._consecutive_failures = 0
+        self._retry_at = None
+        # Predicate của discard() gọi trong lúc có batch đang flush: item khớp không được requeue.
+        self._inflight_discards = []
+        self._oldest_at = None
+        self._condition = threading.Condition()
+        self._thread = None
+        self._closed = False
+        self._flushing = 0
+        self.queued = 0
+        self.coalesced = 0
+        self.flushed = 0
+        self.batches = 0
+        self.failures = 0
+        self.retried = 0
+        self.dropped = 0
+        self.sync_writes = 0
+
+        with _REGISTRY_LOCK:
+            _REGISTRY[name] = self
+        atexit.register(self.close)
+
+    def _ensure_thread_locked(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=f"write-behind-{self.name}", daemon=True)
+            self._thread.start()
+
+    def put(self, key, item):
+        with self._condition:
+            if self._closed:
+                sync_item = item
+            else:
+                self._ensure_thread_locked()
+                if key not in self._pending and len(self._pending) >= self.max_pending:
+                    self._condition.notify_all()
+                    self._condition.wait_for(
+                        lambda: len(self._pending) < self.max_pending or self._closed,
+                        timeout=self.block_timeout,
+                    )
+
+                if key in self._pending:
+                    self.coalesced += 1
+                    if self._merge_fn is not None:
+                        item = self._merge_fn(self._pending[key], item)
+                    self._pending[key] = item
+                    return
+                if len(self._pending) < self.max_pending and not self._closed:
+                    self._pending[key] = item
+                    self.queued += 1
+                    if self._oldest_at is None:
+                        self._oldest_at = time.monotonic()
+                    if len(self._pending) >= self.max_batch:
+                        self._condition.notify_all()
+                    return
+                sync_item = item
+            self.sync_writes += 1
+
+        # Buffer đầy (hoặc đã đóng): ghi đồng bộ trên thread gọi thay vì bỏ dữ liệu.
+        if not self._write([sync_item]):
+            with self._condition:
+                self.failures += 1
+                self.dropped += 1
+
+    def _take_batch_locked(self):
+        keys = list(self._pending)[:self.max_batch]
+        batch = [(key, self._pending.pop(key)) for key in keys]
+        self._oldest_at = time.monotonic() if self._pending else None
+        self._flushing += 1
+        self._condition.notify_all()
+        return batch
+
+    def _write(self, items):
+        try:
+            self._flush_fn(items)
+            return True
+        except Exception as exc:
+            print(f"[write-behind] {self.name} flush failed items={len(items)} error={exc}")
+            return False
+
+    def _requeue_locked(self, batch):
+        # Item thất bại cũ hơn mọi put() đến sau nó: gộp theo thứ tự (cũ, mới) để giá trị mới thắng.
+        dropped = 0
+        for key, item in batch:
+            if any(predicate is None or predicate(item) for predicate in self._inflight_discards):
+                self._attempts.pop(key, None)
+                continue
+            attempts = self._attempts.get(key, 0) + 1
+            if attempts >= self.max_attempts:
+                self._attempts.pop(key, None)
+                dropped += 1
+                continue
+            self._attempts[key] = attempts
+            if key in self._pending:
+                if self._merge_fn is not None:
+                    self._pending[key] = self._merge_fn(item, self._pending[key])
+            else:
+                self._pending[key] = item
+            self.retried += 1
+        if self._pending and self._oldest_at is None:
+            self._oldest_at = time.monotonic()
+        self.dropped += dropped
+        if dropped:
+            print(f"[write-behind] {self.name} dropped items={dropped} after {self.max_attempts} attempts")
+
+        self._consecutive_failures += 1
+        backoff = min(self.max_retry_backoff, self.retry_backoff * (2 ** (self._consecutive_failures - 1)))
+        self._retry_at = time.monotonic() + backoff
+
+    def _finish_batch(self, batch, ok):
+        with self._condition:
+            self._flushing -= 1
+            self.batches += 1
+            if ok:
+                self.flushed += len(batch)
+                for key, _ in batch:
+                    self._attempts.pop(key, None)
+                self._consecutive_failures = 0
+                self._retry_at = None
+            else:
+                self.failures += 1
+                self._requeue_locked(batch)
+            if self._flushing == 0:
+                self._inflight_discards = []
+            self._condition.notify_all()
+
+    def _flush_batch(self, batch):
+        ok = self._write([item for _, item in batch])
+        self._finish_batch(batch, ok)
+        return ok
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    if self._closed:
+                        return
+                    if self._retry_at is not None:
+                        backoff_remaining = self._retry_at - time.monotonic()
+                        if backoff_remaining > 0:
+                            self._condition.wait(timeout=backoff_remaining)
+                            continue
+                    if len(self._pending) >= self.max_batch:
+                        break
+                    if self._pending:
+                        remaining = self.flush_interval - (time.monotonic() - self._oldest_at)
+                        if remaining <= 0:
+                            break
+                        self._condition.wait(timeout=remaining)
+                    else:
+                        self._condition.wait()
+                batch = self._take_batch_locked()
+
+            self._flush_batch(batch)
+
+    def flush(self, timeout=None):
+        """
+        Write out everything pending on the calling thread; waits for in-progress batches.
+        Stops at the first failed batch and leaves the rest to the background retries.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._condition:
+                if not self._pending:
+                    remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+                    self._condition.wait_for(lambda: self._flushing == 0, timeout=remaining)
+                    return
+                batch = self._take_batch_locked()
+            if not self._flush_batch(batch):
+                return
+            if deadline is not None and time.monotonic() >= deadline:
+                return
+
+    def discard(self, predicate=None, timeout=None):
+        """
+        Drop pending items (all, or those where predicate(item) is true) without writing them,
+        then wait up to `timeout` for batches already being flushed. Matching items of those
+        batches are not retried, so after discard() returns nothing matching is written later.
+        """
+        with self._condition:
+            keys = [key for key, item in self._pending.items() if predicate is None or predicate(item)]
+            for key in keys:
+                del self._pending[key]
+                self._attempts.pop(key, None)
+            if not self._pending:
+                self._oldest_at = None
+            if self._flushing:
+                self._inflight_discards.append(predicate)
+            self._condition.notify_all()
+            self._condition.wait_for(lambda: self._flushing == 0, timeout=timeout)
+        return len(keys)
+
+    def close(self):
+        with self._condition:
+            if self._closed:
+                return
+        self.flush(timeout=10)
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def stats(self):
+        with self._condition:
+            return {
+                "name": self.name,
+                "pending": len(self._pending),
+                "max_pending": self.max_pending,
+                "queued": self.queued,
+                "coalesced": self.coalesced,
+                "flushed": self.flushed,
+                "batches": self.batches,
+                "failures": self.failures,
+                "retried": self.retried,
+                "dropped": self.dropped,
+                "retry_in_seconds": (
+                    round(max(0.0, self._retry_at - time.monotonic()), 2) if self._retry_at is not None else 0.0
+                ),
+                "sync_writes": self.sync_writes,
+            }
+
+
+def all_write_behind_stats():
+    with _REGISTRY_LOCK:
+        buffers = list(_REGISTRY.values())
+    return {buffer.name: buffer.stats() for buffer in buffers}
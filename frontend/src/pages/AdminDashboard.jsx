@@ -1,4 +1,4 @@
-import { useState, useEffect, useRef } from 'react'
+import { useState, useEffect, useRef, useCallback } from 'react'
 import { useNavigate } from 'react-router-dom'
 import { MapContainer, TileLayer, Marker, Popup, Circle, useMap } from 'react-leaflet'
 import L from 'leaflet'
@@ -113,11 +113,46 @@ function MapAutoResize() {
   return null
 }
 
+function MapViewportWatcher({ onChange }) {
+  const map = useMap()
+
+  useEffect(() => {
+    const report = () => {
+      onChange({ bbox: map.getBounds().toBBoxString(), zoom: map.getZoom() })
+    }
+
+    report()
+    map.on('moveend', report)
+    return () => {
+      map.off('moveend', report)
+    }
+  }, [map, onChange])
+
+  return null
+}
+
 const parseCoordinate = (value) => {
   const parsed = Number(value)
   return Number.isFinite(parsed) ? parsed : null
 }
 
+const HEATMAP_WINDOWS = [
+  { value: 'all', label: 'Tất cả' },
+  { value: '1', label: '1 giờ qua' },
+  { value: 'today', label: 'Hôm nay' },
+  { value: '168', label: '7 ngày' },
+]
+
+const heatmapWindowHours = (windowValue) => {
+  if (windowValue === 'all') return null
+  if (windowValue === 'today') {
+    const midnight = new Date()
+    midnight.setHours(0, 0, 0, 0)
+    return Math.max(1, Math.ceil((Date.now() - midnight.getTime()) / 3600000))
+  }
+  return Number(windowValue) || null
+}
+
 const buildTileProxyUrl = (provider) => `${BASE_URL}/map-tiles/${provider}/{z}/{x}/{y}.png`
 const MAP_HEIGHT_PX = 520
 
@@ -161,6 +196,7 @@ function AdminDashboard({ role = 'admin' }) {
   })
   const [tileProviderIndex, setTileProviderIndex] = useState(0)
   const [tileLoaded, setTileLoaded] = useState(false)
+  const [heatmapWindow, setHeatmapWindow] = useState('all')
   const tileErrorCountRef = useRef(0)
   const [isTopbarHidden, setIsTopbarHidden] = useState(false)
   const topbarRef = useRef(null)
@@ -170,6 +206,10 @@ function AdminDashboard({ role = 'admin' }) {
   const [viewportWidth, setViewportWidth] = useState(() => (typeof window !== 'undefined' ? window.innerWidth : 1280))
   const onlineStatsRequestControllerRef = useRef(null)
   const onlineStatsRequestSeqRef = useRef(0)
+  const heatmapViewportRef = useRef(null)
+  const heatmapGridLevelRef = useRef(4)
+  const heatmapRequestSeqRef = useRef(0)
+  const heatmapWindowRef = useRef('all')
 
   const isMobile = viewportWidth <= 768
   const isTablet = viewportWidth <= 1024
@@ -268,18 +308,7 @@ function AdminDashboard({ role = 'admin' }) {
     loadOnlineStats()
 
     // Load heatmap data
-    fetch(`${BASE_URL}/admin/heatmap`, {
-      credentials: 'include'
-    })
-      .then(res => {
-        if (!res.ok) {
-          throw new Error('Failed to load heatmap')
-        }
-        return res.json()
-      })
-      .then(data => {
-        setHeatmapData(data || [])
-      })
+    fetchHeatmap()
       .catch(err => {
         console.error('Error loading heatmap:', err)
         setHeatmapData([])
@@ -325,40 +354,152 @@ function AdminDashboard({ role = 'admin' }) {
       .catch(err => console.error('Error loading top audio:', err))
   }
 
-  const loadHeatmapOnly = () => {
-    fetch(`${BASE_URL}/admin/heatmap`, {
+  const fetchHeatmap = () => {
+    // Only cells inside the current map view, at a grid resolution suited to the zoom level.
+    const requestSeq = ++heatmapRequestSeqRef.current
+    const viewport = heatmapViewportRef.current
+    const params = new URLSearchParams()
+    if (viewport) {
+      params.set('bbox', viewport.bbox)
+      params.set('zoom', String(viewport.zoom))
+    }
+    const windowHours = heatmapWindowHours(heatmapWindowRef.current)
+    if (windowHours) {
+      params.set('window_hours', String(windowHours))
+    }
+    const query = params.toString() ? `?${params.toString()}` : ''
+
+    return fetch(`${BASE_URL}/admin/heatmap${query}`, {
       credentials: 'include'
     })
       .then(res => {
         if (!res.ok) {
           throw new Error('Failed to load heatmap')
         }
-        return res.json()
+        return res.json().then(data => ({
+          data,
+          gridLevel: Number(res.headers.get('X-Heatmap-Grid-Level')) || 4
+        }))
       })
-      .then(data => {
+      .then(({ data, gridLevel }) => {
+        if (requestSeq !== heatmapRequestSeqRef.current) {
+          return
+        }
+        heatmapGridLevelRef.current = gridLevel
         setHeatmapData(data || [])
       })
+  }
+
+  const loadHeatmapOnly = () => {
+    fetchHeatmap()
       .catch(err => {
         console.error('Error loading heatmap:', err)
       })
   }
 
+  const handleHeatmapWindowChange = (event) => {
+    heatmapWindowRef.current = event.target.value
+    setHeatmapWindow(event.target.value)
+    loadHeatmapOnly()
+  }
+
+  const handleMapViewportChange = useCallback((viewport) => {
+    const previous = heatmapViewportRef.current
+    heatmapViewportRef.current = viewport
+    if (previous && previous.bbox === viewport.bbox && previous.zoom === viewport.zoom) {
+      return
+    }
+    loadHeatmapOnly()
+  }, [])
+
   useEffect(() => {
     if (isOwner || activeTab !== 'dashboard') {
       return undefined
     }
 
-    // Refresh immediately on tab entry, then keep polling.
+    // Refresh immediately on tab entry, then follow the metrics stream (polling as fallback).
     loadOnlineStats()
     loadHeatmapOnly()
 
-    const intervalId = window.setInterval(() => {
-      loadOnlineStats()
-      loadHeatmapOnly()
-    }, DASHBOARD_POLL_INTERVAL_MS)
+    let intervalId = null
+    const startPolling = () => {
+      if (intervalId !== null) return
+      intervalId = window.setInterval(() => {
+        loadOnlineStats()
+        loadHeatmapOnly()
+      }, DASHBOARD_POLL_INTERVAL_MS)
+    }
+
+    if (typeof window.EventSource === 'undefined') {
+      startPolling()
+      return () => {
+        window.clearInterval(intervalId)
+      }
+    }
+
+    const applyOnline = (online) => {
+      if (!online) return
+      setOnlineStats({
+        window_seconds: online.window_seconds || 30,
+        online_devices: online.online_devices || 0,
+        online_users: online.online_users || 0
+      })
+    }
+    const applyTopRestaurants = (top) => {
+      if (!top) return
+      setTopRestaurants(prev => ({ ...prev, ...top }))
+    }
+    const parseEvent = (event) => {
+      try {
+        return JSON.parse(event.data)
+      } catch {
+        return null
+      }
+    }
+
+    const source = new window.EventSource(`${BASE_URL}/admin/metrics/stream`, { withCredentials: true })
+    source.addEventListener('snapshot', (event) => {
+      const snapshot = parseEvent(event) || {}
+      applyOnline(snapshot.online)
+      applyTopRestaurants(snapshot.top_restaurants)
+    })
+    source.addEventListener('online', (event) => applyOnline(parseEvent(event)))
+    source.addEventListener('top_restaurants', (event) => applyTopRestaurants(parseEvent(event)))
+    source.addEventListener('heatmap', (event) => {
+      // Deltas are raw all-time hits; windowed views are refreshed by fetchHeatmap instead.
+      if (heatmapWindowRef.current !== 'all') return
+      const cells = parseEvent(event) || []
+      if (!cells.length) return
+      setHeatmapData(prev => {
+        const merged = new Map((prev || []).map(point => [`${point.lat},${point.lng}`, point]))
+        // Stream cells are on the finest grid; fold them into the grid currently displayed.
+        const gridLevel = heatmapGridLevelRef.current
+        cells.forEach(cell => {
+          const lat = gridLevel < 4 ? Number(Number(cell.lat).toFixed(gridLevel)) : cell.lat
+          const lng = gridLevel < 4 ? Number(Number(cell.lng).toFixed(gridLevel)) : cell.lng
+          const key = `${lat},${lng}`
+          const current = merged.get(key)
+          merged.set(key, {
+            lat,
+            lng,
+            intensity: (current?.intensity || 0) + (cell.hits || 0)
+          })
+        })
+        return Array.from(merged.values())
+      })
+    })
+    source.onerror = () => {
+      // EventSource reconnects by itself after a normal stream end; CLOSED means the server refused (e.g. 503).
+      if (source.readyState === window.EventSource.CLOSED) {
+        startPolling()
+      }
+    }
 
     return () => {
-      window.clearInterval(intervalId)
+      source.close()
+      if (intervalId !== null) {
+        window.clearInterval(intervalId)
+      }
     }
   }, [activeTab, isOwner])
 
@@ -699,6 +840,16 @@ function AdminDashboard({ role = 'admin' }) {
                   <div style={styles.mapContainer}>
                     <div style={{ ...styles.mapHeaderRow, ...(isMobile ? styles.mapHeaderRowMobile : {}) }}>
                       <h3 style={{ ...styles.mapTitle, ...(isMobile ? styles.mapTitleMobile : {}) }}>📍 Bản đồ Quán ăn & Heatmap User</h3>
+                      <select
+                        value={heatmapWindow}
+                        onChange={handleHeatmapWindowChange}
+                        style={styles.mapSourceBadge}
+                        aria-label="Khoảng thời gian heatmap"
+                      >
+                        {HEATMAP_WINDOWS.map(option => (
+                          <option key={option.value} value={option.value}>{option.label}</option>
+                        ))}
+                      </select>
                       <div style={{ ...styles.mapSourceBadge, ...(isMobile ? styles.mapSourceBadgeMobile : {}) }}>
                         {tileLoaded ? 'Tile OK' : 'Dang tai tile...'} | {TILE_SOURCES[tileProviderIndex].name}
                       </div>
@@ -719,6 +870,7 @@ function AdminDashboard({ role = 'admin' }) {
                           key={`admin-dashboard-map-${activeTab}-${tileProviderIndex}`}
                         >
                           <MapAutoResize />
+                          <MapViewportWatcher onChange={handleMapViewportChange} />
                           <TileLayer
                             attribution={TILE_SOURCES[tileProviderIndex].attribution}
                             url={TILE_SOURCES[tileProviderIndex].url}
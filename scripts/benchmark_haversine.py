@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Benchmark scalar calculate_distance loop vs NumPy batched haversine in backend/services.py.
+
+Run from repo root: python scripts/benchmark_haversine.py
+"""
+import argparse
+import random
+import sys
+import timeit
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT / "backend"))
+
+from services import calculate_distance, haversine_distances, haversine_distance_matrix  # noqa: E402
+
+SIZES = [100, 1000, 10000]
+# Khu vực mẫu quanh TP.HCM, giống phân bố quán thật.
+ORIGIN = (10.7769, 106.7009)
+
+
+def make_points(count, seed):
+    rng = random.Random(seed)
+    lats = [ORIGIN[0] + rng.uniform(-0.15, 0.15) for _ in range(count)]
+    lngs = [ORIGIN[1] + rng.uniform(-0.15, 0.15) for _ in range(count)]
+    return lats, lngs
+
+
+def best_of(fn, repeat, number):
+    return min(timeit.repeat(fn, repeat=repeat, number=number)) / number
+
+
+def bench_one_to_many(count, repeat):
+    lats, lngs = make_points(count, seed=count)
+
+    def scalar():
+        return [calculate_distance(ORIGIN[0], ORIGIN[1], lat, lng) for lat, lng in zip(lats, lngs)]
+
+    def vectorized():
+        return haversine_distances(ORIGIN[0], ORIGIN[1], lats, lngs)
+
+    expected = scalar()
+    actual = vectorized()
+    max_error = max(abs(a - b) for a, b in zip(expected, actual))
+
+    number = max(1, 20000 // count)
+    return best_of(scalar, repeat, number), best_of(vectorized, repeat, number), max_error
+
+
+def bench_matrix(count, repeat):
+    lats, lngs = make_points(count, seed=count + 1)
+
+    def scalar():
+        return [
+            [calculate_distance(lat_a, lng_a, lat_b, lng_b) for lat_b, lng_b in zip(lats, lngs)]
+            for lat_a, lng_a in zip(lats, lngs)
+        ]
+
+    def vectorized():
+        return haversine_distance_matrix(lats, lngs)
+
+    return best_of(scalar, repeat, 1), best_of(vectorized, repeat, 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeat", type=int, default=5, help="timeit repeat count (best run is reported)")
+    parser.add_argument(
+        "--matrix-max",
+        type=int,
+        default=1000,
+        help="largest size used for the pairwise matrix benchmark (scalar NxN loop is slow)",
+    )
+    args = parser.parse_args()
+
+    print("one origin -> N restaurants")
+    print(f"{'N':>8} {'scalar ms':>12} {'numpy ms':>12} {'speedup':>9} {'max err km':>12}")
+    for count in SIZES:
+        scalar_s, vector_s, max_error = bench_one_to_many(count, args.repeat)
+        print(
+            f"{count:>8} {scalar_s * 1000:>12.3f} {vector_s * 1000:>12.3f} "
+            f"{scalar_s / vector_s:>8.1f}x {max_error:>12.2e}"
+        )
+
+    print()
+    print("pairwise N x N matrix")
+    print(f"{'N':>8} {'scalar ms':>12} {'numpy ms':>12} {'speedup':>9}")
+    for count in [size for size in SIZES if size <= args.matrix_max]:
+        scalar_s, vector_s = bench_matrix(count, max(1, args.repeat // 2))
+        print(f"{count:>8} {scalar_s * 1000:>12.3f} {vector_s * 1000:>12.3f} {scalar_s / vector_s:>8.1f}x")
+
+
+if __name__ == "__main__":
+    main()